@@ -6,6 +6,8 @@ __license__   = 'GPL v3'
 __copyright__ = '2014, Greg Riker <griker@hotmail.com>'
 __docformat__ = 'restructuredtext en'
 
+import sys
+
 # The class that all Interface Action plugin wrappers must inherit from
 from calibre.customize import InterfaceActionBase
 from calibre.utils.config import JSONConfig
@@ -34,6 +36,28 @@ class SyncManPlugin(InterfaceActionBase):
     actual_plugin       = 'calibre_plugins.syncman.action:SyncManAction'
     prefs = JSONConfig('plugins/SyncMan')
 
+    def cli_main(self, args):
+        '''
+        Pause, resume or report on the sync apps without loading the GUI:
+        calibre-debug -r SyncMan -- status
+        '''
+        from calibre_plugins.syncman.cli import main
+        sys.exit(main(args[1:]))
+
+    def do_user_config(self, parent=None):
+        '''
+        Stage prefs changes made in the configuration dialog, so they are
+        written once when the dialog is accepted and discarded if it is
+        cancelled
+        '''
+        from calibre_plugins.syncman.prefs import prefs
+        prefs.begin_transaction()
+        try:
+            return InterfaceActionBase.do_user_config(self, parent)
+        finally:
+            # Not committed by save_settings(): the dialog was cancelled
+            prefs.end_transaction(commit=False)
+
     def is_customizable(self):
         '''
         This method must return True to enable customization via
@@ -77,6 +101,10 @@ class SyncManPlugin(InterfaceActionBase):
         '''
         config_widget.save_settings()
 
+        # Write the staged prefs in one pass
+        from calibre_plugins.syncman.prefs import prefs
+        prefs.end_transaction()
+
         # Apply the changes
         ac = self.actual_plugin_
         if ac is not None:
@@ -6,18 +6,31 @@ __license__   = 'GPL v3'
 __copyright__ = '2014, Greg Riker <griker@hotmail.com>'
 __docformat__ = 'restructuredtext en'
 
-import  os
+import  os, sys, threading, time
 
 from calibre.gui2.actions import InterfaceAction
 from calibre.utils.config import config_dir
-from calibre.utils.zipfile import ZipFile
 
 from calibre_plugins.syncman.common_utils import (
-    CompileUI, Logger, set_plugin_icon_resources)
+    PLUGIN_FORMS, Logger, inflate_resources, set_plugin_icon_resources)
 
 from calibre_plugins.syncman import SyncManPlugin
-
-from PyQt4.Qt import QIcon
+from calibre_plugins.syncman.cli import CommandLineControl
+from calibre_plugins.syncman.controller import SyncController
+from calibre_plugins.syncman.discovery import DiscoveryService
+from calibre_plugins.syncman.ignore_rules import IgnoreRules
+from calibre_plugins.syncman.journal import PauseJournal
+from calibre_plugins.syncman.library_index import LibraryIndex
+from calibre_plugins.syncman.quiescence import (
+    DEFAULT_QUIET_RATE, DEFAULT_QUIET_WINDOW, MIN_SAMPLE_INTERVAL, QuiescenceMonitor)
+from calibre_plugins.syncman.snapshot import SnapshotPublisher
+from calibre_plugins.syncman.staging import StagingArea
+from calibre_plugins.syncman.sync_control import (
+    DEFAULT_MAX_PAUSE, DEFAULT_PAUSE_COOLDOWN, DEFAULT_RESUME_DELAY,
+    DEFAULT_UPLOAD_RATE, PauseScheduler, SuspensionEngine)
+from calibre_plugins.syncman.tracing import timings, tracer
+
+from PyQt4.Qt import QIcon, QTimer, pyqtSignal
 
 # The first icon is the plugin icon, referenced by position.
 # The rest of the icons are referenced by name
@@ -25,6 +38,21 @@ PLUGIN_ICONS = ['images/disabled.png', 'images/enabled.png']
 
 plugin_resources_path = os.path.join(config_dir, 'plugins', 'SyncMan_resources')
 
+# Time budget for genesis(), in seconds. genesis() runs while calibre's main
+# window is being built, so the dialog form and config.py are never imported
+# here; they are loaded when the dialog is first opened.
+GENESIS_BUDGET = 0.05
+
+def is_plugin_resource(name):
+    '''
+    Select the plugin zip members inflated to plugin_resources_path
+    '''
+    return (name.startswith('help/') and name.endswith('.html') or
+            name.startswith('help/images/') or
+            name.startswith('icons/') or
+            name == 'sync_app_wizard.py' or
+            name in [widget + '.ui' for widget in PLUGIN_FORMS])
+
 class SyncManAction(InterfaceAction, Logger):
 
     name = 'SyncMan'
@@ -36,28 +64,85 @@ class SyncManAction(InterfaceAction, Logger):
     # action_spec = (text, icon_path, tooltip, keyboard shortcut)
     action_spec = ('SyncMan', None, 'Configure SyncMan', None)
 
+    # Library change notifications may arrive on a database thread, this
+    # signal delivers them to the GUI thread
+    library_write = pyqtSignal()
+
+    # Delivers library index results from the scanning thread
+    library_scanned = pyqtSignal(object)
+
     def apply_settings(self):
-        # In an actual non trivial plugin, you would probably need to
-        # do something based on the settings in prefs
-        #from calibre_plugins.syncman.config import prefs
-        #prefs
+        tracer.enabled = self.prefs.get('debug_plugin', False)
         self._log_location()
+        self.configure_scheduler()
+        # A different sync app may have been selected, release the old one
+        if self.scheduler.paused:
+            self.resume_sync_app()
+        # Resolve the library's profile from the new prefs
+        self.engine.set_library(self.library_path)
+        # Start mirroring a newly configured staging area, and write the
+        # ignore rules of newly selected sync apps
+        self.scan_library()
+
+    def arm_resume_timer(self):
+        '''
+        Arm the timer for the scheduler's next deadline
+        '''
+        remaining = self.scheduler.next_deadline()
+        if remaining is None:
+            self.resume_timer.stop()
+        else:
+            self.resume_timer.start(int(remaining * 1000))
+
+    def attach_library(self, db):
+        '''
+        Listen for changes to db, detaching from the previous library
+        '''
+        self.detach_library()
+        self.library_path = db.library_path
+        # The apps of the library's profile are resolved once, on first use
+        self.engine.set_library(self.library_path)
+        # Catch up with changes made while calibre was not running
+        self.library_index = LibraryIndex(self.library_path)
+        self.scan_library()
+        api = getattr(db, 'new_api', db)
+        if hasattr(api, 'add_listener'):
+            api.add_listener(self.library_listener)
+            self.listening_db = api
+        else:
+            self._log_location("library does not support change notifications")
 
     def genesis(self):
-        self._log_location("v{0}.{1}.{2}".format(*SyncManPlugin.version))
-        from calibre_plugins.syncman.config import prefs
+        started = time.time()
+        from calibre_plugins.syncman.prefs import prefs
 
         self.prefs = prefs
 
-        # Read the plugin icons and store for potential sharing with the config widget
-        icon_resources = self.load_resources(PLUGIN_ICONS)
-        set_plugin_icon_resources(self.name, icon_resources)
-
-
         self.resources_path = os.path.join(config_dir, 'plugins', "%s_resources" % self.name.replace(' ', '_'))
         if not os.path.exists(self.resources_path):
             os.makedirs(self.resources_path)
 
+        # Populate the help, icon, wizard and form resources, so
+        # compile_widgets() finds the forms inflated when the dialog is opened
+        with tracer.span('genesis.inflate_resources'):
+            self.inflate_resources()
+
+        self._log_location("v{0}.{1}.{2}".format(*SyncManPlugin.version))
+
+        # Read the plugin icons and store for potential sharing with the config widget
+        with tracer.span('genesis.load_icons'):
+            icon_resources = self.load_resources(PLUGIN_ICONS)
+            set_plugin_icon_resources(self.name, icon_resources)
+
+        # Suspend the sync apps during library write bursts, resume them
+        # after the library has been quiet for prefs['resume_delay'] seconds.
+        # The controller does this on its own thread. Processes held by a
+        # command line pause are left to the command line.
+        self.engine = SuspensionEngine(self.prefs, command_line=CommandLineControl)
+        self.controller = SyncController(self.engine)
+        self.controller.job_done.connect(self.control_job_done)
+        self.sync_app_results = {}
+
         # This method is called once per plugin, do initial setup here
 
         # Set the icon for this interface action
@@ -71,7 +156,7 @@ class SyncManAction(InterfaceAction, Logger):
         # will return a dictionary mapping names to QIcons. Names that
         # are not found in the zip file will result in null QIcons.
 
-        if self.prefs.get('sync_app'):
+        if self.engine.active_apps():
             icon = get_icons('images/enabled.png')
         else:
             icon = QIcon(I('config.png'))
@@ -83,80 +168,324 @@ class SyncManAction(InterfaceAction, Logger):
         self.qaction.setIcon(icon)
         self.qaction.triggered.connect(self.show_dialog)
 
-        # Populate the help resources
-        self.inflate_help_resources()
-
-        # Populate icon resources
-        self.inflate_icon_resources()
-
-        # Populate the wizard resources
-        self.inflate_wizard_resources()
-
-    def inflate_help_resources(self):
-        '''
-        Extract the help resources from the plugin
-        '''
-        help_resources = []
-        with ZipFile(self.plugin_path, 'r') as zf:
-            for candidate in zf.namelist():
-                if (candidate.startswith('help/') and candidate.endswith('.html') or
-                    candidate.startswith('help/images/')):
-                    help_resources.append(candidate)
-
-        rd = self.load_resources(help_resources)
-        for resource in help_resources:
-            if not resource in rd:
-                continue
-            fs = os.path.join(self.resources_path, resource)
-            if os.path.isdir(fs) or fs.endswith('/'):
-                continue
-            if not os.path.exists(os.path.dirname(fs)):
-                os.makedirs(os.path.dirname(fs))
-            with open(fs, 'wb') as f:
-                f.write(rd[resource])
-
-    def inflate_icon_resources(self):
-        '''
-        Extract the icon resources from the plugin
-        '''
-        icons = []
-        with ZipFile(self.plugin_path, 'r') as zf:
-            for candidate in zf.namelist():
-                if candidate.endswith('/'):
-                    continue
-                if candidate.startswith('icons/'):
-                    icons.append(candidate)
-        ir = self.load_resources(icons)
-        for icon in icons:
-            if not icon in ir:
-                continue
-            fs = os.path.join(self.resources_path, icon)
-            if not os.path.exists(fs):
-                if not os.path.exists(os.path.dirname(fs)):
-                    os.makedirs(os.path.dirname(fs))
-                with open(fs, 'wb') as f:
-                    f.write(ir[icon])
-
-    def inflate_wizard_resources(self):
-        wr = 'sync_app_wizard.py'
-        target = os.path.join(self.resources_path, wr)
-        if os.path.exists(target):
-            os.remove(target)
-
-        with ZipFile(self.plugin_path, 'r') as zfr:
+        # Publish metadata.db snapshots as pause windows close, and mirror
+        # the library through a staging folder
+        self.snapshot_publisher = SnapshotPublisher(self.prefs)
+        self.staging = StagingArea(self.prefs)
+
+        # Tell when the sync apps have caught up after a resume, asking
+        # those whose driver has a status query
+        self.quiescence = QuiescenceMonitor()
+        self.quiescence_result = None
+        self.sample_timer = QTimer()
+        self.sample_timer.setSingleShot(True)
+        self.sample_timer.timeout.connect(self.sample_sync_apps)
+
+        self.scheduler = PauseScheduler(self.controller,
+                                        before_resume=self.pause_window_closing)
+        self.journal = PauseJournal()
+        self.configure_scheduler()
+        self.resume_timer = QTimer()
+        self.resume_timer.setSingleShot(True)
+        self.resume_timer.timeout.connect(self.scheduler_tick)
+        self.library_write.connect(self.library_write_burst)
+        # calibre may hold listeners by weak reference, keep our own
+        self.library_listener = self.library_event
+        self.listening_db = None
+        self.library_path = None
+
+        # Estimate what the sync app has to upload after each window, and
+        # which library files it should never upload
+        self.ignore_rules = IgnoreRules()
+        self.library_index = None
+        self.index_lock = threading.Lock()
+        # Held while the index is updated, by the scanning thread or the
+        # controller's as a pause window closes
+        self.scan_lock = threading.Lock()
+
+        # Created when the GUI is up, see initialization_complete()
+        self.discovery = None
+        self.library_scanned.connect(self.library_scan_complete)
+
+        self.check_genesis_budget(time.time() - started)
+
+    def check_genesis_budget(self, elapsed):
+        '''
+        Report genesis() exceeding GENESIS_BUDGET, or importing the dialog
+        '''
+        self.genesis_elapsed = elapsed
+        timings.record('genesis', elapsed)
+        if tracer.enabled:
+            tracer.event("span genesis: {0:.3f} ms", elapsed * 1000)
+        # The wizard is inflated to the resources folder and imported from
+        # there by import_resource_module(), as a top-level module
+        eager = [m for m in ('calibre_plugins.syncman.config',
+                             'calibre_plugins.syncman.conflicts_report',
+                             'calibre_plugins.syncman.replica_report',
+                             'sync_app_wizard')
+                 if m in sys.modules]
+        if elapsed > GENESIS_BUDGET or eager:
+            self._log_location("genesis took {0:.1f} ms (budget {1:.1f} ms)".format(
+                elapsed * 1000, GENESIS_BUDGET * 1000),
+                "eagerly imported: {0}".format(', '.join(eager)) if eager else '')
+        return elapsed <= GENESIS_BUDGET and not eager
+
+    def commit_staged(self):
+        '''
+        Move staged files into the library mirror, suspending the sync apps
+        unless a pause window will commit them as it closes
+        '''
+        if not self.staging.enabled or self.scheduler.paused or not self.staging.pending:
+            return
+
+        def commit():
+            self.engine.suspend()
             try:
-                zfr.extract(wr, self.resources_path)
-            except:
-                self._log_location()
-                import traceback
-                self._log(traceback.format_exc())
-                raise Exception("Unable to inspect {}".format(wr))
+                return self.staging.commit()
+            finally:
+                self.engine.resume()
+        self.controller.submit('commit_staged', commit)
+
+    def control_job_done(self, operation, result):
+        '''
+        A job run by the controller has finished
+        '''
+        if isinstance(result, Exception):
+            self._log("{0} job failed: {1}", operation, result)
+            if operation == 'sample' and not self.scheduler.paused:
+                # A process may exit while it is sampled, keep watching
+                self.sample_timer.start(MIN_SAMPLE_INTERVAL * 1000)
+            return
+        if operation in ('suspend', 'resume'):
+            self.sync_apps_reported(operation, result)
+        if operation == 'suspend':
+            self.sample_timer.stop()
+        elif operation == 'resume':
+            self.journal_window()
+            # Watch the apps catch up from the start
+            self.controller.submit('quiescence_reset', self.quiescence.reset)
+            self.sample_timer.start(MIN_SAMPLE_INTERVAL * 1000)
+        elif operation == 'sample':
+            self.sync_apps_sampled(result)
+
+    def configure_scheduler(self):
+        '''
+        Apply the pause window and quiescence settings from prefs
+        '''
+        self.scheduler.configure(
+            self.prefs.get('resume_delay', DEFAULT_RESUME_DELAY),
+            self.prefs.get('max_pause', DEFAULT_MAX_PAUSE),
+            self.prefs.get('pause_cooldown', DEFAULT_PAUSE_COOLDOWN),
+            self.prefs.get('upload_rate', DEFAULT_UPLOAD_RATE))
+        self.quiescence.quiet_rate = self.prefs.get('quiet_rate', DEFAULT_QUIET_RATE)
+        self.quiescence.quiet_window = self.prefs.get('quiet_window', DEFAULT_QUIET_WINDOW)
+
+    def detach_library(self):
+        '''
+        Stop listening for changes to the current library
+        '''
+        if self.listening_db is not None:
+            if hasattr(self.listening_db, 'remove_listener'):
+                self.listening_db.remove_listener(self.library_listener)
+            else:
+                getattr(self.listening_db, 'listeners', set()).discard(self.library_listener)
+            self.listening_db = None
+
+    def inflate_resources(self):
+        '''
+        Extract the help, icon, wizard and form resources from the plugin in a
+        single pass, skipping members unchanged since the last startup
+        '''
+        extracted = inflate_resources(self.plugin_path, self.resources_path,
+                                      is_plugin_resource)
+        return extracted
+
+    def library_write_burst(self):
+        '''
+        calibre is writing to the library. Open or extend a pause window.
+        '''
+        if self.engine.local_only:
+            return
+        if self.scheduler.event():
+            self.arm_resume_timer()
+
+    def pause_window_closing(self):
+        '''
+        A pause window is closing. Work queued here runs before the sync
+        apps are resumed.
+        '''
+        if self.library_path is not None:
+            self.controller.submit('window_closing', self.pause_window_work,
+                                   self.library_path)
+        if not self.staging.enabled:
+            # With staging, pause_window_work() scans
+            self.scan_library()
+
+    def pause_window_work(self, library_path):
+        '''
+        Publish a snapshot of metadata.db if due, and move staged files into
+        the mirror. Runs on the controller's thread.
+        '''
+        self.snapshot_publisher.publish(library_path)
+        if self.staging.enabled:
+            # Stage what the window wrote now, so it is committed before the
+            # apps resume instead of suspending them again afterwards
+            index = self.library_index
+            scanned = False
+            if index is not None and index.library_path == library_path:
+                try:
+                    delta = self.update_library_index(index)
+                    scanned = True
+                except Exception as e:
+                    self._log("library scan failed: {0}", e)
+            self.staging.commit()
+            # Reported once committed, so commit_staged() finds nothing left
+            if scanned and index is self.library_index:
+                self.library_scanned.emit(delta)
+
+    def resume_sync_app(self):
+        '''
+        Close any open pause window now
+        '''
+        self.resume_timer.stop()
+        self.scheduler.close()
+
+    def scheduler_tick(self):
+        '''
+        Pause window deadline reached
+        '''
+        self.scheduler.tick()
+        self.arm_resume_timer()
+
+    def sample_sync_apps(self):
+        '''
+        Sample the sync apps' I/O and CPU use on the controller's thread
+        '''
+        if self.scheduler.paused:
+            # Sampling restarts when the window closes
+            return
+
+        def sample():
+            drivers = self.engine.drivers()
+            self.engine.process_index.register(d.app_path for d in drivers.values())
+            statuses = {}
+            for name, driver in drivers.items():
+                status = driver.status()
+                if status is not None:
+                    statuses[name] = status
+            result = self.quiescence.sample(
+                dict((name, driver.pids()) for name, driver in drivers.items()),
+                [busy for busy, busy_status in statuses.items()
+                 if not drivers[busy].is_idle(busy_status)])
+            if result is not None:
+                result['statuses'] = statuses
+            return result
+        self.controller.submit('sample', sample)
+
+    def scan_library(self):
+        '''
+        Update the library index on a worker thread
+        '''
+        index = self.library_index
+        if index is None:
+            return
+        with self.index_lock:
+            if index.scanning:
+                # Picked up by the running scan when it finishes
+                index.rescan = True
+                return
+            index.scanning = True
+
+        def scan():
+            while True:
+                try:
+                    delta = self.update_library_index(index)
+                except Exception as e:
+                    self._log("library scan failed: {0}", e)
+                    delta = None
+                # Results for a library we have since left are dropped
+                if index is self.library_index:
+                    self.library_scanned.emit(delta)
+                with self.index_lock:
+                    if not index.rescan:
+                        index.scanning = False
+                        return
+                    index.rescan = False
+
+        thread = threading.Thread(target=scan, name='SyncMan library index')
+        thread.daemon = True
+        thread.start()
+
+    def stage_changes(self, index, delta):
+        '''
+        Copy the files changed since the previous scan into the staging
+        folder. Called on the scanning thread.
+        '''
+        if not self.staging.enabled:
+            return
+        problem = self.staging.check(index.library_path)
+        if problem:
+            self._log("not mirroring {0}: {1}", index.library_path, problem)
+            return
+        if delta is None or self.staging.needs_full_copy():
+            changed, removed = index.paths(), []
+        else:
+            changed, removed = delta['changed'], delta['removed']
+        # Files calibre was still writing are picked up by the next scan
+        for path in self.staging.stage(index.library_path, changed, removed):
+            index.forget(path)
 
     def initialization_complete(self):
         '''
         Initialization of main GUI is complete
         '''
         self._log_location()
+        self.attach_library(self.gui.current_db)
+        self.sample_timer.start(MIN_SAMPLE_INTERVAL * 1000)
+
+        # Look for installed sync apps for the wizard, off the GUI thread
+        self.discovery = DiscoveryService()
+        self.discovery.start()
+
+    def journal_window(self):
+        '''
+        Record the last pause window once the sync apps have been resumed
+        '''
+        window = self.scheduler.last_window
+        if window is None:
+            return
+        self.scheduler.last_window = None
+        start, duration, events, closed_at = window
+        try:
+            self.journal.append(start, duration, events, time.time() - closed_at)
+        except EnvironmentError as e:
+            self._log("unable to journal pause window: {0}", e)
+
+    def library_changed(self, db):
+        '''
+        Called when the current library is changed
+        '''
+        self._log_location()
+        # Writes to the previous library are done, let them sync
+        self.resume_sync_app()
+        self.attach_library(db)
+
+    def library_event(self, *args):
+        '''
+        Change notification from the library, possibly on another thread
+        '''
+        self.library_write.emit()
+
+    def library_scan_complete(self, delta):
+        '''
+        The library index was updated, delta is None for a new index
+        '''
+        self.commit_staged()
+        if delta is None:
+            return
+        self._log("{0} files changed, {1} deleted, {2} bytes pending upload",
+                  delta['files'], delta['deleted'], delta['bytes'])
+        self.scheduler.report_backlog(delta['bytes'])
 
     def show_dialog(self):
         '''
@@ -171,4 +500,72 @@ class SyncManAction(InterfaceAction, Logger):
         '''
         self._log_location()
 
-        return True
\ No newline at end of file
+        # Never leave the sync app stopped after calibre exits. Queued work
+        # gets SHUTDOWN_TIMEOUT seconds, the apps are continued regardless.
+        self.detach_library()
+        self.sample_timer.stop()
+        self.resume_sync_app()
+        self.commit_staged()
+        if self.snapshot_publisher.published and self.library_path is not None:
+            # Bring the published snapshot up to date with this session
+            self.controller.submit('publish_snapshot', self.snapshot_publisher.publish,
+                                   self.library_path, True)
+        self.controller.shutdown()
+        # The resume's job_done will not be delivered now
+        self.journal_window()
+        self._log_location(self.scheduler.counters())
+        tracer.flush()
+        timings.save()
+
+        return True
+
+    def sync_apps_sampled(self, result):
+        '''
+        Show whether the sync apps have finished uploading, and schedule the
+        next sample. result is None where sampling is not supported.
+        '''
+        if result is None:
+            return
+        previous, self.quiescence_result = self.quiescence_result, result
+        if previous is None or previous['quiescent'] != result['quiescent']:
+            self.qaction.setToolTip("SyncMan: sync apps idle" if result['quiescent']
+                                    else "SyncMan: sync apps busy")
+        if not self.scheduler.paused:
+            self.sample_timer.start(int(result['interval'] * 1000))
+
+    def update_ignore_rules(self, index, delta):
+        '''
+        Match the paths changed since the previous scan against the ignore
+        rules, and rewrite the sync apps' configuration if needed. Called on
+        the scanning thread.
+        '''
+        rules = self.ignore_rules
+        if delta is None or rules.library_path != index.library_path:
+            changed = rules.rebuild(index.library_path, index.paths())
+        else:
+            changed = rules.update(delta['changed'], delta['removed'])
+        apps = self.engine.active_apps()
+        if changed or rules.saved_for != apps:
+            rules.save(index.library_path, apps)
+
+    def update_library_index(self, index):
+        '''
+        Rescan the library, then update the ignore rules and stage the
+        changes. Returns the index delta.
+        '''
+        with self.scan_lock:
+            delta = index.update()
+            self.update_ignore_rules(index, delta)
+            self.stage_changes(index, delta)
+        return delta
+
+    def sync_apps_reported(self, operation, results):
+        '''
+        Per-app results of a suspend or resume by the controller
+        '''
+        self.sync_app_results[operation] = results
+        for name, result in sorted(results.items()):
+            self._log("{0} {1}: pids {2} in {3:.1f} ms{4}", operation, name,
+                      result['pids'], result['elapsed'] * 1000,
+                      ", errors: {0}".format(result['errors']) if result['errors'] else '')
+
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+'''
+Check and time each sync app driver against fake sync apps.
+
+    python2 benchmarks/drivers.py [--runs N] [--children N] [--output FILE]
+
+For each driver, starts benchmarks/fake_sync.py as a sync app of 1 +
+--children processes, under a link to the Python interpreter in a scratch
+app folder, so the driver finds it by path like a real app. The fake app is
+busy for --busy seconds, then idle. The driver is checked to find every
+process, stop and continue them all, and report the status where it has a
+status query. Measures how long after the app turns idle QuiescenceMonitor
+reports it quiescent, the latency of pause and resume until every process
+has changed state, and pause/resume cycles per second. Linux only.
+Results are written as JSON to FILE, or stdout.
+'''
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2014, Greg Riker <griker@hotmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import argparse, json, os, platform, shutil, signal, subprocess, sys, tempfile, time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import standins
+from startup import summarize
+
+FAKE_SYNC = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_sync.py')
+
+# Seconds to wait for processes to appear or change state
+WAIT = 5.0
+
+
+def process_state(pid):
+    '''
+    Return the state letter of pid from /proc, 'T' when stopped
+    '''
+    with open('/proc/{0}/stat'.format(pid), 'rb') as f:
+        return f.read().rpartition(b')')[2].split()[0].decode('ascii')
+
+
+def wait_for(condition, timeout=WAIT, interval=0.0005):
+    '''
+    Poll condition() until it is true, returning the seconds waited
+    '''
+    started = time.time()
+    while not condition():
+        if time.time() - started > timeout:
+            raise AssertionError("timed out after {0} s".format(timeout))
+        time.sleep(interval)
+    return time.time() - started
+
+
+def start_app(app_dir, children, busy, socket_path=None):
+    '''
+    Start a fake sync app running as app_dir/FakeSync, as a process group
+    '''
+    os.makedirs(app_dir)
+    exe = os.path.join(app_dir, 'FakeSync')
+    real = os.path.realpath(sys.executable)
+    try:
+        os.link(real, exe)
+    except OSError:
+        shutil.copy2(real, exe)
+    args = [exe, FAKE_SYNC, '--dir', app_dir, '--children', str(children),
+            '--script', 'busy:{0},idle'.format(busy)]
+    if socket_path:
+        args += ['--socket', socket_path]
+    return subprocess.Popen(args, preexec_fn=os.setpgrp)
+
+
+def bench_driver(drivers, quiescence, cls, scratch, opts):
+    name = 'Fake' + cls.provider.capitalize()
+    app_dir = os.path.join(scratch, name)
+    socket_path = os.path.join(scratch, name + '.sock')
+    prefs = {'sync_apps': {name: app_dir},
+             'sync_drivers': {name: cls.provider},
+             'command_sockets': {name: socket_path}}
+    from calibre_plugins.syncman.process_index import ProcessIndex
+    driver = drivers.driver_for(name, app_dir, ProcessIndex(), prefs)
+    assert driver.__class__ is cls, driver
+    # Serve a command socket to drivers that query one
+    proc = start_app(app_dir, opts.children, opts.busy,
+                     socket_path if hasattr(driver, 'socket') else None)
+    started = time.time()
+    try:
+        def all_found():
+            driver.process_index.invalidate()
+            return len(driver.pids()) == opts.children + 1
+        wait_for(all_found)
+        pids = driver.pids()
+        result = {'processes': len(pids), 'status': driver.status()}
+
+        # Quiescence: sample until quiet, as the action does
+        monitor = quiescence.QuiescenceMonitor(quiet_window=opts.quiet_window)
+        while True:
+            status = driver.status()
+            reported_busy = [name] if status is not None and not driver.is_idle(status) else []
+            if monitor.sample({name: pids}, reported_busy)['quiescent']:
+                break
+            if time.time() - started > opts.busy + WAIT:
+                raise AssertionError("{0} never quiescent".format(name))
+            time.sleep(0.05)
+        result['quiescent_after_idle_s'] = round(
+            time.time() - started - opts.busy - opts.quiet_window, 3)
+
+        # Pause and resume latency, until every process has changed state
+        pause_calls, paused, resume_calls, resumed = [], [], [], []
+        for _ in range(opts.runs):
+            t = time.time()
+            stopped = driver.pause(pids)['pids']
+            pause_calls.append(time.time() - t)
+            assert sorted(stopped) == sorted(pids), stopped
+            wait_for(lambda: all(process_state(pid) == 'T' for pid in pids))
+            paused.append(time.time() - t)
+
+            t = time.time()
+            driver.resume(pids)
+            resume_calls.append(time.time() - t)
+            wait_for(lambda: not any(process_state(pid) == 'T' for pid in pids))
+            resumed.append(time.time() - t)
+        result.update({'pause_call': summarize(pause_calls), 'paused': summarize(paused),
+                       'resume_call': summarize(resume_calls), 'resumed': summarize(resumed)})
+
+        # Throughput: back to back cycles, without waiting on /proc
+        t = time.time()
+        for _ in range(opts.runs):
+            driver.pause(pids)
+            driver.resume(pids)
+        result['cycles_per_s'] = round(opts.runs / (time.time() - t), 1)
+        return result
+    finally:
+        driver.close()
+        os.killpg(proc.pid, signal.SIGKILL)
+        proc.wait()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=50)
+    parser.add_argument('--children', type=int, default=3,
+                        help='helper processes of each fake app')
+    parser.add_argument('--busy', type=float, default=1.0,
+                        help='seconds each fake app is busy after starting')
+    parser.add_argument('--quiet-window', type=float, default=0.5,
+                        help='seconds an app must stay idle to be quiescent')
+    parser.add_argument('--output', help='write JSON results to this file')
+    opts = parser.parse_args(argv)
+
+    if not os.path.isdir('/proc/self'):
+        print("drivers.py needs /proc", file=sys.stderr)
+        return 1
+
+    config_dir = tempfile.mkdtemp(prefix='syncman_bench_')
+    try:
+        standins.install(config_dir)
+        from calibre_plugins.syncman import drivers, quiescence
+
+        results = {}
+        for cls in [drivers.SyncDriver] + drivers.DRIVERS:
+            results[cls.provider] = bench_driver(drivers, quiescence, cls, config_dir, opts)
+        report = {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'children': opts.children,
+            'checks': 'passed',
+            'results': results,
+            }
+    finally:
+        shutil.rmtree(config_dir, ignore_errors=True)
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if opts.output:
+        with open(opts.output, 'wb') as f:
+            f.write(output.encode('utf-8'))
+    else:
+        print(output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+'''
+A scriptable stand-in for a sync app, run by benchmarks/drivers.py.
+
+    FakeSync fake_sync.py --dir DIR [--children N] [--socket PATH]
+                          [--script busy:2,idle] [--rate BYTES]
+
+Runs as N + 1 processes, like sync apps with helper processes. The script
+is a list of steps, each busy or idle for a number of seconds; the last
+step lasts until the process is killed. While busy every process writes
+--rate bytes per second to a file in DIR, and the status is 'Syncing';
+while idle nothing is written and the status is 'Up to date'. With
+--socket, the status is served over the Dropbox command_socket protocol.
+Start it as a process group leader and kill the group to stop it.
+'''
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2014, Greg Riker <griker@hotmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import argparse, os, sys, time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from sockets import FakeDaemon
+
+# Seconds between writes while busy
+TICK = 0.05
+
+
+def parse_script(script):
+    '''
+    Return [(busy, seconds)] from 'busy:2,idle:1,busy'
+    '''
+    steps = []
+    for step in script.split(','):
+        state, _, seconds = step.partition(':')
+        if state not in ('busy', 'idle'):
+            raise ValueError("unknown step {0!r}".format(step))
+        steps.append((state == 'busy', float(seconds) if seconds else None))
+    return steps
+
+
+def state_at(steps, elapsed):
+    '''
+    Return True if the script is busy elapsed seconds after the start
+    '''
+    for busy, seconds in steps:
+        if seconds is None or elapsed < seconds:
+            return busy
+        elapsed -= seconds
+    return steps[-1][0]
+
+
+def work(steps, path, rate, started, daemon=None):
+    chunk = b'x' * max(1, int(rate * TICK))
+    with open(path, 'ab') as f:
+        while True:
+            busy = state_at(steps, time.time() - started)
+            if daemon is not None:
+                daemon.status = 'Syncing' if busy else 'Up to date'
+            if busy:
+                f.write(chunk)
+                f.flush()
+                if f.tell() > 16 * 1024 * 1024:
+                    f.seek(0)
+                    f.truncate()
+            time.sleep(TICK)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--dir', required=True)
+    parser.add_argument('--children', type=int, default=0)
+    parser.add_argument('--socket')
+    parser.add_argument('--script', default='idle')
+    parser.add_argument('--rate', type=int, default=1024 * 1024)
+    opts = parser.parse_args(argv)
+
+    steps = parse_script(opts.script)
+    started = time.time()
+    for n in range(opts.children):
+        if os.fork() == 0:
+            work(steps, os.path.join(opts.dir, 'child_{0}'.format(n)), opts.rate, started)
+            os._exit(0)
+
+    daemon = None
+    if opts.socket:
+        daemon = FakeDaemon(opts.socket)
+        daemon.start()
+    work(steps, os.path.join(opts.dir, 'main'), opts.rate, started, daemon)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
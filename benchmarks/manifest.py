@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+'''
+Check and time the library checksum manifest against a synthetic library.
+
+    python2 benchmarks/manifest.py [--books N] [--book-kb KB] [--workers N]
+                                   [--runs N] [--output FILE]
+
+Writes a library of --books books, each an epub of about --book-kb KB, an
+opf and a cover, in a scratch directory. Times building the manifest from
+scratch with one worker, and with thread and process pools of --workers, an
+update with nothing changed, and an update after 1% of the books changed. A
+replica is copied from the library, then damaged: a file deleted, one
+truncated, one rewritten at the same size and one added. The comparison is
+checked to report exactly those, and timed. Results are written as JSON to
+FILE, or stdout.
+'''
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2014, Greg Riker <griker@hotmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import argparse, json, os, platform, shutil, sys, tempfile, time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import standins
+from startup import timed
+
+
+def write_file(path, size):
+    with open(path, 'wb') as f:
+        f.write(os.urandom(size))
+
+
+def make_library(root, books, book_kb):
+    '''
+    Write a calibre-like library of books at root, dated well in the past
+    so no file is too recent to be trusted by its mtime
+    '''
+    for n in range(books):
+        book_dir = os.path.join(root, 'Author {0}'.format(n % 97),
+                                'Book {0} ({0})'.format(n))
+        os.makedirs(book_dir)
+        write_file(os.path.join(book_dir, 'Book {0}.epub'.format(n)), book_kb * 1024 + n)
+        write_file(os.path.join(book_dir, 'metadata.opf'), 2048)
+        write_file(os.path.join(book_dir, 'cover.jpg'), 32 * 1024)
+    write_file(os.path.join(root, 'metadata.db'), 256 * 1024)
+    age(root)
+
+
+def age(root, seconds=3600):
+    then = time.time() - seconds
+    for dpath, dnames, fnames in os.walk(root):
+        for name in fnames:
+            os.utime(os.path.join(dpath, name), (then, then))
+
+
+def check(manifest, replica):
+    '''
+    Damage replica and check compare() reports each problem, raising
+    AssertionError otherwise
+    '''
+    os.remove(os.path.join(replica, 'Author 1', 'Book 1 (1)', 'cover.jpg'))
+    with open(os.path.join(replica, 'Author 2', 'Book 2 (2)', 'Book 2.epub'), 'r+b') as f:
+        f.truncate(1024)
+    write_file(os.path.join(replica, 'Author 3', 'Book 3 (3)', 'metadata.opf'), 2048)
+    write_file(os.path.join(replica, 'Author 4', 'Book 4 (4)', 'stray.tmp'), 10)
+    problems = [(path, problem) for path, problem, detail in manifest.compare(replica)['problems']]
+    expected = [('Author 1/Book 1 (1)/cover.jpg', 'missing'),
+                ('Author 2/Book 2 (2)/Book 2.epub', 'size'),
+                ('Author 3/Book 3 (3)/metadata.opf', 'checksum'),
+                ('Author 4/Book 4 (4)/stray.tmp', 'extra')]
+    assert problems == expected, problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--books', type=int, default=1000)
+    parser.add_argument('--book-kb', type=int, default=512)
+    parser.add_argument('--workers', type=int,
+                        help='hashing workers, by default one per CPU')
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--output', help='write JSON results to this file')
+    opts = parser.parse_args(argv)
+
+    config_dir = tempfile.mkdtemp(prefix='syncman_bench_')
+    try:
+        standins.install(config_dir)
+        from calibre_plugins.syncman.manifest import HASH_WORKERS, ChecksumManifest
+        workers = opts.workers or HASH_WORKERS
+
+        library = os.path.join(config_dir, 'library')
+        make_library(library, opts.books, opts.book_kb)
+        manifest_dir = os.path.join(config_dir, 'manifests')
+
+        def wipe_manifest():
+            shutil.rmtree(manifest_dir, ignore_errors=True)
+
+        def build(**kw):
+            return lambda: ChecksumManifest(library, manifest_dir, **kw).update()
+
+        results = {
+            'build_serial': timed(build(workers=1), opts.runs, setup=wipe_manifest),
+            'build_threads': timed(build(workers=workers), opts.runs, setup=wipe_manifest),
+            'build_processes': timed(build(workers=workers, processes=True), opts.runs,
+                                     setup=wipe_manifest),
+            }
+        manifest = ChecksumManifest(library, manifest_dir, workers)
+        manifest.update()
+        results['update_unchanged'] = timed(manifest.update, opts.runs)
+
+        changed = max(1, opts.books // 100)
+
+        def touch_books():
+            then = time.time() - 60
+            for n in range(changed):
+                path = os.path.join(library, 'Author {0}'.format(n % 97),
+                                    'Book {0} ({0})'.format(n), 'metadata.opf')
+                write_file(path, 2048)
+                os.utime(path, (then, then))
+        results['update_changed'] = timed(manifest.update, opts.runs, setup=touch_books)
+        stats = manifest.update()
+        assert stats['hashed'] == 0, stats
+
+        replica = os.path.join(config_dir, 'replica')
+        shutil.copytree(library, replica)
+        assert not manifest.compare(replica)['problems']
+        check(manifest, replica)
+        results['compare'] = timed(lambda: manifest.compare(replica), opts.runs)
+
+        report = {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'books': opts.books,
+            'files': manifest.files(),
+            'library_mb': round(sum(entry[0] for files in manifest.dirs.values()
+                                    for entry in files.values()) / (1024 * 1024), 1),
+            'workers': workers,
+            'changed_per_update': changed,
+            'manifest_bytes': os.path.getsize(manifest.manifest_path),
+            'checks': 'passed',
+            'results': results,
+            }
+    finally:
+        shutil.rmtree(config_dir, ignore_errors=True)
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if opts.output:
+        with open(opts.output, 'wb') as f:
+            f.write(output.encode('utf-8'))
+    else:
+        print(output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
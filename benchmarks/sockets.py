@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+'''
+Check and time the sync app control socket client against a fake daemon.
+
+    python2 benchmarks/sockets.py [--runs N] [--output FILE]
+
+FakeDaemon serves the Dropbox command_socket protocol on a unix socket in a
+scratch directory. The client is checked for single and pipelined requests,
+refused requests, reconnecting after the daemon drops the connection or
+restarts, and backing off from a socket nobody listens on. Then a status
+query is timed on a new connection each time, on the pooled connection, and
+pipelined. Results are written as JSON to FILE, or stdout.
+'''
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2014, Greg Riker <griker@hotmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import argparse, json, os, platform, shutil, socket, sys, tempfile, threading
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import standins
+from startup import timed
+
+
+class FakeDaemon(object):
+    '''
+    Answer get_dropbox_status with status, and echo any other request's
+    arguments. Requests named 'fail' are refused. After drop_after
+    requests on a connection, the connection is closed without a reply.
+    '''
+    def __init__(self, path, status='Up to date'):
+        self.path = path
+        self.status = status
+        self.drop_after = None
+        self.connections = 0
+        self.requests = 0
+        self.server = None
+        self.open_connections = set()
+
+    def handle(self, conn):
+        reader = conn.makefile('rb')
+        served = 0
+        try:
+            while True:
+                command = reader.readline()
+                if not command:
+                    return
+                args = []
+                while True:
+                    line = reader.readline()
+                    if not line or line == b'done\n':
+                        break
+                    args.append(line)
+                if self.drop_after is not None and served >= self.drop_after:
+                    return
+                served += 1
+                self.requests += 1
+                command = command.strip()
+                if command == b'fail':
+                    reply = [b'notok\n']
+                elif command == b'get_dropbox_status':
+                    reply = [b'ok\n', b'status\t' + self.status.encode('utf-8') + b'\n']
+                else:
+                    reply = [b'ok\n'] + args
+                conn.sendall(b''.join(reply) + b'done\n')
+        except socket.error:
+            pass
+        finally:
+            reader.close()
+            conn.close()
+            self.open_connections.discard(conn)
+
+    def serve(self):
+        while True:
+            try:
+                conn, _ = self.server.accept()
+            except socket.error:
+                return
+            self.connections += 1
+            self.open_connections.add(conn)
+            t = threading.Thread(target=self.handle, args=(conn,))
+            t.daemon = True
+            t.start()
+
+    def start(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(self.path)
+        self.server.listen(8)
+        t = threading.Thread(target=self.serve)
+        t.daemon = True
+        t.start()
+
+    def stop(self):
+        for conn in [self.server] + list(self.open_connections):
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        self.server.close()
+        os.remove(self.path)
+
+
+def check(module, daemon):
+    '''
+    Exercise the client against daemon, raising AssertionError on failure
+    '''
+    client = module.CommandSocket(daemon.path)
+    assert client.request('get_dropbox_status') == {'status': ['Up to date']}
+    replies = client.pipeline([('echo', {'path': '/a'}), ('get_dropbox_status', {}),
+                               ('echo', {'path': ['/b', '/c']})])
+    assert replies == [{'path': ['/a']}, {'status': ['Up to date']},
+                       {'path': ['/b', '/c']}], replies
+    assert client.connects == 1
+
+    # Refused requests raise, the connection stays usable
+    try:
+        client.request('fail')
+    except module.CommandSocketError:
+        pass
+    else:
+        raise AssertionError("refused request returned")
+    assert client.request('echo', {'k': 'v'}) == {'k': ['v']}
+    assert client.connects == 1
+
+    # A dropped connection is reopened and the unanswered requests resent
+    daemon.drop_after = 1
+    client.close()
+    replies = client.pipeline([('echo', {'n': '1'}), ('echo', {'n': '2'})])
+    assert replies == [{'n': ['1']}, {'n': ['2']}], replies
+    assert client.connects == 3, client.connects
+    daemon.drop_after = None
+
+    # A restarted daemon is reached on the next request
+    daemon.stop()
+    daemon.start()
+    assert client.request('get_dropbox_status') == {'status': ['Up to date']}
+    assert client.connects == 4, client.connects
+
+    # Nobody listening: fail once, then back off without connecting
+    missing = module.CommandSocket(daemon.path + '.missing')
+    for _ in range(2):
+        try:
+            missing.request('get_dropbox_status')
+        except module.CommandSocketError:
+            pass
+        else:
+            raise AssertionError("request to a missing socket returned")
+    assert missing.failed_at is not None and missing.connects == 0
+
+    client.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=200)
+    parser.add_argument('--output', help='write JSON results to this file')
+    opts = parser.parse_args(argv)
+
+    config_dir = tempfile.mkdtemp(prefix='syncman_bench_')
+    try:
+        standins.install(config_dir)
+        from calibre_plugins.syncman import command_socket
+
+        daemon = FakeDaemon(os.path.join(config_dir, 'command_socket'))
+        daemon.start()
+        check(command_socket, daemon)
+
+        pooled = command_socket.CommandSocket(daemon.path)
+
+        def fresh_connection():
+            client = command_socket.CommandSocket(daemon.path)
+            client.request('get_dropbox_status')
+            client.close()
+
+        def pooled_connection():
+            pooled.request('get_dropbox_status')
+
+        def pipelined():
+            pooled.pipeline([('get_dropbox_status', {})] * 10)
+
+        results = {
+            'fresh_connection': timed(fresh_connection, opts.runs),
+            'pooled_connection': timed(pooled_connection, opts.runs),
+            'pipelined_x10': timed(pipelined, opts.runs),
+            }
+        pooled.close()
+        daemon.stop()
+        report = {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'checks': 'passed',
+            'results': results,
+            }
+    finally:
+        shutil.rmtree(config_dir, ignore_errors=True)
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if opts.output:
+        with open(opts.output, 'wb') as f:
+            f.write(output.encode('utf-8'))
+    else:
+        print(output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+'''
+Local stand-ins for the parts of calibre and PyQt4 the plugin imports, so its
+startup and resource handling can be exercised without a calibre GUI.
+
+install(config_dir) must be called before any calibre_plugins.syncman module
+is imported. The stand-ins only model what the plugin uses: JSONConfig, the
+plugin archive (ZipFile, load_resources), InterfaceAction and a few Qt
+classes whose methods do nothing.
+'''
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2014, Greg Riker <griker@hotmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import __builtin__, imp, json, os, sys, types, zipfile
+
+PLUGIN_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _module(name, **attrs):
+    module = types.ModuleType(str(name))
+    module.__dict__.update(attrs)
+    sys.modules[str(name)] = module
+    if '.' in name:
+        parent, _, child = name.rpartition('.')
+        setattr(sys.modules[str(parent)], str(child), module)
+    return module
+
+
+class JSONConfig(dict):
+    '''
+    calibre.utils.config.JSONConfig: a dict persisted as JSON
+    '''
+    def __init__(self, rel_path_to_cf_file):
+        dict.__init__(self)
+        self.defaults = {}
+        self.file_path = os.path.join(
+            sys.modules[str('calibre.utils.config')].config_dir,
+            rel_path_to_cf_file + '.json')
+        self.refresh()
+
+    def commit(self):
+        dpath = os.path.dirname(self.file_path)
+        if not os.path.exists(dpath):
+            os.makedirs(dpath)
+        with open(self.file_path, 'wb') as f:
+            f.write(self.to_raw())
+
+    def get(self, key, default=None):
+        return dict.get(self, key, self.defaults.get(key, default))
+
+    def refresh(self, clear_current=True):
+        d = {}
+        if os.path.exists(self.file_path):
+            with open(self.file_path, 'rb') as f:
+                d = json.loads(f.read())
+        if clear_current:
+            self.clear()
+        self.update(d)
+
+    def set(self, key, val):
+        self.__setitem__(key, val)
+
+    def to_raw(self):
+        return json.dumps(self, indent=2)
+
+    def __setitem__(self, key, val):
+        dict.__setitem__(self, key, val)
+        self.commit()
+
+
+class Signal(object):
+    '''
+    Qt signal: connect() and emit() call the slots synchronously
+    '''
+    def __init__(self, *types):
+        self.slots = []
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        bound = obj.__dict__.get(id(self))
+        if bound is None:
+            bound = obj.__dict__[id(self)] = Signal()
+        return bound
+
+    def connect(self, slot):
+        self.slots.append(slot)
+
+    def disconnect(self, slot=None):
+        self.slots = [] if slot is None else [s for s in self.slots if s != slot]
+
+    def emit(self, *args):
+        for slot in list(self.slots):
+            slot(*args)
+
+
+class QObject(object):
+    def __init__(self, *args, **kwargs):
+        pass
+
+
+class QTimer(QObject):
+    timeout = Signal()
+
+    def isActive(self):
+        return False
+
+    def setInterval(self, ms):
+        pass
+
+    def setSingleShot(self, single_shot):
+        pass
+
+    def start(self, ms=None):
+        pass
+
+    def stop(self):
+        pass
+
+    @staticmethod
+    def singleShot(ms, slot):
+        slot()
+
+
+class QIcon(object):
+    def __init__(self, *args):
+        pass
+
+
+class QAction(object):
+    triggered = Signal()
+
+    def setIcon(self, icon):
+        pass
+
+    def setToolTip(self, tip):
+        pass
+
+
+class InterfaceAction(QObject):
+    '''
+    calibre.gui2.actions.InterfaceAction, with load_resources() reading the
+    plugin archive as calibre does
+    '''
+    def __init__(self, plugin_path, gui=None):
+        self.plugin_path = plugin_path
+        self.gui = gui
+        self.qaction = QAction()
+
+    def load_resources(self, names):
+        ans = {}
+        with zipfile.ZipFile(self.plugin_path, 'r') as zf:
+            for candidate in zf.namelist():
+                if candidate in names:
+                    ans[candidate] = zf.read(candidate)
+        return ans
+
+
+class InterfaceActionBase(object):
+    actual_plugin_ = None
+
+    def do_user_config(self, parent=None):
+        pass
+
+
+def compileUi(form, buf):
+    '''
+    PyQt4.uic.compileUi: emit a trivial form class
+    '''
+    buf.write(b"class Ui_Dialog(object):\n"
+              b"    def setupUi(self, Dialog):\n"
+              b"        pass\n")
+
+
+def debug_print(*args):
+    pass
+
+
+def install(config_dir):
+    '''
+    Register the stand-ins and map calibre_plugins.syncman to this checkout
+    '''
+    _module('calibre', __version__='1.48.0')
+    _module('calibre.constants', DEBUG=False, iswindows=False, isosx=False,
+            islinux=sys.platform.startswith('linux'))
+    _module('calibre.customize', InterfaceActionBase=InterfaceActionBase)
+    _module('calibre.devices')
+    _module('calibre.devices.usbms')
+    _module('calibre.devices.usbms.driver', debug_print=debug_print)
+    _module('calibre.gui2')
+    _module('calibre.gui2.actions', InterfaceAction=InterfaceAction)
+    _module('calibre.utils')
+    _module('calibre.utils.config', JSONConfig=JSONConfig, config_dir=config_dir)
+    _module('calibre.utils.filenames', atomic_rename=os.rename)
+    _module('calibre.utils.zipfile', ZipFile=zipfile.ZipFile)
+
+    qt = dict(QAction=QAction, QIcon=QIcon, QObject=QObject, QTimer=QTimer,
+              pyqtSignal=Signal, PYQT_VERSION_STR='4.10.4',
+              QT_VERSION_STR='4.8.6')
+    _module('PyQt4')
+    _module('PyQt4.Qt', **qt)
+    _module('PyQt4.QtCore', **qt)
+    _module('PyQt4.uic', compileUi=compileUi)
+
+    __builtin__.I = lambda name: name
+    __builtin__.get_icons = lambda name: QIcon()
+
+    _module('calibre_plugins', __path__=[])
+    package = imp.load_module(str('calibre_plugins.syncman'), None, PLUGIN_ROOT,
+                              ('', '', imp.PKG_DIRECTORY))
+    sys.modules[str('calibre_plugins')].syncman = package
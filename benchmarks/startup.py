@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+'''
+Benchmark SyncMan startup and resource handling without a calibre GUI.
+
+    python2 benchmarks/startup.py [--runs N] [--members N] [--output FILE]
+
+Builds a plugin archive from this checkout, padded with --members help pages
+and icons, in a scratch calibre config directory. Times cold and warm
+SyncManAction.genesis(), inflate_resources(), compile_widgets() with and
+without a form cache, and loading the dialog forms as the first open of each
+dialog in a session does: the compiled form modules are forgotten before
+each run, so they are checked and imported again. Results are written as
+JSON to FILE, or stdout.
+'''
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2014, Greg Riker <griker@hotmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import argparse, json, os, platform, random, shutil, sys, tempfile, time, zipfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import standins
+
+
+def build_plugin(plugin_path, members):
+    '''
+    Zip the plugin sources with members help pages and members icons
+    '''
+    rng = random.Random(members)
+    with zipfile.ZipFile(plugin_path, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for root, dirs, files in os.walk(standins.PLUGIN_ROOT):
+            dirs[:] = [d for d in dirs if not d.startswith('.') and d != 'benchmarks']
+            for name in files:
+                if name.endswith(('.py', '.ui', '.png', '.txt')):
+                    fs = os.path.join(root, name)
+                    zf.write(fs, os.path.relpath(fs, standins.PLUGIN_ROOT).replace(os.sep, '/'))
+        for i in range(members):
+            zf.writestr('help/page_{0:04d}.html'.format(i),
+                        '<html><body>{0}</body></html>'.format('help text ' * 400))
+            zf.writestr('icons/icon_{0:04d}.png'.format(i),
+                        bytes(bytearray(rng.getrandbits(8) for _ in range(2048))))
+
+
+def snapshot(path):
+    '''
+    Return {file: mtime} below path
+    '''
+    ans = {}
+    for root, _, files in os.walk(path):
+        for name in files:
+            fs = os.path.join(root, name)
+            ans[fs] = os.stat(fs).st_mtime
+    return ans
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    n = len(samples)
+    median = samples[n // 2] if n % 2 else (samples[n // 2 - 1] + samples[n // 2]) / 2
+    return {
+        'runs': n,
+        'min_ms': round(samples[0] * 1000, 3),
+        'median_ms': round(median * 1000, 3),
+        'max_ms': round(samples[-1] * 1000, 3),
+        'mean_ms': round(sum(samples) / n * 1000, 3),
+        }
+
+
+def timed(func, runs, setup=None):
+    samples = []
+    for _ in range(runs):
+        if setup is not None:
+            setup()
+        started = time.time()
+        func()
+        samples.append(time.time() - started)
+    return summarize(samples)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--members', type=int, default=500,
+                        help='help pages and icons added to the plugin archive')
+    parser.add_argument('--output', help='write JSON results to this file')
+    opts = parser.parse_args(argv)
+
+    config_dir = tempfile.mkdtemp(prefix='syncman_bench_')
+    try:
+        standins.install(config_dir)
+        from calibre_plugins.syncman.action import SyncManAction, is_plugin_resource
+        from calibre_plugins.syncman.common_utils import (
+            FORM_CACHE, compile_widgets, inflate_resources, load_form)
+
+        plugins_dir = os.path.join(config_dir, 'plugins')
+        os.makedirs(plugins_dir)
+        plugin_path = os.path.join(plugins_dir, 'SyncMan.zip')
+        resources_path = os.path.join(plugins_dir, 'SyncMan_resources')
+        build_plugin(plugin_path, opts.members)
+
+        def wipe_resources():
+            shutil.rmtree(resources_path, ignore_errors=True)
+
+        def wipe_form_cache():
+            for name in os.listdir(resources_path):
+                if name == FORM_CACHE or name.endswith('_ui.py'):
+                    os.remove(os.path.join(resources_path, name))
+
+        def genesis():
+            SyncManAction(plugin_path).genesis()
+
+        def inflate():
+            if not os.path.exists(resources_path):
+                os.makedirs(resources_path)
+            inflate_resources(plugin_path, resources_path, is_plugin_resource)
+
+        dialogs = ('syncman', 'sync_app_wizard', 'conflicts_report', 'replica_report')
+
+        def forget_forms():
+            for widget in dialogs:
+                sys.modules.pop(str(widget + '_ui'), None)
+
+        def open_dialogs():
+            for widget in dialogs:
+                load_form(widget)
+
+        results = {}
+        results['genesis_cold'] = timed(genesis, opts.runs, setup=wipe_resources)
+        results['genesis_warm'] = timed(genesis, opts.runs)
+        before = snapshot(resources_path)
+        genesis()
+        results['genesis_warm']['writes'] = sum(
+            1 for fs, mtime in snapshot(resources_path).items() if before.get(fs) != mtime)
+
+        results['inflate_cold'] = timed(inflate, opts.runs, setup=wipe_resources)
+        results['inflate_warm'] = timed(inflate, opts.runs)
+        results['compile_widgets_cold'] = timed(compile_widgets, opts.runs, setup=wipe_form_cache)
+        results['compile_widgets_warm'] = timed(compile_widgets, opts.runs)
+        results['dialog_open'] = timed(open_dialogs, opts.runs, setup=forget_forms)
+
+        report = {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'members': opts.members,
+            'plugin_bytes': os.path.getsize(plugin_path),
+            'results': results,
+            }
+    finally:
+        shutil.rmtree(config_dir, ignore_errors=True)
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if opts.output:
+        with open(opts.output, 'wb') as f:
+            f.write(output.encode('utf-8'))
+    else:
+        print(output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2014, Greg Riker <griker@hotmail.com>'
+__docformat__ = 'restructuredtext en'
+
+# Command line control of the sync apps, run by SyncManPlugin.cli_main().
+# Kept free of GUI imports, and never reads the plugin zip, so it starts
+# quickly enough to wrap scripted jobs:
+#
+#   calibre-debug -r SyncMan -- pause
+#   calibre-debug -r SyncMan -- run calibredb add -r /nightly/books
+#   calibre-debug -r SyncMan -- resume
+#   calibre-debug -r SyncMan -- verify /mnt/backup/Calibre\ Library
+import argparse, json, os, signal, subprocess, sys, time
+
+from calibre.constants import iswindows
+from calibre.utils.config import config_dir
+from calibre.utils.filenames import atomic_rename
+
+from calibre_plugins.syncman.common_utils import Logger
+from calibre_plugins.syncman.drivers import SyncDriver
+from calibre_plugins.syncman.manifest import ChecksumManifest
+from calibre_plugins.syncman.sync_control import SuspensionEngine
+
+CLI_STATE = os.path.join(config_dir, 'plugins', 'SyncMan_resources', 'cli_state.json')
+
+# Holder recorded by the pause command. run records its own pid and start time.
+PAUSE_HOLDER = 'pause'
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class CommandLineControl(Logger):
+    '''
+    Pause and resume the active sync apps from separate processes.
+    The stopped processes are recorded in CLI_STATE with their start times,
+    so resume continues exactly what pause stopped, even from another
+    process, and never signals a recycled pid. Each pause is held by a
+    holder: the pause command, or the [pid, start time] of a run command.
+    The apps are only continued once no live holder remains, so overlapping
+    jobs do not resume each other's pause window. The state file is locked
+    while it is read and rewritten. calibre's SuspensionEngine leaves the
+    processes held here alone, see held().
+    '''
+    def __init__(self, prefs, state_path=CLI_STATE, engine=None):
+        self.prefs = prefs
+        self.state_path = state_path
+        self.engine = engine or SuspensionEngine(prefs)
+        self.lock_file = None
+
+    def continue_processes(self, app_name, processes):
+        '''
+        Resume [(pid, start_time)] of app_name, skipping processes that have
+        exited. Returns the pids continued.
+        '''
+        driver = self.engine.drivers().get(app_name)
+        if driver is None:
+            # No longer configured, signal whatever stopped it
+            driver = SyncDriver(app_name, None, self.engine.process_index)
+        pids = [pid for pid, start_time in processes
+                if self.engine.process_index.is_alive(pid, start_time)]
+        return driver.resume(pids)['pids']
+
+    def held(self):
+        '''
+        Return the pids held stopped by live holders. Call with the state
+        locked.
+        '''
+        state = self.load()
+        if not self.live_holders(state['holders']):
+            return set()
+        return set(pid for processes in state['apps'].values()
+                   for pid, start_time in processes
+                   if self.engine.process_index.is_alive(pid, start_time))
+
+    def live_holders(self, holders):
+        '''
+        Return the holders still holding a pause: PAUSE_HOLDER, and the run
+        commands that are still running
+        '''
+        ans = []
+        for holder in holders:
+            if holder != PAUSE_HOLDER:
+                # [pid, start time], or a pid recorded by an older version
+                pid, start_time = holder if isinstance(holder, list) else (holder, None)
+                if not self.engine.process_index.is_alive(pid, start_time):
+                    continue
+            ans.append(holder)
+        return ans
+
+    def load(self):
+        '''
+        Return {'apps': {app_name: [[pid, start_time], ...]}, 'holders': [...],
+        'paused_at': time or None}
+        '''
+        state = {'apps': {}, 'holders': [], 'paused_at': None}
+        if os.path.exists(self.state_path):
+            try:
+                with open(self.state_path, 'rb') as f:
+                    state.update(json.loads(f.read()))
+            except Exception as e:
+                self._log("unreadable command line state {0}: {1}", self.state_path, e)
+        return state
+
+    def lock(self):
+        dpath = os.path.dirname(self.state_path)
+        if not os.path.exists(dpath):
+            os.makedirs(dpath)
+        self.lock_file = open(self.state_path + '.lock', 'ab')
+        if fcntl is not None:
+            fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_EX)
+
+    def pause(self, holder=PAUSE_HOLDER):
+        '''
+        Stop the active sync apps on behalf of holder. Returns
+        {app_name: [pid, ...]} of the processes held stopped.
+        '''
+        self.lock()
+        try:
+            state = self.load()
+            drivers = self.engine.drivers()
+            self.engine.process_index.register(d.app_path for d in drivers.values())
+            for name, driver in drivers.items():
+                stopped = [list(p) for p in state['apps'].get(name, [])
+                           if self.engine.process_index.is_alive(*p)]
+                start_times = dict(
+                    (pid, start_time) for pid, start_time in
+                    self.engine.process_index.processes(driver.app_path)
+                    if [pid, start_time] not in stopped)
+                paused = driver.pause(list(start_times))['pids']
+                stopped += [[pid, start_times[pid]] for pid in paused]
+                state['apps'][name] = stopped
+            if holder not in state['holders']:
+                state['holders'].append(holder)
+            if state['paused_at'] is None:
+                state['paused_at'] = time.time()
+            self.save(state)
+        finally:
+            self.unlock()
+        self._log_location(holder, state['apps'])
+        return dict((name, [pid for pid, _ in processes])
+                    for name, processes in state['apps'].items())
+
+    def resume(self, holder=PAUSE_HOLDER, force=False):
+        '''
+        Release holder's pause. Returns {app_name: [pid, ...]} of the
+        processes continued, empty while other holders remain, unless force.
+        '''
+        self.lock()
+        try:
+            state = self.load()
+            holders = self.live_holders(h for h in state['holders'] if h != holder)
+            if holders and not force:
+                state['holders'] = holders
+                self.save(state)
+                continued = {}
+            else:
+                continued = dict((name, self.continue_processes(name, processes))
+                                 for name, processes in state['apps'].items())
+                state = {'apps': {}, 'holders': [], 'paused_at': None}
+                self.save(state)
+        finally:
+            self.unlock()
+        self._log_location(holder, continued)
+        return continued
+
+    def run(self, command):
+        '''
+        Run command with the sync apps paused, returning its exit status
+        '''
+        pid = os.getpid()
+        # With the start time, a recycled pid is not taken for this command
+        holder = [pid, self.engine.process_index.start_time(pid)]
+        self.pause(holder)
+        try:
+            return subprocess.call(command)
+        finally:
+            self.resume(holder)
+
+    def save(self, state):
+        temp_path = self.state_path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(json.dumps(state, separators=(',', ':')).encode('utf-8'))
+        atomic_rename(temp_path, self.state_path)
+
+    def status(self):
+        '''
+        Return [(app_name, active, [pid, ...], [held pid, ...])] for the
+        configured sync apps, and the state
+        '''
+        state = self.load()
+        active = self.engine.active_apps()
+        apps = self.prefs.get('sync_apps', {})
+        self.engine.process_index.register(apps.values())
+        ans = []
+        for name in sorted(apps):
+            held = [pid for pid, start_time in state['apps'].get(name, [])
+                    if self.engine.process_index.is_alive(pid, start_time)]
+            ans.append((name, name in active, self.engine.find_pids(apps[name]), held))
+        return ans, state
+
+    def unlock(self):
+        if self.lock_file is not None:
+            self.lock_file.close()
+            self.lock_file = None
+
+
+def holder_name(holder):
+    '''
+    Return PAUSE_HOLDER, or the pid of a run command holder
+    '''
+    return unicode(holder[0] if isinstance(holder, list) else holder)
+
+
+def option_parser():
+    parser = argparse.ArgumentParser(prog='calibre-debug -r SyncMan --',
+        description="Control the sync apps managed by SyncMan without the calibre GUI")
+    parser.add_argument('--library', metavar='PATH',
+                        help="manage the sync apps of this library's profile, or "
+                        "verify this library rather than calibre's current one")
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+    commands.add_parser('pause', help="stop the active sync apps until resume")
+    resume = commands.add_parser('resume', help="continue the sync apps stopped by pause")
+    resume.add_argument('--force', action='store_true',
+                        help="continue the apps even while run commands hold them")
+    commands.add_parser('status', help="show the sync apps and their processes")
+    run = commands.add_parser('run', help="run a command with the sync apps paused")
+    run.add_argument('args', nargs=argparse.REMAINDER, help="command and its arguments")
+    verify = commands.add_parser('verify', help="compare a replica of the library with "
+                                 "its checksum manifest, updating the manifest first")
+    verify.add_argument('replica', help="folder holding the replica")
+    return parser
+
+
+def main(args, prefs=None):
+    '''
+    Run the command line args, returning the exit status
+    '''
+    opts = option_parser().parse_args(args)
+    if opts.command == 'verify':
+        return verify(opts.library, opts.replica)
+    if prefs is None:
+        from calibre_plugins.syncman.prefs import prefs
+    if not hasattr(signal, 'SIGSTOP'):
+        print("Suspending processes is not supported on this platform", file=sys.stderr)
+        return 1
+    control = CommandLineControl(prefs)
+    if opts.library:
+        control.engine.set_library(os.path.abspath(opts.library))
+
+    if opts.command == 'pause':
+        for name, pids in sorted(control.pause().items()):
+            print("{0}: paused {1}".format(name, ' '.join(map(str, pids)) or "no processes"))
+    elif opts.command == 'resume':
+        continued = control.resume(force=opts.force)
+        if not continued:
+            holders = control.load()['holders']
+            print("Still paused by {0}".format(' '.join(map(holder_name, holders)))
+                  if holders else "Not paused")
+        for name, pids in sorted(continued.items()):
+            print("{0}: resumed {1}".format(name, ' '.join(map(str, pids)) or "no processes"))
+    elif opts.command == 'status':
+        apps, state = control.status()
+        if not apps:
+            print("No sync apps configured")
+        for name, active, pids, held in apps:
+            print("{0}{1}: {2}{3}".format(
+                name, '' if active else " (inactive)",
+                "pids " + ' '.join(map(str, pids)) if pids else "not running",
+                ", {0} paused".format(len(held)) if held else ''))
+        if state['paused_at'] is not None:
+            print("Paused for {0:.0f} s by {1}".format(
+                time.time() - state['paused_at'], ' '.join(map(holder_name, state['holders']))))
+    elif opts.command == 'run':
+        command = opts.args[1:] if opts.args[:1] == ['--'] else opts.args
+        if not command:
+            print("run needs a command", file=sys.stderr)
+            return 2
+        return control.run(command)
+    return 0
+
+
+def verify(library_path, replica_path):
+    '''
+    Print the differences between replica_path and the library, returning 1
+    if there are any. Hashing uses a process pool, except on Windows where
+    workers are spawned without the plugin's imports.
+    '''
+    if library_path is None:
+        from calibre.utils.config import prefs as calibre_prefs
+        library_path = calibre_prefs['library_path']
+    if not os.path.isdir(replica_path):
+        print("No folder {0}".format(replica_path), file=sys.stderr)
+        return 2
+    manifest = ChecksumManifest(os.path.abspath(library_path), processes=not iswindows)
+    stats = manifest.update()
+    print("{0}: {1} files, {2} hashed ({3:.1f} MB) in {4:.2f} s".format(
+        library_path, stats['files'], stats['hashed'], stats['bytes'] / (1024 * 1024),
+        stats['elapsed']))
+    for error in stats['errors']:
+        print("Unreadable: {0}".format(error), file=sys.stderr)
+    result = manifest.compare(os.path.abspath(replica_path))
+    for path, problem, detail in result['problems']:
+        print("{0}: {1}{2}".format(problem, path, " (" + detail + ")" if detail else ''))
+    print("{0}: {1} files hashed ({2:.1f} MB) in {3:.2f} s, {4} problems".format(
+        replica_path, result['checked'], result['bytes'] / (1024 * 1024), result['elapsed'],
+        len(result['problems'])))
+    return 1 if result['problems'] else 0
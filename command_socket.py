@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2014, Greg Riker <griker@hotmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import socket, threading, time
+
+from calibre_plugins.syncman.common_utils import Logger
+
+# Seconds a request may take before the connection is dropped
+DEFAULT_TIMEOUT = 2.0
+
+# Seconds before connecting again to a socket that refused us, so polling
+# an app that is not running costs nothing
+RETRY_INTERVAL = 30
+
+
+class CommandSocketError(Exception):
+    pass
+
+
+class CommandSocket(Logger):
+    '''
+    Long-lived connection to a sync app's control socket, speaking the
+    Dropbox command_socket protocol. A request is the command name, a
+    line per argument of tab separated key and values, and 'done'. The
+    reply is 'ok' or 'notok', lines of the same form, and 'done'.
+    pipeline() writes several requests before reading any reply. A
+    connection that fails is closed and opened again once, and the
+    requests not yet answered are sent again: every request we make is a
+    query, so repeating one is harmless.
+    '''
+    def __init__(self, path, timeout=DEFAULT_TIMEOUT, clock=time.time):
+        self.path = path
+        self.timeout = timeout
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.sock = None
+        self.reader = None
+        # When connecting last failed, or None
+        self.failed_at = None
+
+        # Counters
+        self.connects = 0
+        self.requests = 0
+
+    def close(self):
+        with self.lock:
+            self._close()
+
+    def pipeline(self, requests):
+        '''
+        Send [(command, {key: value or [values]})], returning
+        [{key: [values]}] in the same order. Raises CommandSocketError if
+        the app cannot be reached, or rejects a request.
+        '''
+        with self.lock:
+            replies = []
+            for attempt in (1, 2):
+                try:
+                    self._connect()
+                except CommandSocketError as e:
+                    raise CommandSocketError("{0}: {1}".format(self.path, e))
+                try:
+                    pending = requests[len(replies):]
+                    self.sock.sendall(b''.join(self._encode(c, a) for c, a in pending))
+                    for _ in pending:
+                        replies.append(self._read_reply())
+                    break
+                except (socket.error, CommandSocketError) as e:
+                    # The stream is out of step, start again on a new connection
+                    self._close()
+                    if attempt == 2:
+                        raise CommandSocketError("{0}: {1}".format(self.path, e))
+                    self._log("{0}: {1}, reconnecting", self.path, e)
+        self.requests += len(requests)
+        for reply in replies:
+            if reply is None:
+                raise CommandSocketError("{0}: request refused".format(self.path))
+        return replies
+
+    def request(self, command, args=None):
+        return self.pipeline([(command, args or {})])[0]
+
+    # Helpers
+    def _close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+            self.sock = self.reader = None
+
+    def _connect(self):
+        if self.sock is not None:
+            return
+        if self.failed_at is not None and self.clock() - self.failed_at < RETRY_INTERVAL:
+            raise CommandSocketError("not reachable since {0:.0f} s".format(
+                self.clock() - self.failed_at))
+        if not hasattr(socket, 'AF_UNIX'):
+            self.failed_at = self.clock()
+            raise CommandSocketError("unix sockets are not supported on this platform")
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.path)
+        except socket.error as e:
+            sock.close()
+            self.failed_at = self.clock()
+            raise CommandSocketError(str(e))
+        self.failed_at = None
+        self.connects += 1
+        self.sock = sock
+        self.reader = sock.makefile('rb')
+
+    def _encode(self, command, args):
+        lines = [command]
+        for key, values in args.items():
+            if not isinstance(values, (list, tuple)):
+                values = [values]
+            lines.append('\t'.join([key] + list(values)))
+        lines.append('done')
+        return ('\n'.join(lines) + '\n').encode('utf-8')
+
+    def _read_line(self):
+        line = self.reader.readline()
+        if not line.endswith(b'\n'):
+            raise CommandSocketError("connection closed")
+        return line[:-1].decode('utf-8')
+
+    def _read_reply(self):
+        '''
+        Return {key: [values]}, or None if the request was refused
+        '''
+        status = self._read_line()
+        if status not in ('ok', 'notok'):
+            raise CommandSocketError("unexpected reply {0!r}".format(status))
+        reply = {}
+        while True:
+            line = self._read_line()
+            if line == 'done':
+                break
+            fields = line.split('\t')
+            reply[fields[0]] = fields[1:]
+        return reply if status == 'ok' else None
+
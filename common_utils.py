@@ -6,29 +6,47 @@ __license__   = 'GPL v3'
 __copyright__ = '2014, Greg Riker <griker@hotmail.com>'
 __docformat__ = 'restructuredtext en'
 
-import cStringIO, os, re, sys, time
-from datetime import datetime
+import cStringIO, hashlib, importlib, json, os, re, sys
+from xml.etree.cElementTree import iterparse
 
+from calibre import __version__
 from calibre.constants import DEBUG
 from calibre.devices.usbms.driver import debug_print
-from calibre.ebooks.BeautifulSoup import BeautifulStoneSoup
 from calibre.utils.config import config_dir
 from calibre.utils.zipfile import ZipFile
 
-from PyQt4.uic import compileUi
+from calibre_plugins.syncman.tracing import tracer
+
+# Qt Creator forms shipped in the plugin, compiled at runtime by CompileUI
+PLUGIN_FORMS = ['syncman', 'sync_app_wizard', 'conflicts_report', 'replica_report']
+
+# CRC and size of each member inflated from the plugin zip
+RESOURCE_MANIFEST = 'manifest.json'
+
+# Content key and window title of each compiled form
+FORM_CACHE = 'form_cache.json'
 
 class CompileUI(object):
     '''
-    Compile Qt Creator .ui files at runtime
+    Compile Qt Creator .ui files at runtime.
+    Compiled forms are cached in FORM_CACHE, keyed by the content of the .ui
+    source and the toolkit versions, so a form is recompiled only when either
+    changes. The key does not depend on paths or mtimes, so the cache survives
+    restarts and copied profiles.
     '''
-    def __init__(self, resources_path):
+    IMAGES_PAT = re.compile(r'''(['"]):/images/([^'"]+)\1''')
+    TRANSLATE_PAT = re.compile(r'(?:QtGui.QApplication.translate|(?<!def )_translate)\(.+?,\s+"(.+?)(?<!\\)",.+?\)')
+
+    def __init__(self, resources_path, widgets=PLUGIN_FORMS):
         self.resources_path = resources_path
+        self.widgets = widgets
         self.compiled_forms = {}
         self.help_file = None
         self.compiled_forms = self.compile_ui()
 
     def compile_ui(self):
-        pat = re.compile(r'''(['"]):/images/([^'"]+)\1''')
+        # PyQt4.uic is only needed when a form actually has to be compiled
+        from PyQt4.uic import compileUi
 
         def sub(match):
             ans = 'I(%s%s%s)' % (match.group(1), match.group(2), match.group(1))
@@ -39,169 +57,200 @@ class CompileUI(object):
         compiled_forms = {}
         self._find_forms()
 
+        cache_fs = os.path.join(self.resources_path, FORM_CACHE)
+        cache = {}
+        if os.path.exists(cache_fs):
+            try:
+                with open(cache_fs, 'rb') as f:
+                    cache = json.loads(f.read())
+            except:
+                cache = {}
+        updated_cache = dict(cache)
+        toolkit = self._toolkit_signature()
+
         # Cribbed from gui2.__init__:build_forms()
         for form in self.forms:
-            with open(form) as form_file:
-                soup = BeautifulStoneSoup(form_file.read())
-                property = soup.find('property', attrs={'name': 'windowTitle'})
-                string = property.find('string')
-                window_title = string.renderContents()
+            with open(form, 'rb') as form_file:
+                raw = form_file.read()
+            key = hashlib.sha1(raw + toolkit).hexdigest()
 
             compiled_form = self._form_to_compiled_form(form)
-            if (not os.path.exists(compiled_form) or
-                    os.stat(form).st_mtime > os.stat(compiled_form).st_mtime):
-
-                if not os.path.exists(compiled_form):
-                    if DEBUG:
-                        debug_print(' compiling {}'.format(form))
-                else:
-                    if DEBUG:
-                        debug_print(' recompiling {}'.format(form))
-                    os.remove(compiled_form)
+            form_name = compiled_form.rpartition(os.sep)[2].partition('.')[0]
+            cached = cache.get(form_name)
+            if (cached is not None and cached['key'] == key and
+                    os.path.exists(compiled_form)):
+                compiled_forms[cached['window_title']] = form_name
+                continue
+
+            if DEBUG:
+                debug_print(' compiling {}'.format(form))
+            with tracer.span('compile_ui ' + form_name):
+                window_title = self._window_title(form)
                 buf = cStringIO.StringIO()
                 compileUi(form, buf)
                 dat = buf.getvalue()
                 dat = dat.replace('__appname__', 'calibre')
                 dat = dat.replace('import images_rc', '')
-                dat = re.compile(r'(?:QtGui.QApplication.translate|(?<!def )_translate)\(.+?,\s+"(.+?)(?<!\\)",.+?\)').sub(r'_("\1")', dat)
+                dat = self.TRANSLATE_PAT.sub(r'_("\1")', dat)
                 dat = dat.replace('_("MMM yyyy")', '"MMM yyyy"')
-                dat = pat.sub(sub, dat)
+                dat = self.IMAGES_PAT.sub(sub, dat)
                 with open(compiled_form, 'wb') as cf:
                     cf.write(dat)
 
-            compiled_forms[window_title] = compiled_form.rpartition(os.sep)[2].partition('.')[0]
-            os.remove(form)
+            updated_cache[form_name] = {'key': key, 'window_title': window_title}
+            compiled_forms[window_title] = form_name
+
+        if updated_cache != cache:
+            with open(cache_fs, 'wb') as f:
+                f.write(json.dumps(updated_cache, indent=2, sort_keys=True))
         return compiled_forms
 
     def _find_forms(self):
         forms = []
-        for root, _, files in os.walk(self.resources_path):
-            for name in files:
-                if name.endswith('.ui'):
-                    forms.append(os.path.abspath(os.path.join(root, name)))
+        for widget in self.widgets:
+            form = os.path.join(self.resources_path, widget + '.ui')
+            if os.path.exists(form):
+                forms.append(os.path.abspath(form))
         self.forms = forms
 
     def _form_to_compiled_form(self, form):
         compiled_form = form.rpartition('.')[0]+'_ui.py'
         return compiled_form
 
+    def _toolkit_signature(self):
+        '''
+        Versions which affect the output of compileUi()
+        '''
+        from PyQt4.QtCore import PYQT_VERSION_STR, QT_VERSION_STR
+        return "PyQt {0}/Qt {1}/calibre {2}".format(
+            PYQT_VERSION_STR, QT_VERSION_STR, __version__).encode('utf-8')
+
+    def _window_title(self, form):
+        '''
+        Stream the form until its windowTitle property is seen
+        '''
+        for _, elem in iterparse(form):
+            if elem.tag == 'property' and elem.get('name') == 'windowTitle':
+                return elem.findtext('string') or ''
+        return ''
+
 
 class Logger():
     '''
-    A self-modifying class to print debug statements.
-    If disabled in prefs, methods are neutered at first call for performance optimization
+    Mixin recording debug statements in the plugin trace.
+    When debug logging is disabled in prefs, each call costs one attribute
+    check. Messages are formatted lazily when the trace is written.
     '''
-    LOCATION_TEMPLATE = "{cls}:{func}({arg1}) {arg2}"
+    LOCATION_TEMPLATE = "{0}:{1}({2}) {3}"
 
-    def _log(self, msg=None):
+    def _log(self, msg=None, *args):
         '''
-        Upon first call, switch to appropriate method
+        Record msg, formatted with args if given
         '''
-        from calibre_plugins.marvin_manager.config import plugin_prefs
-        if not plugin_prefs.get('debug_plugin', False):
-            # Neuter the method
-            self._log = self.__null
-            self._log_location = self.__null
-        else:
-            # Log the message, then switch to real method
-            if msg:
-                debug_print(" {0}".format(str(msg)))
+        if tracer.enabled:
+            if args:
+                tracer.event(" " + msg, *args)
             else:
-                debug_print()
-
-            self._log = self.__log
-            self._log_location = self.__log_location
-
-    def __log(self, msg=None):
-        '''
-        The real method
-        '''
-        if msg:
-            debug_print(" {0}".format(str(msg)))
-        else:
-            debug_print()
+                tracer.event(" {0}", msg if msg is not None else '')
 
     def _log_location(self, *args):
         '''
-        Upon first call, switch to appropriate method
-        '''
-        from calibre_plugins.syncman.config import prefs
-        if not prefs.get('debug_plugin', False):
-            # Neuter the method
-            self._log = self.__null
-            self._log_location = self.__null
-        else:
-            # Log the message from here so stack trace is valid
-            arg1 = arg2 = ''
-
-            if len(args) > 0:
-                arg1 = str(args[0])
-            if len(args) > 1:
-                arg2 = str(args[1])
-
-            debug_print(self.LOCATION_TEMPLATE.format(cls=self.__class__.__name__,
-                        func=sys._getframe(1).f_code.co_name,
-                        arg1=arg1, arg2=arg2))
-
-            # Switch to real method
-            self._log = self.__log
-            self._log_location = self.__log_location
-
-    def __log_location(self, *args):
+        Record the calling class and method, with up to two arguments
         '''
-        The real method
-        '''
-        arg1 = arg2 = ''
-
-        if len(args) > 0:
-            arg1 = str(args[0])
-        if len(args) > 1:
-            arg2 = str(args[1])
-
-        debug_print(self.LOCATION_TEMPLATE.format(cls=self.__class__.__name__,
-                    func=sys._getframe(1).f_code.co_name,
-                    arg1=arg1, arg2=arg2))
-
-    def __null(self, *args, **kwargs):
-        '''
-        Optimized method when logger is silent
-        '''
-        pass
+        if tracer.enabled:
+            arg1 = args[0] if len(args) > 0 else ''
+            arg2 = args[1] if len(args) > 1 else ''
+            tracer.event(self.LOCATION_TEMPLATE, self.__class__.__name__,
+                         sys._getframe(1).f_code.co_name, arg1, arg2)
 
 
-def compile_widgets():
+def compile_widgets(widgets=PLUGIN_FORMS):
     '''
     Compile widgets as needed
     '''
     plugin_path = os.path.join(config_dir, 'plugins', 'SyncMan.zip')
     resources_path = os.path.join(config_dir, 'plugins', 'SyncMan_resources')
-    widgets = ['syncman', 'sync_app_wizard']
+    forms = [widget + '.ui' for widget in widgets]
 
-    with ZipFile(plugin_path, 'r') as zfr:
-        try:
-            for widget in widgets:
-                needs_compilation = True
+    with tracer.span('compile_widgets'):
+        # The forms are normally inflated by SyncManAction.genesis(), only
+        # visit the plugin zip if one has gone missing
+        for form in forms:
+            if not os.path.exists(os.path.join(resources_path, form)):
+                inflate_resources(plugin_path, resources_path, lambda name: name in forms)
+                break
 
-                # Get the .ui source timestamp
-                ui_ts = zfr.getinfo(widget + '.ui').date_time
-                ui_time = datetime(*ui_ts).timetuple()
+        CompileUI(resources_path, widgets)
 
-                # Do we have a compiled version with a later timestamp?
-                compiled_fs = os.path.join(resources_path, widget + '_ui.py')
-                if os.path.exists(compiled_fs):
-                    py_time = time.localtime(os.stat(compiled_fs).st_mtime)
-                    if py_time >= ui_time:
-                        needs_compilation = False
+def import_resource_module(module_name):
+    '''
+    Import a module inflated to SyncMan_resources. sys.path is only extended
+    for the duration of the import.
+    '''
+    if module_name in sys.modules:
+        return sys.modules[module_name]
 
-                if needs_compilation:
-                    zfr.extract(widget + '.ui', resources_path)
+    resources_path = os.path.join(config_dir, 'plugins', 'SyncMan_resources')
+    sys.path.insert(0, resources_path)
+    try:
+        return importlib.import_module(module_name)
+    finally:
+        sys.path.remove(resources_path)
 
+def inflate_resources(plugin_path, resources_path, wanted):
+    '''
+    Extract the members of the plugin zip accepted by wanted(name) which are
+    new or changed since the last pass. Each member's CRC and size are recorded
+    in a manifest stored in resources_path, so a warm start performs no writes.
+    Returns the list of extracted members.
+    '''
+    manifest_fs = os.path.join(resources_path, RESOURCE_MANIFEST)
+    manifest = {}
+    if os.path.exists(manifest_fs):
+        try:
+            with open(manifest_fs, 'rb') as f:
+                manifest = json.loads(f.read())
         except:
-            import traceback
-            print(traceback.format_exc())
-            raise Exception("Unable to inspect {}".format(widget + '.ui'))
-
-        CompileUI(resources_path)
+            manifest = {}
+
+    updated_manifest = dict(manifest)
+    extracted = []
+    with tracer.span('inflate_resources'), ZipFile(plugin_path, 'r') as zf:
+        members = set()
+        for zi in zf.infolist():
+            name = zi.filename
+            if name.endswith('/') or not wanted(name):
+                continue
+            members.add(name)
+            signature = [zi.CRC, zi.file_size]
+            fs = os.path.join(resources_path, *name.split('/'))
+            if manifest.get(name) == signature and os.path.exists(fs):
+                continue
+
+            if not os.path.exists(os.path.dirname(fs)):
+                os.makedirs(os.path.dirname(fs))
+            with open(fs, 'wb') as f:
+                f.write(zf.read(name))
+            updated_manifest[name] = signature
+            extracted.append(name)
+
+    # Forget members no longer shipped in the plugin
+    for name in manifest:
+        if wanted(name) and name not in members:
+            del updated_manifest[name]
+
+    if updated_manifest != manifest:
+        with open(manifest_fs, 'wb') as f:
+            f.write(json.dumps(updated_manifest, indent=2, sort_keys=True))
+    return extracted
+
+def load_form(widget):
+    '''
+    Compile widget's form if needed, return its generated Ui_Dialog class.
+    Called when a dialog is first needed, not during calibre startup.
+    '''
+    compile_widgets([widget])
+    return import_resource_module(widget + '_ui').Ui_Dialog
 
 def set_plugin_icon_resources(name, resources):
     '''
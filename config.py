@@ -6,26 +6,37 @@ __license__   = 'GPL v3'
 __copyright__ = '2014, Greg Riker <griker@hotmail.com>'
 __docformat__ = 'restructuredtext en'
 
-import importlib, os, sys
+import os, time
+from functools import partial
 
-from PyQt4.Qt import QComboBox, QHBoxLayout, QIcon, QLabel, QLineEdit, QWidget
+from PyQt4.Qt import (QFileDialog, QHBoxLayout, QHeaderView, QIcon, QLabel,
+                      QLineEdit, QListWidgetItem, QTableWidgetItem, QWidget, Qt)
 
 from calibre.constants import DEBUG
 from calibre.gui2.dialogs.message_box import MessageBox
 from calibre.gui2.ui import get_gui
-from calibre.utils.config import config_dir, JSONConfig
 
-from calibre_plugins.syncman.common_utils import Logger, compile_widgets
+from calibre_plugins.syncman.common_utils import (
+    Logger, import_resource_module, load_form)
+from calibre_plugins.syncman.ignore_rules import rules_path
+from calibre_plugins.syncman.journal import PauseJournal
+from calibre_plugins.syncman.prefs import prefs
+from calibre_plugins.syncman.snapshot import DEFAULT_SNAPSHOT_INTERVAL
+from calibre_plugins.syncman.sync_control import (
+    DEFAULT_MAX_PAUSE, DEFAULT_RESUME_DELAY, active_sync_apps, library_profile)
+from calibre_plugins.syncman.tracing import timings
 
-# Import Ui_Dialog from syncman.ui
-if True:
-    compile_widgets()
-    widget_path = os.path.join(config_dir, 'plugins', 'SyncMan_resources')
-    sys.path.insert(0, widget_path)
-    from syncman_ui import Ui_Dialog
-    sys.path.remove(widget_path)
+# Periods the pause window history can be summarized over, in seconds
+JOURNAL_PERIODS = [
+    ("the last day", 24 * 3600),
+    ("the last week", 7 * 24 * 3600),
+    ("the last 30 days", 30 * 24 * 3600),
+    ("all history", None),
+    ]
 
-prefs = JSONConfig('plugins/SyncMan')
+# Import Ui_Dialog from syncman.ui. This module is only imported by
+# SyncManPlugin.config_widget(), so the form is compiled on first use
+Ui_Dialog = load_form('syncman')
 
 class ConfigWidget(QWidget, Ui_Dialog, Logger):
 
@@ -43,17 +54,38 @@ class ConfigWidget(QWidget, Ui_Dialog, Logger):
         # Restore the debug settings
         self.debug_plugin.setChecked(self.prefs.get('debug_plugin', False))
 
-        # Add the defined sync services to the combobox
-        sync_app_list = self.prefs.get('sync_apps', {}).keys()
-        self.sync_apps.blockSignals(True)
-        self.sync_apps.addItems([''])
-        self.sync_apps.addItems(sorted(sync_app_list, key=lambda s: s.lower()))
-        self.sync_apps.setInsertPolicy(QComboBox.InsertAlphabetically)
+        # Restore the quiet period and maximum pause
+        self.resume_delay_sb.setValue(self.prefs.get('resume_delay', DEFAULT_RESUME_DELAY))
+        self.max_pause_sb.setValue(self.prefs.get('max_pause', DEFAULT_MAX_PAUSE) // 60)
 
-        # Select the previously selected sync service
-        selected_sync_app = self.prefs.get('sync_app', '')
-        index = self.sync_apps.findText(selected_sync_app)
-        self.sync_apps.setCurrentIndex(index)
+        # Restore the snapshot settings
+        self.snapshot_cb.setChecked(self.prefs.get('snapshot_mode', False))
+        self.snapshot_folder_le.setText(self.prefs.get('snapshot_folder', ''))
+        self.snapshot_interval_sb.setValue(
+            self.prefs.get('snapshot_interval', DEFAULT_SNAPSHOT_INTERVAL) // 60)
+
+        # Restore the staging settings
+        self.staging_cb.setChecked(self.prefs.get('staging_mode', False))
+        self.mirror_folder_le.setText(self.prefs.get('mirror_folder', ''))
+        self.staging_folder_le.setText(self.prefs.get('staging_folder', ''))
+
+        # Configure the folder buttons
+        for name, title in (('snapshot_folder', "Select snapshot folder"),
+                            ('mirror_folder', "Select mirror folder"),
+                            ('staging_folder', "Select staging folder")):
+            tb = getattr(self, name + '_tb')
+            tb.setIcon(QIcon(I('document_open.png')))
+            tb.clicked.connect(partial(self.select_folder,
+                                       getattr(self, name + '_le'), title))
+
+        # Add the defined sync services to the list, checking those active
+        # for the current library
+        self.library_path = self.gui.current_db.library_path
+        self.library_profile_cb.setChecked(
+            library_profile(self.prefs, self.library_path) is not None)
+        active_apps = active_sync_apps(self.prefs, self.library_path)
+        for sync_app_name in self.prefs.get('sync_apps', {}):
+            self.add_sync_app_item(sync_app_name, sync_app_name in active_apps)
 
         # Configure the tool buttons
         self.forget_tb.setIcon(QIcon(I('clear_left.png')))
@@ -62,11 +94,37 @@ class ConfigWidget(QWidget, Ui_Dialog, Logger):
         self.wizard_tb.setIcon(QIcon(I('wizard.png')))
         self.wizard_tb.clicked.connect(self.add_service)
 
-        # Hook changes to the sync_apps combobox
-        self.sync_apps.currentIndexChanged.connect(self.sync_apps_changed)
-        self.sync_apps.blockSignals(False)
+        # Hook selection changes in the sync_apps list
+        self.sync_apps_lw.itemSelectionChanged.connect(self.sync_apps_changed)
         self.sync_apps_changed()
 
+        # Show which sync apps are running, looked up off the GUI thread.
+        # The controller outlives the dialog, see hideEvent()
+        self.controller = plugin_action.controller
+        self.controller.job_done.connect(self.control_job_done)
+        self.controller.status()
+
+        # Show timings of recent sessions, and the last upload estimate
+        self.populate_timings()
+        self.show_pending_upload()
+        for label, seconds in JOURNAL_PERIODS:
+            self.journal_period_cb.addItem(label)
+        self.journal_period_cb.currentIndexChanged.connect(self.show_journal)
+        self.show_journal()
+        self.conflicts_pb.clicked.connect(self.show_conflicts)
+        self.ignore_rules_pb.clicked.connect(self.show_ignore_rules)
+        self.verify_replica_pb.clicked.connect(self.show_replica_report)
+
+    def add_sync_app_item(self, sync_app_name, active):
+        '''
+        Add a checkable sync app to the list
+        '''
+        item = QListWidgetItem(sync_app_name)
+        item.setFlags(item.flags() | Qt.ItemIsUserCheckable)
+        item.setCheckState(Qt.Checked if active else Qt.Unchecked)
+        self.sync_apps_lw.addItem(item)
+        return item
+
     def add_service(self):
         '''
         Modeled after MXD:config:launch_cc_wizard()
@@ -74,14 +132,13 @@ class ConfigWidget(QWidget, Ui_Dialog, Logger):
         self._log_location()
         klass = os.path.join(self.resources_path, 'sync_app_wizard.py')
         if not os.path.exists(klass):
-            self._log("Unable to load from '{}'".format(klass))
+            self._log("Unable to load from '{0}'", klass)
             return
 
-        self._log("importing SyncApp Wizard dialog from '{}'".format(klass))
-        sys.path.insert(0, self.resources_path)
-        this_dc = importlib.import_module('sync_app_wizard')
-        sys.path.remove(self.resources_path)
-        dlg = this_dc.SyncAppWizard(self, verbose=DEBUG)
+        self._log("importing SyncApp Wizard dialog from '{0}'", klass)
+        this_dc = import_resource_module('sync_app_wizard')
+        dlg = this_dc.SyncAppWizard(self, verbose=DEBUG,
+                                    discovery=self.parent.discovery)
         if dlg.exec_():
             # Retrieve the selected sync_app
             sync_app_fs = str(dlg.sync_app_path_le.text())
@@ -90,12 +147,27 @@ class ConfigWidget(QWidget, Ui_Dialog, Logger):
             # Update prefs with new sync app
             sync_apps = self.prefs.get('sync_apps', {})
             sync_apps[sync_app_name] = sync_app_fs
-            self.prefs.set('sync_apps', sync_apps)
+            self.prefs.set_now('sync_apps', sync_apps)
+
+            # Add sync_app to the list, active and selected
+            for item in self.sync_apps_lw.findItems(sync_app_name, Qt.MatchExactly):
+                self.sync_apps_lw.takeItem(self.sync_apps_lw.row(item))
+            item = self.add_sync_app_item(sync_app_name, True)
+            self.sync_apps_lw.setCurrentItem(item)
 
-            # Add sync_app to combobox, select
-            self.sync_apps.addItem(sync_app_name)
-            index = self.sync_apps.findText(sync_app_name)
-            self.sync_apps.setCurrentIndex(index)
+    def control_job_done(self, operation, result):
+        '''
+        Show the processes found by the controller's status lookup
+        '''
+        if operation != 'status' or not isinstance(result, dict):
+            return
+        for row in range(self.sync_apps_lw.count()):
+            item = self.sync_apps_lw.item(row)
+            pids = result.get(unicode(item.text()))
+            if pids:
+                item.setToolTip("Running, pid {0}".format(', '.join(map(str, pids))))
+            elif pids is not None:
+                item.setToolTip("Not running")
 
     def forget_service(self):
         '''
@@ -103,7 +175,10 @@ class ConfigWidget(QWidget, Ui_Dialog, Logger):
         '''
         self._log_location()
 
-        key = str(self.sync_apps.currentText())
+        item = self.sync_apps_lw.currentItem()
+        if item is None:
+            return
+        key = str(item.text())
 
         title = "Forget syncing application".format(key)
         msg = ("<p>Forget '{}' syncing application?".format(key))
@@ -113,21 +188,171 @@ class ConfigWidget(QWidget, Ui_Dialog, Logger):
             # Delete key from prefs
             sync_apps = self.prefs.get('sync_apps', {})
             del sync_apps[key]
-            self.prefs.set('sync_apps', sync_apps)
+            self.prefs.set_now('sync_apps', sync_apps)
+
+            # Remove from list
+            self.sync_apps_lw.takeItem(self.sync_apps_lw.row(item))
 
-            # Remove from combobox
-            index = self.sync_apps.currentIndex()
-            self.sync_apps.removeItem(index)
+    def hideEvent(self, event):
+        '''
+        The dialog is closing. Stop listening to the controller, which would
+        otherwise keep this widget alive and call into its deleted children.
+        '''
+        if self.controller is not None:
+            self.controller.job_done.disconnect(self.control_job_done)
+            self.controller = None
+        QWidget.hideEvent(self, event)
+
+    def populate_timings(self):
+        '''
+        Fill the read-only performance table from the timing history
+        '''
+        stats = timings.stats()
+        self.timings_tw.setSortingEnabled(False)
+        self.timings_tw.setRowCount(len(stats))
+        for row, phase in enumerate(sorted(stats)):
+            samples, lo, median, hi = stats[phase]
+            self.timings_tw.setItem(row, 0, QTableWidgetItem(phase))
+            for column, value in enumerate((samples, lo * 1000, median * 1000, hi * 1000), 1):
+                item = QTableWidgetItem()
+                item.setData(Qt.DisplayRole, round(value, 2))
+                item.setTextAlignment(Qt.AlignRight | Qt.AlignVCenter)
+                self.timings_tw.setItem(row, column, item)
+        self.timings_tw.resizeColumnsToContents()
+        self.timings_tw.horizontalHeader().setResizeMode(0, QHeaderView.Stretch)
+        self.timings_tw.setSortingEnabled(True)
 
     def save_settings(self):
         self._log_location()
         self.prefs.set('debug_plugin', self.debug_plugin.isChecked())
-        self.prefs.set('sync_app', str(self.sync_apps.currentText()))
+        active_sync_apps = []
+        for row in range(self.sync_apps_lw.count()):
+            item = self.sync_apps_lw.item(row)
+            if item.checkState() == Qt.Checked:
+                active_sync_apps.append(str(item.text()))
+        profiles = dict(self.prefs.get('library_profiles', {}))
+        if self.library_profile_cb.isChecked():
+            profiles[self.library_path] = {'active_sync_apps': active_sync_apps}
+        else:
+            profiles.pop(self.library_path, None)
+            self.prefs.set('active_sync_apps', active_sync_apps)
+        self.prefs.set('library_profiles', profiles)
+        self.prefs.set('resume_delay', self.resume_delay_sb.value())
+        self.prefs.set('max_pause', self.max_pause_sb.value() * 60)
+        self.prefs.set('snapshot_mode', self.snapshot_cb.isChecked())
+        self.prefs.set('snapshot_folder', unicode(self.snapshot_folder_le.text()))
+        self.prefs.set('snapshot_interval', self.snapshot_interval_sb.value() * 60)
+        self.prefs.set('staging_mode', self.staging_cb.isChecked())
+        self.prefs.set('mirror_folder', unicode(self.mirror_folder_le.text()))
+        self.prefs.set('staging_folder', unicode(self.staging_folder_le.text()))
+        if self.staging_cb.isChecked():
+            # The mirror follows the library open when it was enabled
+            self.prefs.set('mirror_library', self.library_path)
+
+    def select_folder(self, line_edit, title):
+        '''
+        Browse for a folder, showing it in line_edit
+        '''
+        self._log_location(title)
+        folder = unicode(QFileDialog.getExistingDirectory(
+            self, title, unicode(line_edit.text()) or os.path.expanduser("~")))
+        if folder:
+            line_edit.setText(folder)
+
+    def show_conflicts(self):
+        '''
+        Open the conflicted copies report for the current library
+        '''
+        self._log_location()
+        from calibre_plugins.syncman.conflicts_report import ConflictsReport
+        dlg = ConflictsReport(self, self.library_path)
+        dlg.exec_()
+
+    def show_ignore_rules(self):
+        '''
+        Show the ignore configuration generated for each active sync app
+        '''
+        self._log_location()
+        rules = self.parent.ignore_rules
+        details = []
+        for name in sorted(rules.saved_for or {}):
+            path = rules_path(name)
+            try:
+                with open(path, 'rb') as f:
+                    details.append("{0} ({1}):\n{2}".format(name, path, f.read().decode('utf-8')))
+            except EnvironmentError:
+                continue
+        if details:
+            msg = ("calibre's transient files in {0} are listed below for each active sync "
+                   "app. Apply them in the sync app to keep them from syncing.".format(
+                       rules.library_path))
+        else:
+            msg = "No ignore rules have been generated yet. Enable a sync app and try again."
+        dlg = MessageBox(MessageBox.INFO, "Sync ignore rules", msg,
+                         det_msg='\n'.join(details), parent=self.gui,
+                         show_copy_button=True)
+        dlg.exec_()
+
+    def show_journal(self, *args):
+        '''
+        Summarize the pause windows journaled over the selected period
+        '''
+        seconds = JOURNAL_PERIODS[max(0, self.journal_period_cb.currentIndex())][1]
+        since = time.time() - seconds if seconds is not None else None
+        journal = getattr(self.parent, 'journal', None) or PauseJournal()
+        summary = journal.summary(since)
+        if not summary['windows']:
+            self.journal_label.setText("No pause windows recorded")
+            return
+
+        def fmt(stats, template):
+            return ', '.join("{0} {1}".format(key, template.format(stats[key]))
+                             for key in ('p50', 'p95', 'max'))
+        self.journal_label.setText('\n'.join([
+            "{0} windows, paused {1:.0f} s in all".format(summary['windows'], summary['paused']),
+            "Paused: " + fmt(summary['duration'], "{0:.1f} s"),
+            "Events per window: " + fmt(summary['events'], "{0:.0f}"),
+            "Resumed after: " + fmt(summary['resume'], "{0:.2f} s"),
+            ]))
+
+    def show_pending_upload(self):
+        '''
+        Describe the last library scan, and whether the sync apps are idle
+        '''
+        lines = []
+        index = getattr(self.parent, 'library_index', None)
+        delta = index.last_delta if index is not None else None
+        if delta is not None:
+            lines.append(
+                "Last library scan: {0} files changed ({1:.1f} MB), {2} deleted. "
+                "Scanned {3} files in {4:.2f} s".format(
+                    delta['files'], delta['bytes'] / (1024 * 1024), delta['deleted'],
+                    delta['scanned'], delta['elapsed']))
+        sample = getattr(self.parent, 'quiescence_result', None)
+        if sample is not None:
+            if sample['quiescent']:
+                lines.append("Sync apps idle for {0:.0f} s".format(sample['quiet_for']))
+            else:
+                lines.append("Sync apps busy: {0:.0f} KB/s".format(
+                    sum(rate for rate, cpu in sample['rates'].values()) / 1024))
+            for name, status in sorted(sample.get('statuses', {}).items()):
+                lines.append("{0}: {1}".format(name, status))
+        if lines:
+            self.pending_label.setText('\n'.join(lines))
+
+    def show_replica_report(self):
+        '''
+        Open the replica verification report for the current library
+        '''
+        self._log_location()
+        from calibre_plugins.syncman.replica_report import ReplicaReport
+        dlg = ReplicaReport(self, self.library_path)
+        dlg.exec_()
 
     def sync_apps_changed(self, *args):
-        self._log_location(self.sync_apps.currentText())
-        selected = str(self.sync_apps.currentText())
-        if selected:
+        item = self.sync_apps_lw.currentItem()
+        self._log_location(item.text() if item is not None else '')
+        if item is not None and self.sync_apps_lw.selectedItems():
             self.forget_tb.setEnabled(True)
         else:
             self.forget_tb.setEnabled(False)
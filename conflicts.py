@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2014, Greg Riker <griker@hotmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import hashlib, json, os, re, time, zlib
+from multiprocessing.pool import ThreadPool
+
+from calibre.utils.config import config_dir
+from calibre.utils.filenames import atomic_rename
+
+from calibre_plugins.syncman.common_utils import Logger
+from calibre_plugins.syncman.library_index import join, scandir
+from calibre_plugins.syncman.tracing import tracer
+
+INDEX_DIR = os.path.join(config_dir, 'plugins', 'SyncMan_resources', 'conflict_index')
+
+# Bumped when the on-disk format changes, older indexes are rebuilt
+INDEX_VERSION = 1
+
+# Threads listing directories. Listing is I/O bound and releases the GIL.
+SCAN_WORKERS = 8
+
+# Directories modified this recently are listed again on the next scan, as a
+# later change within the filesystem's timestamp resolution would not
+# change their mtime
+RACY_INTERVAL = 2
+
+# Names given to conflicting versions of a file or folder by the sync apps
+# we ship icons for, tested in order
+CONFLICT_PATTERNS = [
+    # "name (Jane's conflicted copy 2014-05-01).epub", "name (Case Conflict)"
+    ('Dropbox', re.compile(r" \((?:[^()]+'s )?(?:conflicted copy|case conflict|"
+                           r"selective sync conflict)\b[^()]*\)", re.I)),
+    # "name (Copy conflict 2014-05-01 10.22.31).epub"
+    ('Copy', re.compile(r" \(copy conflict\b[^()]*\)", re.I)),
+    # "name_MyHost_Conflict.epub", "name_Differ_1.epub"
+    ('CloudSync', re.compile(r"_(?:[^_/]+_)?(?:conflict|differ)(?:_\d+)?(?=\.[^.]+$|$)", re.I)),
+    # "name (conflicted 1).epub", "name (Jane - Conflict).epub"
+    ('Box', re.compile(r" \((?:[^()]+ )?(?:- )?conflict(?:ed)?(?: copy)?(?: [\d-]+)?\)", re.I)),
+    ]
+
+
+def conflict_provider(name):
+    '''
+    Return the sync app whose conflict naming name matches, or None
+    '''
+    for provider, pat in CONFLICT_PATTERNS:
+        if pat.search(name):
+            return provider
+    return None
+
+
+def list_names(path):
+    '''
+    Return ([subdirectory names], [file names]) of path, without following
+    symlinks
+    '''
+    dirs, files = [], []
+    if scandir is not None:
+        for entry in scandir(path):
+            (dirs if entry.is_dir(follow_symlinks=False) else files).append(entry.name)
+    else:
+        for name in os.listdir(path):
+            (dirs if os.path.isdir(os.path.join(path, name)) and
+             not os.path.islink(os.path.join(path, name)) else files).append(name)
+    return dirs, files
+
+
+class ConflictScanner(Logger):
+    '''
+    Find the conflicted copies sync apps leave in a library.
+    Directories are visited a level at a time by a thread pool. The index
+    keeps each directory's mtime, subdirectories and conflicted copies. A
+    directory whose mtime is unchanged has had no entries added, removed or
+    renamed, so a repeat scan only stat()s it and reuses its entry, and
+    lists the changed directories.
+    '''
+    def __init__(self, library_path, index_dir=INDEX_DIR, workers=SCAN_WORKERS):
+        self.library_path = library_path
+        key = hashlib.sha1(os.path.abspath(library_path).encode('utf-8')).hexdigest()
+        self.index_path = os.path.join(index_dir, key + '.idx')
+        self.workers = workers
+        # {relative dir: [mtime_ms, [subdirectories], [[conflict name, provider]]]}
+        self.dirs = None
+
+        # Counters for the last scan
+        self.listed = 0
+        self.reused = 0
+
+    def conflicts(self):
+        '''
+        Return [(relative path, provider, size, mtime)] for the indexed
+        conflicted copies, sorted by path
+        '''
+        ans = []
+        for rel, entry in (self.dirs or {}).items():
+            for name, provider in entry[2]:
+                path = join(rel, name)
+                try:
+                    st = os.lstat(os.path.join(self.library_path, *path.split('/')))
+                except OSError:
+                    continue
+                ans.append((path, provider, st.st_size, st.st_mtime))
+        return sorted(ans)
+
+    def load(self):
+        self.dirs = {}
+        if not os.path.exists(self.index_path):
+            return False
+        try:
+            with open(self.index_path, 'rb') as f:
+                saved = json.loads(zlib.decompress(f.read()).decode('utf-8'))
+        except Exception as e:
+            self._log("unreadable conflict index {0}: {1}", self.index_path, e)
+            return False
+        if (saved.get('version') != INDEX_VERSION or
+                saved.get('library_path') != self.library_path):
+            return False
+        self.dirs = saved['dirs']
+        return True
+
+    def save(self):
+        dpath = os.path.dirname(self.index_path)
+        if not os.path.exists(dpath):
+            os.makedirs(dpath)
+        raw = json.dumps({'version': INDEX_VERSION,
+                          'library_path': self.library_path,
+                          'dirs': self.dirs}, separators=(',', ':'))
+        temp_path = self.index_path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(zlib.compress(raw.encode('utf-8'), 6))
+        atomic_rename(temp_path, self.index_path)
+
+    def scan(self):
+        '''
+        Update the index, returning conflicts(). Safe to call from a worker
+        thread.
+        '''
+        started = time.time()
+        if self.dirs is None:
+            self.load()
+        self.listed = self.reused = 0
+        old = self.dirs
+        new = {}
+        pool = ThreadPool(self.workers)
+        try:
+            with tracer.span('conflicts.scan'):
+                frontier = ['']
+                while frontier:
+                    next_frontier = []
+                    for rel, entry, listed in pool.map(
+                            lambda rel: self.visit(rel, old.get(rel)), frontier):
+                        if entry is None:
+                            continue
+                        if listed:
+                            self.listed += 1
+                        else:
+                            self.reused += 1
+                        new[rel] = entry
+                        next_frontier.extend(join(rel, name) for name in entry[1])
+                    frontier = next_frontier
+        finally:
+            pool.close()
+            pool.join()
+
+        changed = new != old
+        self.dirs = new
+        if changed:
+            self.save()
+        ans = self.conflicts()
+        self._log("conflict scan of {0}: {1} listed, {2} unchanged, {3} conflicts in {4:.1f} ms",
+                  self.library_path, self.listed, self.reused, len(ans),
+                  (time.time() - started) * 1000)
+        return ans
+
+    def visit(self, rel, entry):
+        '''
+        Return (rel, index entry, listed) for the directory rel, reusing
+        entry if the directory is unchanged. The entry is None if rel has
+        gone.
+        '''
+        path = os.path.join(self.library_path, *rel.split('/')) if rel else self.library_path
+        try:
+            mtime = os.stat(path).st_mtime
+            if entry is not None and entry[0] == int(mtime * 1000):
+                return rel, entry, False
+            dirs, files = list_names(path)
+        except OSError:
+            return rel, None, False
+
+        conflicts = []
+        for name in dirs + files:
+            provider = conflict_provider(name)
+            if provider is not None:
+                conflicts.append([name, provider])
+        if time.time() - mtime < RACY_INTERVAL:
+            mtime = -1
+        return rel, [int(mtime * 1000), sorted(dirs), conflicts], True
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2014, Greg Riker <griker@hotmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import threading, time
+
+from calibre.gui2.ui import get_gui
+
+from calibre_plugins.syncman.common_utils import Logger, load_form
+from calibre_plugins.syncman.conflicts import ConflictScanner
+
+from PyQt4.Qt import (QDialog, QDialogButtonBox, QHeaderView, QTableWidgetItem,
+                      Qt, pyqtSignal)
+
+# Import Ui_Dialog from conflicts_report.ui. This module is only imported by
+# ConfigWidget.show_conflicts(), so the form is compiled on first use
+Ui_Dialog = load_form('conflicts_report')
+
+
+class ConflictsReport(QDialog, Ui_Dialog, Logger):
+    '''
+    List the conflicted copies in the current library. The library is
+    scanned on a worker thread when the dialog opens, and on Rescan.
+    '''
+    # Delivers scan results from the worker thread
+    scan_complete = pyqtSignal(object)
+
+    def __init__(self, parent, library_path):
+        self._log_location(library_path)
+        self.gui = get_gui()
+        QDialog.__init__(self, parent)
+        self.setupUi(self)
+
+        self.scanner = ConflictScanner(library_path)
+        self.scanning = False
+        self.scan_complete.connect(self.show_conflicts)
+
+        self.rescan_button = self.bb.addButton("Rescan", QDialogButtonBox.ActionRole)
+        self.rescan_button.clicked.connect(self.scan)
+        self.bb.rejected.connect(self.reject)
+
+        self.conflicts_tw.horizontalHeader().setResizeMode(1, QHeaderView.Stretch)
+        self.scan()
+
+    def scan(self):
+        '''
+        Rescan the library on a worker thread
+        '''
+        if self.scanning:
+            return
+        self.scanning = True
+        self.rescan_button.setEnabled(False)
+        self.summary_label.setText("Scanning {0}...".format(self.scanner.library_path))
+
+        def scan():
+            started = time.time()
+            try:
+                conflicts = self.scanner.scan()
+            except Exception as e:
+                self._log("conflict scan failed: {0}", e)
+                conflicts = None
+            try:
+                self.scan_complete.emit((conflicts, time.time() - started))
+            except RuntimeError:
+                # The dialog was closed during the scan
+                pass
+
+        thread = threading.Thread(target=scan, name='SyncMan conflict scan')
+        thread.daemon = True
+        thread.start()
+
+    def show_conflicts(self, result):
+        '''
+        Fill the table with the scan results
+        '''
+        conflicts, elapsed = result
+        self.scanning = False
+        self.rescan_button.setEnabled(True)
+        if conflicts is None:
+            self.summary_label.setText("Unable to scan {0}".format(self.scanner.library_path))
+            return
+
+        self.summary_label.setText(
+            "{0} conflicted copies, {1:.1f} MB. Scanned in {2:.2f} s, "
+            "{3} of {4} folders changed since the last scan".format(
+                len(conflicts), sum(c[2] for c in conflicts) / (1024 * 1024), elapsed,
+                self.scanner.listed, self.scanner.listed + self.scanner.reused))
+
+        self.conflicts_tw.setSortingEnabled(False)
+        self.conflicts_tw.setRowCount(len(conflicts))
+        for row, (path, provider, size, mtime) in enumerate(conflicts):
+            self.conflicts_tw.setItem(row, 0, QTableWidgetItem(provider))
+            self.conflicts_tw.setItem(row, 1, QTableWidgetItem(path))
+            item = QTableWidgetItem()
+            item.setData(Qt.DisplayRole, round(size / 1024, 1))
+            item.setTextAlignment(Qt.AlignRight | Qt.AlignVCenter)
+            self.conflicts_tw.setItem(row, 2, item)
+            self.conflicts_tw.setItem(row, 3, QTableWidgetItem(
+                time.strftime('%Y-%m-%d %H:%M', time.localtime(mtime))))
+        self.conflicts_tw.resizeColumnsToContents()
+        self.conflicts_tw.horizontalHeader().setResizeMode(1, QHeaderView.Stretch)
+        self.conflicts_tw.setSortingEnabled(True)
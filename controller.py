@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2014, Greg Riker <griker@hotmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import os, signal, threading, time
+from Queue import Queue
+
+from calibre_plugins.syncman.common_utils import Logger
+from calibre_plugins.syncman.tracing import tracer
+
+from PyQt4.Qt import QObject, pyqtSignal
+
+# Longest shutdown() waits for queued jobs before continuing the suspended
+# processes itself
+SHUTDOWN_TIMEOUT = 3.0
+
+
+class SyncController(QObject, Logger):
+    '''
+    Run everything done to the sync apps on a single worker thread, so the
+    GUI thread never waits on a process scan, a signal or a file copy.
+    Jobs run in the order they are submitted: work queued before resume()
+    runs while the apps are still suspended. Each job's result is delivered
+    to the GUI thread by job_done(operation, result); result is the
+    exception if the job failed. The worker is started by the first job.
+    '''
+    job_done = pyqtSignal(object, object)
+
+    def __init__(self, engine):
+        QObject.__init__(self)
+        self.engine = engine
+        self.queue = Queue()
+        self.thread = None
+        # Operation being run by the worker, or None
+        self.running = None
+
+    def app_status(self):
+        '''
+        Return {app_name: [pid, ...]} of the configured sync apps' processes
+        '''
+        apps = self.engine.prefs.get('sync_apps', {})
+        self.engine.process_index.register(apps.values())
+        return dict((name, self.engine.find_pids(path)) for name, path in apps.items())
+
+    def continue_suspended(self):
+        '''
+        Send SIGCONT to every process the engine has stopped, from the
+        calling thread. Used when the worker does not finish in time.
+        '''
+        for name, pids in list(self.engine.suspended.items()):
+            for pid in pids:
+                try:
+                    os.kill(pid, signal.SIGCONT)
+                except OSError:
+                    pass
+            self._log("continued {0}: {1}", name, pids)
+
+    def resume(self):
+        self.submit('resume', self.engine.resume)
+
+    def shutdown(self, timeout=SHUTDOWN_TIMEOUT):
+        '''
+        Resume the sync apps and stop the worker, returning within timeout
+        seconds. Jobs still queued after timeout are abandoned with the
+        worker, a daemon thread.
+        '''
+        if self.thread is None:
+            self.engine.resume()
+            self.engine.close()
+            return True
+
+        started = time.time()
+        self.resume()
+        self.queue.put(None)
+        self.thread.join(timeout)
+        finished = not self.thread.is_alive()
+        if not finished:
+            self._log("worker busy with {0} after {1:.1f} s", self.running, timeout)
+            # Keep a hung job from stopping the apps again as calibre exits
+            self.engine.closed = True
+            self.continue_suspended()
+        else:
+            self.engine.close()
+        self._log_location("{0:.1f} ms".format((time.time() - started) * 1000))
+        return finished
+
+    def status(self):
+        '''
+        Look up the configured sync apps' processes, reported as 'status'
+        '''
+        self.submit('status', self.app_status)
+
+    def submit(self, operation, func, *args):
+        '''
+        Queue func(*args) to run on the worker thread
+        '''
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.work, name='SyncMan control')
+            self.thread.daemon = True
+            self.thread.start()
+        self.queue.put((operation, func, args))
+
+    def suspend(self):
+        self.submit('suspend', self.engine.suspend)
+
+    def work(self):
+        '''
+        Worker thread: run jobs until shutdown()
+        '''
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            operation, func, args = job
+            self.running = operation
+            try:
+                with tracer.span('control.' + operation):
+                    result = func(*args)
+            except Exception as e:
+                self._log("{0} failed: {1}", operation, e)
+                result = e
+            self.running = None
+            self.job_done.emit(operation, result)
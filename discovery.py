@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2014, Greg Riker <griker@hotmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import json, os, threading, time
+
+from calibre.utils.config import config_dir
+from calibre.utils.filenames import atomic_rename
+
+from calibre_plugins.syncman.common_utils import Logger
+from calibre_plugins.syncman.drivers import known_locations
+from calibre_plugins.syncman.tracing import tracer
+
+DISCOVERY_CACHE = os.path.join(config_dir, 'plugins', 'SyncMan_resources', 'discovery.json')
+
+# Seconds a cached path check is trusted
+CHECK_TTL = 300
+
+
+def expand(path):
+    return os.path.expandvars(os.path.expanduser(path))
+
+
+class DiscoveryService(Logger):
+    '''
+    Find the sync apps installed in the locations known to their drivers.
+    start() looks on a worker thread, as home directories may be on slow
+    network drives. Results and path checks are cached in DISCOVERY_CACHE
+    with the mtime of each path, so found() and is_cached() answer from
+    memory and the wizard opens without touching the filesystem.
+    '''
+    def __init__(self, cache_path=DISCOVERY_CACHE, clock=time.time):
+        self.cache_path = cache_path
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.thread = None
+        # {path: [exists, mtime, checked_at]}
+        self.checks = {}
+        # [(app_name, path)] found by the last discovery
+        self.apps = []
+        self.load()
+
+    def check(self, path, refresh=False):
+        '''
+        Return True if path exists, answering from the cache while it is
+        fresh unless refresh is set
+        '''
+        now = self.clock()
+        with self.lock:
+            entry = self.checks.get(path)
+        if entry is not None and not refresh and now - entry[2] < CHECK_TTL:
+            return entry[0]
+        try:
+            mtime = os.stat(path).st_mtime
+        except (OSError, UnicodeError):
+            entry = [False, None, now]
+        else:
+            entry = [True, mtime, now]
+        with self.lock:
+            self.checks[path] = entry
+        return entry[0]
+
+    def discover(self):
+        '''
+        Check every known location, returning [(app_name, path)] of the
+        installed apps. Safe to call from a worker thread.
+        '''
+        with tracer.span('discovery'):
+            before = self.signature()
+            apps = []
+            for name, paths in known_locations():
+                for path in paths:
+                    path = expand(path)
+                    if self.check(path, refresh=True):
+                        apps.append((name, path))
+                        break
+            changed = apps != self.apps
+            self.apps = apps
+            if changed or self.signature() != before:
+                self.save()
+        if changed:
+            self._log("found {0}", apps)
+        return apps
+
+    def found(self):
+        '''
+        Return [(app_name, path)] of the installed apps, as last discovered
+        '''
+        return list(self.apps)
+
+    def is_cached(self, path):
+        '''
+        Return the cached answer of check(path), or None
+        '''
+        with self.lock:
+            entry = self.checks.get(path)
+        if entry is None or self.clock() - entry[2] >= CHECK_TTL:
+            return None
+        return entry[0]
+
+    def load(self):
+        if not os.path.exists(self.cache_path):
+            return
+        try:
+            with open(self.cache_path, 'rb') as f:
+                cache = json.loads(f.read())
+            self.checks = cache['checks']
+            self.apps = [tuple(app) for app in cache['apps']]
+        except Exception as e:
+            self._log("unreadable discovery cache {0}: {1}", self.cache_path, e)
+
+    def save(self):
+        with self.lock:
+            raw = json.dumps({'apps': self.apps, 'checks': self.checks},
+                             separators=(',', ':'))
+        dpath = os.path.dirname(self.cache_path)
+        if not os.path.exists(dpath):
+            os.makedirs(dpath)
+        temp_path = self.cache_path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(raw.encode('utf-8'))
+        atomic_rename(temp_path, self.cache_path)
+
+    def signature(self):
+        '''
+        Return {path: (exists, mtime)}, ignoring when paths were checked
+        '''
+        with self.lock:
+            return dict((path, tuple(entry[:2])) for path, entry in self.checks.items())
+
+    def start(self):
+        '''
+        Discover the installed apps on a worker thread
+        '''
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.thread = threading.Thread(target=self.discover, name='SyncMan discovery')
+        self.thread.daemon = True
+        self.thread.start()
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2014, Greg Riker <griker@hotmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import os, signal, time
+
+from calibre.constants import isosx, iswindows
+
+from calibre_plugins.syncman.command_socket import CommandSocket, CommandSocketError
+from calibre_plugins.syncman.common_utils import Logger
+from calibre_plugins.syncman.ignore_rules import provider_for
+from calibre_plugins.syncman.tracing import timings
+
+if isosx:
+    PLATFORM = 'osx'
+elif iswindows:
+    PLATFORM = 'windows'
+else:
+    PLATFORM = 'linux'
+
+
+class SyncDriver(Logger):
+    '''
+    Control one sync app. This generic driver suits any app: it finds the
+    app's processes by executable path, pauses them with SIGSTOP and
+    resumes them with SIGCONT. It has no status query, so quiescence is
+    judged from the processes' I/O alone. Drivers for particular apps add
+    install locations for discovery, and a status query where the app
+    offers one. The engine calls a driver from its worker threads, one
+    operation at a time per driver.
+    '''
+    provider = 'generic'
+    # {platform: [install location]}, environment variables and ~ expanded.
+    # Directories are matched by the processes running inside them.
+    locations = {}
+    # Status texts meaning the app has nothing left to sync
+    idle_statuses = ()
+
+    def __init__(self, app_name, app_path, process_index, prefs=None):
+        self.app_name = app_name
+        self.app_path = app_path
+        self.process_index = process_index
+        self.prefs = prefs if prefs is not None else {}
+
+    @classmethod
+    def known_locations(cls):
+        return cls.locations.get(PLATFORM, [])
+
+    def close(self):
+        '''
+        Release any connection to the app
+        '''
+        pass
+
+    def is_idle(self, status):
+        '''
+        Return True if status, as returned by status(), means the app has
+        finished syncing
+        '''
+        return status.startswith(self.idle_statuses)
+
+    def pause(self, pids, cancelled=None):
+        '''
+        Stop pids, unless cancelled() turns True on the way. Returns
+        {'pids': stopped pids, 'errors': [...], 'elapsed': seconds}.
+        '''
+        return self.signal(pids, 'SIGSTOP', cancelled)
+
+    def pids(self):
+        '''
+        Return the pids of the app's live processes
+        '''
+        return self.process_index.pids(self.app_path)
+
+    def resume(self, pids):
+        '''
+        Continue pids stopped by pause(). Returns the same as pause().
+        '''
+        return self.signal(pids, 'SIGCONT')
+
+    def signal(self, pids, signame, cancelled=None):
+        started = time.time()
+        sig = getattr(signal, signame)
+        signalled = []
+        errors = []
+        for pid in pids:
+            if cancelled is not None and cancelled():
+                break
+            try:
+                os.kill(pid, sig)
+            except OSError as e:
+                # Exited, possibly while suspended
+                errors.append("{0}: {1}".format(pid, e))
+                self.process_index.invalidate(self.app_path)
+                continue
+            signalled.append(pid)
+        elapsed = time.time() - started
+        timings.record('{0} {1}'.format(signame, self.app_name), elapsed)
+        return {'pids': signalled, 'errors': errors, 'elapsed': elapsed}
+
+    def status(self):
+        '''
+        Return the app's own account of what it is doing, or None if it
+        cannot be asked
+        '''
+        return None
+
+
+class DropboxDriver(SyncDriver):
+    '''
+    Dropbox, whose status is read from its command_socket over a
+    connection kept open between polls. prefs['command_sockets'] =
+    {app_name: path} overrides the socket path.
+    '''
+    provider = 'Dropbox'
+    locations = {
+        'osx': ['/Applications/Dropbox.app', '~/Applications/Dropbox.app'],
+        'windows': [r'%APPDATA%\Dropbox\bin\Dropbox.exe',
+                    r'%PROGRAMFILES(X86)%\Dropbox\Client\Dropbox.exe',
+                    r'%PROGRAMFILES%\Dropbox\Client\Dropbox.exe'],
+        'linux': ['~/.dropbox-dist'],
+        }
+    idle_statuses = ('Up to date', 'Idle')
+    socket_path = '~/.dropbox/command_socket'
+
+    def __init__(self, *args, **kwargs):
+        SyncDriver.__init__(self, *args, **kwargs)
+        path = self.prefs.get('command_sockets', {}).get(self.app_name)
+        self.socket = CommandSocket(path or os.path.expanduser(self.socket_path))
+
+    def close(self):
+        self.socket.close()
+
+    def status(self):
+        started = time.time()
+        try:
+            reply = self.socket.request('get_dropbox_status')
+        except CommandSocketError as e:
+            self._log("{0} status: {1}", self.app_name, e)
+            return None
+        timings.record('status {0}'.format(self.app_name), time.time() - started)
+        return ' '.join(reply.get('status', []))
+
+
+class BoxDriver(SyncDriver):
+    provider = 'Box'
+    locations = {
+        'osx': ['/Applications/Box Sync.app', '/Applications/Box.app'],
+        'windows': [r'%PROGRAMFILES%\Box\Box Sync\BoxSync.exe',
+                    r'%PROGRAMFILES(X86)%\Box\Box Sync\BoxSync.exe'],
+        }
+
+
+class CopyDriver(SyncDriver):
+    provider = 'Copy'
+    locations = {
+        'osx': ['/Applications/Copy.app'],
+        'windows': [r'%PROGRAMFILES(X86)%\Copy\CopyAgent.exe',
+                    r'%PROGRAMFILES%\Copy\CopyAgent.exe'],
+        'linux': ['~/copy/x86_64/CopyAgent', '~/copy/x86/CopyAgent'],
+        }
+
+
+class CloudSyncDriver(SyncDriver):
+    provider = 'CloudSync'
+    locations = {
+        'osx': ['/Applications/Synology Cloud Station Drive.app',
+                '/Applications/Synology Cloud Station.app'],
+        'windows': [r'%PROGRAMFILES(X86)%\Synology\CloudStation\bin\CloudStation.exe',
+                    r'%PROGRAMFILES%\Synology\CloudStation\bin\CloudStation.exe'],
+        'linux': ['/usr/bin/synology-cloud-station-drive', '~/.CloudStation/bin'],
+        }
+
+
+# The drivers of the apps we ship icons for, in discovery order
+DRIVERS = [DropboxDriver, BoxDriver, CopyDriver, CloudSyncDriver]
+
+
+def driver_class(provider):
+    '''
+    Return the driver class for provider, SyncDriver if there is none
+    '''
+    for cls in DRIVERS:
+        if cls.provider == provider:
+            return cls
+    return SyncDriver
+
+
+def driver_for(app_name, app_path, process_index, prefs):
+    '''
+    Return a driver for a configured sync app
+    '''
+    provider = driver_provider(app_name, app_path, prefs)
+    return driver_class(provider)(app_name, app_path, process_index, prefs)
+
+
+def driver_provider(app_name, app_path, prefs):
+    '''
+    Return the provider whose driver controls a sync app.
+    prefs['sync_drivers'] = {app_name: provider} chooses one explicitly,
+    otherwise it is guessed from the app's name and path.
+    '''
+    provider = prefs.get('sync_drivers', {}).get(app_name) or provider_for(app_name, app_path)
+    return driver_class(provider).provider
+
+
+def known_locations():
+    '''
+    Return [(provider, [install location])] on this platform
+    '''
+    return [(cls.provider, cls.known_locations()) for cls in DRIVERS if cls.known_locations()]
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2014, Greg Riker <griker@hotmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import fnmatch, os, re
+
+from calibre.constants import isosx, iswindows
+from calibre.utils.config import config_dir
+from calibre.utils.filenames import atomic_rename
+
+from calibre_plugins.syncman.common_utils import Logger
+
+IGNORE_DIR = os.path.join(config_dir, 'plugins', 'SyncMan_resources', 'ignore')
+
+# Library paths that should never sync: (pattern, reason). Patterns match a
+# file name, or with a trailing / a folder name, anywhere in the library.
+IGNORE_RULES = [
+    ('metadata.db-journal', "SQLite rollback journal of the library database"),
+    ('metadata.db-wal', "SQLite write-ahead log of the library database"),
+    ('metadata.db-shm', "SQLite shared memory index of the library database"),
+    ('full-text-search.db', "full text search index, rebuilt by calibre"),
+    ('full-text-search.db-*', "SQLite transients of the full text search index"),
+    ('.metadata.db.syncman', "SyncMan snapshot being written"),
+    ('.caltrash/', "books and formats deleted in calibre"),
+    ('*.tmp', "temporary file"),
+    ('.DS_Store', "OS X folder settings"),
+    ('._*', "OS X resource fork"),
+    ('Thumbs.db', "Windows thumbnail cache"),
+    ('desktop.ini', "Windows folder settings"),
+    ]
+
+
+# Executable, bundle or folder names of each provider's sync app, lowercase
+# and without .app or .exe
+PROVIDER_NAMES = [
+    ('Dropbox', ('dropbox', 'dropboxd', 'dropbox-dist')),
+    ('CloudSync', ('cloudstation', 'cloud station', 'cloudsync',
+                   'synology cloud station', 'synology cloud station drive',
+                   'synology-cloud-station-drive')),
+    ('Copy', ('copy', 'copyagent')),
+    ('Box', ('box', 'box sync', 'boxsync')),
+    ]
+
+
+def provider_for(app_name, app_path):
+    '''
+    Return the provider whose ignore configuration suits a sync app, matched
+    on the name of its executable or bundle, then on the app's name. A
+    folder such as ~/.CloudStation/bin is matched on its parent's name.
+    '''
+    parts = [part for part in re.split(r'[\\/]', app_path) if part]
+    if parts and parts[-1].lower() == 'bin':
+        parts.pop()
+    base = re.sub(r'\.(app|exe)$', '', parts[-1].lower()).lstrip('.') if parts else ''
+    for key in (base, app_name.strip().lower()):
+        for provider, names in PROVIDER_NAMES:
+            if key in names:
+                return provider
+    return 'generic'
+
+
+def quote(path):
+    return '"' + path.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def rules_path(app_name, ignore_dir=IGNORE_DIR):
+    '''
+    Return the file holding the configuration generated for app_name
+    '''
+    return os.path.join(ignore_dir, re.sub(r'[^\w .-]', '_', app_name) + '.txt')
+
+
+class IgnoreRules(Logger):
+    '''
+    Compute the library paths matched by IGNORE_RULES, and the ignore or
+    selective sync configuration of each sync app for them.
+    The matched paths are kept as a set. update() applies a library scan's
+    changed and removed paths, so only new files are matched against the
+    rules, and reports whether the set changed.
+    '''
+    def __init__(self, rules=IGNORE_RULES):
+        self.rules = rules
+        self.file_pats = [re.compile(fnmatch.translate(pat)) for pat, _ in rules
+                          if not pat.endswith('/')]
+        self.dir_names = set(pat.rstrip('/') for pat, _ in rules if pat.endswith('/'))
+        # Relative paths of the ignored files and folders of library_path
+        self.library_path = None
+        self.ignored = set()
+        # {app_name: app_path} the configuration was last saved for
+        self.saved_for = None
+
+    def emit(self, provider, library_path):
+        '''
+        Return the configuration text ignoring the matched paths for provider
+        '''
+        lines = ["# Paths in {0} that should not sync, generated by SyncMan".format(library_path)]
+        lines += ["#   {0}: {1}".format(pat, reason) for pat, reason in self.rules]
+        paths = [os.path.join(library_path, *path.split('/')) for path in sorted(self.ignored)]
+
+        if provider == 'Dropbox':
+            # Folders by selective sync, files by Dropbox's ignore attribute
+            for path, fs in zip(sorted(self.ignored), paths):
+                if self.is_dir_rule(path):
+                    lines.append("dropbox exclude add {0}".format(quote(fs)))
+                elif iswindows:
+                    lines.append("Set-Content -Path '{0}' -Stream com.dropbox.ignored -Value 1".format(
+                        fs.replace("'", "''")))
+                elif isosx:
+                    lines.append("xattr -w com.dropbox.ignored 1 {0}".format(quote(fs)))
+                else:
+                    lines.append("attr -s com.dropbox.ignored -V 1 {0}".format(quote(fs)))
+        elif provider == 'CloudSync':
+            # blacklist.filter in the Cloud Station configuration folder
+            lines += ['[File]']
+            lines += ['black_name = {0}'.format(quote(pat)) for pat, _ in self.rules
+                      if not pat.endswith('/')]
+            lines += ['[Directory]']
+            lines += ['black_name = {0}'.format(quote(name)) for name in sorted(self.dir_names)]
+        elif provider == 'Box':
+            lines.append("# Box Sync has no ignore list, move these out of the synced folder:")
+            lines += paths
+        else:
+            # One pattern per line, as Copy's excluded files and most
+            # .ignore formats expect
+            lines += [pat for pat, _ in self.rules]
+        return '\n'.join(lines) + '\n'
+
+    def is_dir_rule(self, path):
+        return path.rpartition('/')[2] in self.dir_names
+
+    def match(self, path):
+        '''
+        Return the ignored path covering the relative path, or None
+        '''
+        parts = path.split('/')
+        for i, part in enumerate(parts[:-1]):
+            if part in self.dir_names:
+                return '/'.join(parts[:i + 1])
+        if any(pat.match(parts[-1]) for pat in self.file_pats):
+            return path
+        return None
+
+    def rebuild(self, library_path, paths):
+        '''
+        Match every path of library_path. Returns True if the ignored set
+        changed.
+        '''
+        self.library_path = library_path
+        ignored = set()
+        for path in paths:
+            match = self.match(path)
+            if match is not None:
+                ignored.add(match)
+        changed = ignored != self.ignored
+        self.ignored = ignored
+        return changed
+
+    def save(self, library_path, sync_apps, ignore_dir=IGNORE_DIR):
+        '''
+        Write the configuration for each of {app_name: app_path} to
+        ignore_dir/<app_name>.txt. Returns {app_name: file path}.
+        '''
+        if not os.path.exists(ignore_dir):
+            os.makedirs(ignore_dir)
+        written = {}
+        for name, path in sync_apps.items():
+            fs = rules_path(name, ignore_dir)
+            temp_path = fs + '.tmp'
+            with open(temp_path, 'wb') as f:
+                f.write(self.emit(provider_for(name, path), library_path).encode('utf-8'))
+            atomic_rename(temp_path, fs)
+            written[name] = fs
+        self.saved_for = dict(sync_apps)
+        return written
+
+    def update(self, changed, removed):
+        '''
+        Apply the changed and removed paths of a library scan. Returns True
+        if the ignored set changed.
+        '''
+        before = len(self.ignored)
+        added = False
+        for path in changed:
+            match = self.match(path)
+            if match is not None and match not in self.ignored:
+                self.ignored.add(match)
+                added = True
+        for path in removed:
+            # A folder stays ignored while the next full rebuild finds files in it
+            self.ignored.discard(path)
+        return added or len(self.ignored) != before
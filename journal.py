@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2014, Greg Riker <griker@hotmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import math, os, struct
+
+from calibre.utils.config import config_dir
+
+from calibre_plugins.syncman.common_utils import Logger
+
+JOURNAL_PATH = os.path.join(config_dir, 'plugins', 'SyncMan_resources', 'pause_journal.bin')
+
+# A pause window: start time, seconds paused, library events absorbed and
+# seconds from the window closing until the sync apps were resumed
+RECORD = struct.Struct(str('<dfIf'))
+
+# The journal is rotated at this size, keeping this many older files, so
+# the history never takes more than (JOURNAL_FILES + 1) * MAX_JOURNAL_BYTES
+MAX_JOURNAL_BYTES = 64 * 1024
+JOURNAL_FILES = 3
+
+# Records read at a time by windows()
+READ_RECORDS = 512
+
+# Relative width of a Histogram bucket, bounding the error of percentiles
+BUCKET_RATIO = 1.05
+
+
+class Histogram(object):
+    '''
+    Log-scale histogram of non-negative values. Memory depends on the
+    range of the values, not their number; percentiles are within
+    BUCKET_RATIO of the true value. min, max and count are exact.
+    '''
+    def __init__(self, smallest=0.001):
+        self.smallest = smallest
+        self.log_ratio = math.log(BUCKET_RATIO)
+        # {bucket: count}, bucket -1 holding values below smallest
+        self.buckets = {}
+        self.count = 0
+        self.min = self.max = None
+
+    def add(self, value):
+        if value < self.smallest:
+            bucket = -1
+        else:
+            bucket = int(math.log(value / self.smallest) / self.log_ratio)
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, q):
+        '''
+        Return the value below which q percent of the values fall, or None
+        '''
+        if not self.count:
+            return None
+        rank = max(1, int(math.ceil(self.count * q / 100)))
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                if bucket < 0:
+                    return self.min
+                # Bucket midpoint, clamped to what was actually seen
+                value = self.smallest * BUCKET_RATIO ** (bucket + 0.5)
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    def summary(self):
+        return {'p50': self.percentile(50), 'p95': self.percentile(95), 'max': self.max}
+
+
+class PauseJournal(Logger):
+    '''
+    Append-only history of pause windows, as fixed size RECORDs in
+    JOURNAL_PATH and its rotated predecessors JOURNAL_PATH.1 (newest)
+    to .JOURNAL_FILES (oldest). Records are appended in time order, so
+    windows() reads the files oldest first, skipping files that end before
+    the period asked for, a block at a time. summary() streams them into
+    histograms, so neither holds the history in memory.
+    '''
+    def __init__(self, path=JOURNAL_PATH, max_bytes=MAX_JOURNAL_BYTES,
+                 files=JOURNAL_FILES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.files = files
+
+    def append(self, start, duration, events, resume_time):
+        '''
+        Record a pause window
+        '''
+        dpath = os.path.dirname(self.path)
+        if not os.path.exists(dpath):
+            os.makedirs(dpath)
+        size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        if size + RECORD.size > self.max_bytes:
+            self.rotate()
+            size = 0
+        with open(self.path, 'ab') as f:
+            if size % RECORD.size:
+                # A record cut short by a crash, drop it to stay aligned
+                f.truncate(size - size % RECORD.size)
+            f.write(RECORD.pack(start, duration, events, resume_time))
+
+    def paths(self):
+        '''
+        Return the journal files, oldest first
+        '''
+        paths = ['{0}.{1}'.format(self.path, n) for n in range(self.files, 0, -1)]
+        return [path for path in paths + [self.path] if os.path.exists(path)]
+
+    def rotate(self):
+        oldest = '{0}.{1}'.format(self.path, self.files)
+        if os.path.exists(oldest):
+            os.remove(oldest)
+        for n in range(self.files - 1, 0, -1):
+            path = '{0}.{1}'.format(self.path, n)
+            if os.path.exists(path):
+                os.rename(path, '{0}.{1}'.format(self.path, n + 1))
+        if self.files:
+            os.rename(self.path, self.path + '.1')
+        else:
+            os.remove(self.path)
+        self._log_location(self.path)
+
+    def summary(self, since=None, until=None):
+        '''
+        Return {'windows', 'paused', 'duration', 'events', 'resume'} for the
+        windows started in the period; the last three are {'p50', 'p95',
+        'max'}
+        '''
+        histograms = dict((key, Histogram()) for key in ('duration', 'events', 'resume'))
+        windows = 0
+        paused = 0.0
+        for start, duration, events, resume_time in self.windows(since, until):
+            windows += 1
+            paused += duration
+            histograms['duration'].add(duration)
+            histograms['events'].add(events)
+            histograms['resume'].add(resume_time)
+        ans = dict((key, h.summary()) for key, h in histograms.items())
+        ans['windows'] = windows
+        ans['paused'] = paused
+        return ans
+
+    def windows(self, since=None, until=None):
+        '''
+        Yield (start, duration, events, resume_time) of the windows started
+        from since until until, oldest first
+        '''
+        for path in self.paths():
+            try:
+                with open(path, 'rb') as f:
+                    count = os.fstat(f.fileno()).st_size // RECORD.size
+                    if not count:
+                        continue
+                    if since is not None:
+                        f.seek((count - 1) * RECORD.size)
+                        if RECORD.unpack(f.read(RECORD.size))[0] < since:
+                            continue
+                        f.seek(0)
+                    remaining = count
+                    while remaining:
+                        n = min(remaining, READ_RECORDS)
+                        block = f.read(n * RECORD.size)
+                        remaining -= n
+                        for offset in range(0, len(block) - RECORD.size + 1, RECORD.size):
+                            record = RECORD.unpack_from(block, offset)
+                            if until is not None and record[0] > until:
+                                return
+                            if since is None or record[0] >= since:
+                                yield record
+            except EnvironmentError as e:
+                self._log("unreadable pause journal {0}: {1}", path, e)
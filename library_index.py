@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2014, Greg Riker <griker@hotmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import hashlib, json, os, stat, time, zlib
+
+from calibre.utils.config import config_dir
+from calibre.utils.filenames import atomic_rename
+
+from calibre_plugins.syncman.common_utils import Logger
+from calibre_plugins.syncman.tracing import tracer
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+INDEX_DIR = os.path.join(config_dir, 'plugins', 'SyncMan_resources', 'library_index')
+
+# Bumped when the on-disk format changes, older indexes are rebuilt
+INDEX_VERSION = 1
+
+# Directories modified this recently are listed again on the next update, as
+# an entry added within the filesystem's timestamp resolution would leave
+# their mtime unchanged
+RACY_INTERVAL = 2
+
+# Seconds between updates that list every directory. In between, files
+# rewritten in place in a directory whose mtime is unchanged are missed.
+FULL_SCAN_INTERVAL = 300
+
+
+def list_dir(path):
+    '''
+    Yield (name, is_dir, size, mtime_ms) for the entries of path, without
+    following symlinks. scandir() gets the entry type from the directory
+    listing, so only files are stat()ed.
+    '''
+    if scandir is not None:
+        for entry in scandir(path):
+            if entry.is_dir(follow_symlinks=False):
+                yield entry.name, True, 0, 0
+            elif entry.is_file(follow_symlinks=False):
+                st = entry.stat(follow_symlinks=False)
+                yield entry.name, False, st.st_size, int(st.st_mtime * 1000)
+        return
+
+    for name in os.listdir(path):
+        st = os.lstat(os.path.join(path, name))
+        if stat.S_ISDIR(st.st_mode):
+            yield name, True, 0, 0
+        elif stat.S_ISREG(st.st_mode):
+            yield name, False, st.st_size, int(st.st_mtime * 1000)
+
+
+def join(rel, name):
+    '''
+    Join an index directory and file name into a relative path
+    '''
+    return rel + '/' + name if rel else name
+
+
+def scan_tree(root):
+    '''
+    Return {relative dir: {file name: [size, mtime_ms]}} for the tree at root
+    '''
+    dirs = {}
+    pending = ['']
+    while pending:
+        rel = pending.pop()
+        files = {}
+        try:
+            for name, is_dir, size, mtime in list_dir(os.path.join(root, rel)):
+                if is_dir:
+                    pending.append(join(rel, name))
+                else:
+                    files[name] = [size, mtime]
+        except OSError:
+            # Removed or unreadable while we were scanning
+            continue
+        dirs[rel] = files
+    return dirs
+
+
+def rescan_tree(root, old_dirs, old_mtimes, racy):
+    '''
+    Return ({relative dir: {file name: [size, mtime_ms]}}, {relative dir:
+    mtime_ms}, directories listed) for the tree at root. Only directories
+    whose mtime differs from old_mtimes, or is later than racy, are listed
+    again, the others keep their files from old_dirs and are descended
+    into by their indexed subdirectories. The root is always listed.
+    '''
+    children = {}
+    for rel in old_dirs:
+        if rel:
+            children.setdefault(rel.rpartition('/')[0], []).append(rel)
+    dirs, mtimes = {}, {}
+    listed = 0
+    pending = ['']
+    while pending:
+        rel = pending.pop()
+        path = os.path.join(root, rel)
+        try:
+            st = os.lstat(path)
+            if not stat.S_ISDIR(st.st_mode):
+                continue
+            mtime = int(st.st_mtime * 1000)
+            if rel and rel in old_dirs and old_mtimes.get(rel) == mtime and mtime < racy:
+                dirs[rel] = old_dirs[rel]
+                pending.extend(children.get(rel, ()))
+            else:
+                files = {}
+                for name, is_dir, size, file_mtime in list_dir(path):
+                    if is_dir:
+                        pending.append(join(rel, name))
+                    else:
+                        files[name] = [size, file_mtime]
+                dirs[rel] = files
+                listed += 1
+        except OSError:
+            # Removed or unreadable while we were scanning
+            continue
+        mtimes[rel] = mtime
+    return dirs, mtimes, listed
+
+
+class LibraryIndex(Logger):
+    '''
+    Persistent (path, size, mtime) index of a library tree.
+    update() rescans the tree and reports the files written or deleted since
+    the previous scan, which are what the sync app has still to upload. Only
+    directories whose mtime has changed are listed again, every directory
+    at most FULL_SCAN_INTERVAL seconds apart, and the library root, holding
+    metadata.db, always. The index is kept as zlib-compressed JSON in
+    INDEX_DIR, one file per library, and is only rewritten when the tree
+    has changed.
+    '''
+    def __init__(self, library_path, index_dir=INDEX_DIR):
+        self.library_path = library_path
+        key = hashlib.sha1(os.path.abspath(library_path).encode('utf-8')).hexdigest()
+        self.index_path = os.path.join(index_dir, key + '.idx')
+        self.dirs = None
+        # {relative dir: mtime_ms} as of the last update
+        self.dir_mtimes = {}
+        self.full_scan_at = None
+        self.last_delta = None
+        # Managed by the caller running update() on a worker thread
+        self.scanning = False
+        self.rescan = False
+
+    def compare(self, old, new):
+        '''
+        Return the changed file count and bytes between two scans, and the
+        relative paths of the changed and deleted files
+        '''
+        changed, removed = [], []
+        pending_bytes = 0
+        for rel, new_files in new.items():
+            old_files = old.get(rel, {})
+            if old_files is new_files or old_files == new_files:
+                continue
+            for name, entry in new_files.items():
+                if old_files.get(name) != entry:
+                    changed.append(join(rel, name))
+                    pending_bytes += entry[0]
+            removed.extend(join(rel, name) for name in old_files if name not in new_files)
+        for rel, old_files in old.items():
+            if rel not in new:
+                removed.extend(join(rel, name) for name in old_files)
+        return {'files': len(changed), 'deleted': len(removed),
+                'bytes': pending_bytes, 'changed': changed, 'removed': removed}
+
+    def forget(self, path):
+        '''
+        Drop path from the index, so the next scan reports it as changed
+        '''
+        rel, _, name = path.rpartition('/')
+        files = (self.dirs or {}).get(rel)
+        if files is not None:
+            files.pop(name, None)
+            # List the directory again, the file is still there
+            self.dir_mtimes.pop(rel, None)
+
+    def load(self):
+        '''
+        Read the saved index. Returns False if there is none for this library.
+        '''
+        self.dirs = None
+        self.dir_mtimes = {}
+        if not os.path.exists(self.index_path):
+            return False
+        try:
+            with open(self.index_path, 'rb') as f:
+                saved = json.loads(zlib.decompress(f.read()).decode('utf-8'))
+        except Exception as e:
+            self._log("unreadable library index {0}: {1}", self.index_path, e)
+            return False
+        if (saved.get('version') != INDEX_VERSION or
+                saved.get('library_path') != self.library_path):
+            return False
+        self.dirs = saved['dirs']
+        # Missing from indexes written before directories were skipped
+        self.dir_mtimes = saved.get('dir_mtimes', {})
+        return True
+
+    def paths(self):
+        '''
+        Return the relative paths of the indexed files
+        '''
+        return [join(rel, name) for rel, files in (self.dirs or {}).items()
+                for name in files]
+
+    def save(self):
+        dpath = os.path.dirname(self.index_path)
+        if not os.path.exists(dpath):
+            os.makedirs(dpath)
+        raw = json.dumps({'version': INDEX_VERSION,
+                          'library_path': self.library_path,
+                          'dirs': self.dirs,
+                          'dir_mtimes': self.dir_mtimes}, separators=(',', ':'))
+        temp_path = self.index_path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(zlib.compress(raw.encode('utf-8'), 6))
+        atomic_rename(temp_path, self.index_path)
+
+    def update(self, full=False):
+        '''
+        Rescan the library. Returns {'files', 'deleted', 'bytes', 'changed',
+        'removed', 'scanned', 'listed', 'elapsed'}, or None if there was no
+        previous index to compare with. full lists every directory, as the
+        first update of a session does.
+        Safe to call from a worker thread.
+        '''
+        started = time.time()
+        with tracer.span('library_index.update'):
+            if self.dirs is None:
+                self.load()
+            full = (full or self.full_scan_at is None or
+                    started - self.full_scan_at >= FULL_SCAN_INTERVAL)
+            racy = int((started - RACY_INTERVAL) * 1000)
+            new, mtimes, listed = rescan_tree(
+                self.library_path, self.dirs or {}, {} if full else self.dir_mtimes, racy)
+            if full:
+                self.full_scan_at = started
+            delta = None
+            if self.dirs is not None:
+                delta = self.compare(self.dirs, new)
+            changed = (delta is None or delta['files'] or delta['deleted'] or
+                       mtimes != self.dir_mtimes)
+            self.dirs = new
+            self.dir_mtimes = mtimes
+            if changed:
+                self.save()
+
+        if delta is not None:
+            delta['scanned'] = sum(len(files) for files in new.values())
+            delta['listed'] = listed
+            delta['elapsed'] = time.time() - started
+            self.last_delta = delta
+            self._log("library index of {0} updated in {1:.1f} ms: {2} of {3} folders "
+                      "listed, {4} files changed, {5} deleted, {6} bytes",
+                      self.library_path, delta['elapsed'] * 1000, listed, len(new),
+                      delta['files'], delta['deleted'], delta['bytes'])
+        else:
+            self._log("library index of {0} built in {1:.1f} ms: {2} files",
+                      self.library_path, (time.time() - started) * 1000,
+                      sum(len(files) for files in new.values()))
+        return delta
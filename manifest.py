@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2014, Greg Riker <griker@hotmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import base64, hashlib, json, multiprocessing, os, time, zlib
+from multiprocessing.pool import ThreadPool
+
+from calibre.utils.config import config_dir
+from calibre.utils.filenames import atomic_rename
+
+from calibre_plugins.syncman.common_utils import Logger
+from calibre_plugins.syncman.library_index import join, scan_tree
+from calibre_plugins.syncman.tracing import tracer
+
+MANIFEST_DIR = os.path.join(config_dir, 'plugins', 'SyncMan_resources', 'manifest')
+
+# Bumped when the on-disk format changes, older manifests are rebuilt
+MANIFEST_VERSION = 1
+
+# Bytes read at a time while hashing
+HASH_CHUNK = 1024 * 1024
+
+# Batches smaller than this are hashed without a pool, as starting and
+# stopping one takes as long as hashing this much
+POOL_MIN_BYTES = 16 * 1024 * 1024
+
+try:
+    HASH_WORKERS = multiprocessing.cpu_count()
+except NotImplementedError:
+    HASH_WORKERS = 4
+
+# Files modified this recently are hashed again on the next update, as a
+# rewrite within the filesystem's timestamp resolution would leave their
+# size and mtime unchanged
+RACY_INTERVAL = 2
+
+
+def hash_file(path):
+    '''
+    Return (path, base64 sha1 of the contents, error). Module level so a
+    process pool can pickle it.
+    '''
+    h = hashlib.sha1()
+    try:
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(HASH_CHUNK)
+                if not chunk:
+                    break
+                h.update(chunk)
+    except EnvironmentError as e:
+        return path, None, unicode(e)
+    return path, base64.b64encode(h.digest()).decode('ascii'), None
+
+
+class ChecksumManifest(Logger):
+    '''
+    Checksums of every file in a library tree, to verify a replica of it.
+    update() rescans the tree and hashes only the files whose size or mtime
+    has changed since the previous update, a pool of workers hashing
+    several files at once. The manifest is kept as zlib-compressed JSON in
+    MANIFEST_DIR, one file per library, grouped by directory with the
+    digests in base64.
+    Hashing runs in threads by default: hashlib releases the GIL while
+    hashing, and worker processes cannot be started from inside calibre's
+    GUI on every platform. processes=True uses a process pool instead,
+    where the caller is a plain script.
+    '''
+    def __init__(self, library_path, manifest_dir=MANIFEST_DIR,
+                 workers=HASH_WORKERS, processes=False):
+        self.library_path = library_path
+        key = hashlib.sha1(os.path.abspath(library_path).encode('utf-8')).hexdigest()
+        self.manifest_path = os.path.join(manifest_dir, key + '.idx')
+        self.workers = workers
+        self.processes = processes
+        # {relative dir: {file name: [size, mtime_ms, digest]}}
+        self.dirs = None
+
+    def compare(self, replica_path):
+        '''
+        Check replica_path against the manifest as of the last update().
+        Files are hashed only where the sizes match. Returns {'problems':
+        [(relative path, problem, detail)], 'checked', 'bytes', 'elapsed'},
+        problems being 'missing', 'extra', 'size', 'checksum' or
+        'unreadable', sorted by path.
+        '''
+        started = time.time()
+        if self.dirs is None:
+            self.load()
+        problems = []
+        candidates = {}
+        with tracer.span('manifest.compare'):
+            replica = scan_tree(replica_path)
+            for rel, files in self.dirs.items():
+                replica_files = replica.get(rel, {})
+                for name, (size, mtime, digest) in files.items():
+                    path = join(rel, name)
+                    if name not in replica_files:
+                        problems.append((path, 'missing', ''))
+                    elif replica_files[name][0] != size:
+                        problems.append((path, 'size', "{0} bytes in the library, {1} in the "
+                                         "replica".format(size, replica_files[name][0])))
+                    else:
+                        candidates[self._abspath(replica_path, path)] = (path, size, digest)
+            for rel, replica_files in replica.items():
+                files = self.dirs.get(rel, {})
+                problems.extend((join(rel, name), 'extra', '')
+                                for name in replica_files if name not in files)
+
+            hashed_bytes = 0
+            sizes = dict((path, c[1]) for path, c in candidates.items())
+            for abs_path, digest, error in self.hash(sizes):
+                path, size, expected = candidates[abs_path]
+                if error is not None:
+                    problems.append((path, 'unreadable', error))
+                    continue
+                if digest != expected:
+                    problems.append((path, 'checksum', ''))
+                hashed_bytes += size
+
+        ans = {'problems': sorted(problems), 'checked': len(candidates),
+               'bytes': hashed_bytes, 'elapsed': time.time() - started}
+        self._log("replica {0} compared with {1} in {2:.1f} ms: {3} checked, {4} problems",
+                  replica_path, self.library_path, ans['elapsed'] * 1000,
+                  ans['checked'], len(problems))
+        return ans
+
+    def files(self):
+        '''
+        Return the number of files in the manifest
+        '''
+        return sum(len(files) for files in (self.dirs or {}).values())
+
+    def hash(self, sizes):
+        '''
+        Yield hash_file() of each path in {path: size}, in the order they
+        finish. The largest files are started first, so the pool is not left
+        waiting on one big file at the end.
+        '''
+        paths = sorted(sizes, key=sizes.get, reverse=True)
+        if len(paths) < 2 or self.workers < 2 or sum(sizes.values()) < POOL_MIN_BYTES:
+            for path in paths:
+                yield hash_file(path)
+            return
+
+        pool = (multiprocessing.Pool if self.processes else ThreadPool)(self.workers)
+        try:
+            chunksize = max(1, min(64, len(paths) // (self.workers * 4)))
+            for ans in pool.imap_unordered(hash_file, paths, chunksize):
+                yield ans
+        finally:
+            pool.close()
+            pool.join()
+
+    def load(self):
+        '''
+        Read the saved manifest. Returns False if there is none for this
+        library.
+        '''
+        self.dirs = {}
+        if not os.path.exists(self.manifest_path):
+            return False
+        try:
+            with open(self.manifest_path, 'rb') as f:
+                saved = json.loads(zlib.decompress(f.read()).decode('utf-8'))
+        except Exception as e:
+            self._log("unreadable checksum manifest {0}: {1}", self.manifest_path, e)
+            return False
+        if (saved.get('version') != MANIFEST_VERSION or
+                saved.get('library_path') != self.library_path):
+            return False
+        self.dirs = saved['dirs']
+        return True
+
+    def save(self):
+        dpath = os.path.dirname(self.manifest_path)
+        if not os.path.exists(dpath):
+            os.makedirs(dpath)
+        raw = json.dumps({'version': MANIFEST_VERSION,
+                          'library_path': self.library_path,
+                          'dirs': self.dirs}, separators=(',', ':'))
+        temp_path = self.manifest_path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(zlib.compress(raw.encode('utf-8'), 9))
+        atomic_rename(temp_path, self.manifest_path)
+
+    def update(self):
+        '''
+        Rescan the library, hashing new and changed files. Returns {'files',
+        'hashed', 'bytes', 'removed', 'errors', 'elapsed'}. Safe to call from
+        a worker thread.
+        '''
+        started = time.time()
+        if self.dirs is None:
+            self.load()
+        old = self.dirs
+        new = {}
+        pending = {}
+        with tracer.span('manifest.update'):
+            for rel, files in scan_tree(self.library_path).items():
+                old_files = old.get(rel, {})
+                entries = new[rel] = {}
+                for name, (size, mtime) in files.items():
+                    entry = old_files.get(name)
+                    if entry is not None and entry[:2] == [size, mtime]:
+                        entries[name] = entry
+                    else:
+                        pending[self._abspath(self.library_path, join(rel, name))] = (
+                            rel, name, size, mtime)
+
+            racy = int((started - RACY_INTERVAL) * 1000)
+            errors = []
+            hashed_bytes = 0
+            sizes = dict((path, entry[2]) for path, entry in pending.items())
+            for abs_path, digest, error in self.hash(sizes):
+                rel, name, size, mtime = pending[abs_path]
+                if error is not None:
+                    # Removed or unreadable since the scan, hashed next time
+                    errors.append("{0}: {1}".format(join(rel, name), error))
+                    continue
+                new[rel][name] = [size, mtime if mtime < racy else -1, digest]
+                hashed_bytes += size
+
+        removed = sum(1 for rel, files in old.items() for name in files
+                      if name not in new.get(rel, {}))
+        changed = new != old
+        self.dirs = new
+        if changed:
+            self.save()
+        ans = {'files': self.files(), 'hashed': len(pending) - len(errors),
+               'bytes': hashed_bytes, 'removed': removed, 'errors': errors,
+               'elapsed': time.time() - started}
+        self._log("checksum manifest of {0} updated in {1:.1f} ms: {2} files, "
+                  "{3} hashed ({4:.1f} MB), {5} removed, {6} errors",
+                  self.library_path, ans['elapsed'] * 1000, ans['files'], ans['hashed'],
+                  hashed_bytes / (1024 * 1024), removed, len(errors))
+        return ans
+
+    # Helpers
+    def _abspath(self, root, path):
+        return os.path.join(root, *path.split('/'))
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2014, Greg Riker <griker@hotmail.com>'
+__docformat__ = 'restructuredtext en'
+
+# Kept free of GUI imports so SyncManAction.genesis() and Logger can read
+# prefs without importing config.py, which compiles the dialog form
+import os
+
+from calibre.utils.config import JSONConfig
+from calibre.utils.filenames import atomic_rename
+
+from calibre_plugins.syncman.tracing import tracer
+
+class SyncManPrefs(JSONConfig):
+    '''
+    JSONConfig timing its reads and writes.
+    Between begin_transaction() and end_transaction(), set() only changes the
+    in-memory prefs. end_transaction() then writes them once, or restores them
+    from disk. set_now() writes a single pref even during a transaction. A
+    write is skipped when the serialized prefs are unchanged, and replaces
+    the file atomically.
+    '''
+    def __init__(self, rel_path_to_cf_file):
+        self.in_transaction = False
+        self.dirty = False
+        self.committed_raw = None
+        JSONConfig.__init__(self, rel_path_to_cf_file)
+
+    def begin_transaction(self):
+        '''
+        Stage changes in memory until end_transaction()
+        '''
+        self.in_transaction = True
+        self.dirty = False
+
+    def commit(self):
+        if self.in_transaction:
+            self.dirty = True
+            return
+
+        raw = self.to_raw()
+        if raw == self.committed_raw:
+            return
+
+        with tracer.span('prefs.write'):
+            dpath = os.path.dirname(self.file_path)
+            if not os.path.exists(dpath):
+                os.makedirs(dpath)
+            temp_path = self.file_path + '.tmp'
+            with open(temp_path, 'wb') as f:
+                f.write(raw if isinstance(raw, bytes) else raw.encode('utf-8'))
+            atomic_rename(temp_path, self.file_path)
+        self.committed_raw = raw
+
+    def end_transaction(self, commit=True):
+        '''
+        Write the staged changes, or discard them by reloading from disk
+        '''
+        if not self.in_transaction:
+            return
+        self.in_transaction = False
+        if self.dirty:
+            self.dirty = False
+            if commit:
+                self.commit()
+            else:
+                self.refresh()
+
+    def set_now(self, key, val):
+        '''
+        Set and write key at once, leaving the other changes staged by a
+        transaction. For choices made in a dialog opened from the
+        configuration dialog, which cancelling it must not discard.
+        '''
+        if not self.in_transaction:
+            return self.set(key, val)
+        staged, dirty = dict(self), self.dirty
+        self.in_transaction = False
+        try:
+            # Write key over the prefs on disk, not the staged ones
+            self.refresh()
+            self.set(key, val)
+        finally:
+            self.in_transaction = True
+            self.dirty = dirty
+            staged[key] = val
+            self.clear()
+            self.update(staged)
+
+    def refresh(self, *args, **kwargs):
+        with tracer.span('prefs.read'):
+            JSONConfig.refresh(self, *args, **kwargs)
+        self.committed_raw = self.to_raw()
+
+prefs = SyncManPrefs('plugins/SyncMan')
+tracer.enabled = prefs.get('debug_plugin', False)
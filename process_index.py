@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2014, Greg Riker <griker@hotmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import os, subprocess, threading, time
+
+from calibre_plugins.syncman.common_utils import Logger
+
+# Seconds before an app with no live processes is looked for again
+DEFAULT_MISS_INTERVAL = 30
+
+# Seconds before a valid cache entry is refreshed, picking up helper
+# processes spawned since the last scan
+DEFAULT_MAX_AGE = 300
+
+
+class ProcessIndex(Logger):
+    '''
+    Map sync app paths to live pids.
+    All registered apps are matched in a single pass over the process table.
+    Cached pids are revalidated by comparing each process's start time, read
+    from /proc/<pid>/stat, so a recycled pid is never mistaken for the app.
+    Where /proc is not available the process table is read with ps, and pids
+    are revalidated by existence only. Safe to use from several threads: the
+    GUI registers apps while the controller and its pool look them up.
+    '''
+    def __init__(self, proc_root='/proc', miss_interval=DEFAULT_MISS_INTERVAL,
+                 max_age=DEFAULT_MAX_AGE, clock=time.time):
+        self.proc_root = proc_root
+        self.has_proc = os.path.isdir(os.path.join(proc_root, 'self'))
+        self.miss_interval = miss_interval
+        self.max_age = max_age
+        self.clock = clock
+
+        # {app_path: (scanned_at, [(pid, start_time), ...])}
+        self.cache = {}
+        self.app_paths = set()
+        # Guards cache and app_paths, not held while the process table is read
+        self.lock = threading.Lock()
+
+        # Counters
+        self.scans = 0
+        self.hits = 0
+
+    def invalidate(self, app_path=None):
+        '''
+        Forget cached pids for app_path, or for every app
+        '''
+        with self.lock:
+            if app_path is None:
+                self.cache.clear()
+            else:
+                self.cache.pop(app_path, None)
+
+    def is_alive(self, pid, start_time):
+        '''
+        Return True if pid is still the process started at start_time, as
+        returned by processes(). A None start_time checks existence only.
+        '''
+        if start_time is None:
+            try:
+                os.kill(pid, 0)
+            except OSError:
+                return False
+            return True
+        return self._start_time(pid) == start_time
+
+    def pids(self, app_path):
+        '''
+        Return the live pids of app_path
+        '''
+        return [pid for pid, _ in self.processes(app_path)]
+
+    def processes(self, app_path):
+        '''
+        Return [(pid, start_time)] of the live processes of app_path
+        '''
+        with self.lock:
+            self.app_paths.add(app_path)
+            entry = self.cache.get(app_path)
+        if entry is not None:
+            scanned_at, processes = entry
+            age = self.clock() - scanned_at
+            if processes:
+                if age < self.max_age and self._valid(processes):
+                    self.hits += 1
+                    return list(processes)
+            elif age < self.miss_interval:
+                self.hits += 1
+                return []
+
+        return self.scan(app_path)[app_path]
+
+    def register(self, app_paths):
+        '''
+        Set the apps matched by each scan
+        '''
+        with self.lock:
+            self.app_paths = set(app_paths)
+            for app_path in list(self.cache):
+                if app_path not in self.app_paths:
+                    del self.cache[app_path]
+
+    def start_time(self, pid):
+        '''
+        Return the start time of pid for is_alive(), None where it cannot be
+        read and only the pid's existence can be checked
+        '''
+        return self._start_time(pid) if self.has_proc else None
+
+    def scan(self, include=None):
+        '''
+        Match every process against the registered apps, and include, in one
+        pass. Returns {app_path: [(pid, start_time), ...]}.
+        '''
+        self.scans += 1
+        with self.lock:
+            app_paths = set(self.app_paths)
+        if include is not None:
+            app_paths.add(include)
+        matchers = []
+        for app_path in app_paths:
+            real_path = os.path.realpath(app_path)
+            matchers.append((app_path, real_path, real_path.rstrip(os.sep) + os.sep))
+        found = dict((app_path, []) for app_path in app_paths)
+
+        for pid, exe, start_time in self._processes():
+            for app_path, real_path, app_dir in matchers:
+                if exe == real_path or exe.startswith(app_dir):
+                    found[app_path].append((pid, start_time))
+                    break
+
+        now = self.clock()
+        with self.lock:
+            # Apps unregistered meanwhile are not cached again
+            for app_path, processes in found.items():
+                if app_path in self.app_paths:
+                    self.cache[app_path] = (now, processes)
+        return found
+
+    # Helpers
+    def _processes(self):
+        '''
+        Yield (pid, exe, start_time) for every visible process except our own
+        '''
+        own_pid = os.getpid()
+        if self.has_proc:
+            for entry in os.listdir(self.proc_root):
+                if not entry.isdigit() or int(entry) == own_pid:
+                    continue
+                pid = int(entry)
+                try:
+                    exe = os.readlink(os.path.join(self.proc_root, entry, 'exe'))
+                except OSError:
+                    # Gone, or owned by another user
+                    continue
+                start_time = self._start_time(pid)
+                if start_time is not None:
+                    yield pid, exe, start_time
+        else:
+            try:
+                output = subprocess.check_output(['ps', '-axo', 'pid=,comm='])
+            except (OSError, subprocess.CalledProcessError):
+                self._log_location("unable to list processes")
+                return
+            for line in output.decode('utf-8', 'replace').splitlines():
+                pid, _, exe = line.strip().partition(' ')
+                if pid.isdigit() and int(pid) != own_pid:
+                    yield int(pid), exe.strip(), None
+
+    def _start_time(self, pid):
+        '''
+        Start time of pid in clock ticks since boot, field 22 of
+        /proc/<pid>/stat. The command name may contain spaces and parens, so
+        fields are counted from the last ')'.
+        '''
+        try:
+            with open(os.path.join(self.proc_root, str(pid), 'stat'), 'rb') as f:
+                stat = f.read()
+        except (IOError, OSError):
+            return None
+        return int(stat.rpartition(b')')[2].split()[19])
+
+    def _valid(self, processes):
+        return all(self.is_alive(pid, start_time) for pid, start_time in processes)
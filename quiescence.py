@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2014, Greg Riker <griker@hotmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import os, time
+
+from calibre_plugins.syncman.common_utils import Logger
+
+# Default I/O rate in bytes per second, summed over an app's processes,
+# below which the app is considered idle. rchar and wchar include socket
+# traffic, so uploads count.
+DEFAULT_QUIET_RATE = 16 * 1024
+
+# Default CPU use, as a fraction of one core, below which an app is idle
+DEFAULT_QUIET_CPU = 0.02
+
+# Default seconds every app must stay idle before they are quiescent
+DEFAULT_QUIET_WINDOW = 30
+
+# Bounds on the adaptive sampling interval, in seconds
+MIN_SAMPLE_INTERVAL = 1
+MAX_SAMPLE_INTERVAL = 30
+
+try:
+    CLOCK_TICKS = os.sysconf(str('SC_CLK_TCK'))
+except (AttributeError, ValueError, OSError):
+    CLOCK_TICKS = 100
+
+
+class QuiescenceMonitor(Logger):
+    '''
+    Tell when the sync apps have finished uploading after a resume.
+    sample() reads /proc/<pid>/io and the CPU times in /proc/<pid>/stat of
+    each app's processes, and returns the seconds until the next sample. The
+    apps are quiescent once each has stayed below quiet_rate and quiet_cpu
+    for quiet_window seconds. The interval starts at MIN_SAMPLE_INTERVAL
+    and doubles while nothing changes, up to MAX_SAMPLE_INTERVAL, but never
+    beyond the end of the quiet window. A sample reads two small files per
+    process, so monitoring can run all session long.
+    '''
+    def __init__(self, quiet_rate=DEFAULT_QUIET_RATE, quiet_cpu=DEFAULT_QUIET_CPU,
+                 quiet_window=DEFAULT_QUIET_WINDOW, proc_root='/proc', clock=time.time):
+        self.quiet_rate = quiet_rate
+        self.quiet_cpu = quiet_cpu
+        self.quiet_window = quiet_window
+        self.proc_root = proc_root
+        self.supported = os.path.isdir(os.path.join(proc_root, 'self'))
+        self.clock = clock
+        self.reset()
+
+        # Counters
+        self.samples = 0
+
+    def counters(self, pid):
+        '''
+        Return (I/O bytes, CPU seconds) of pid so far, or None if it has gone
+        '''
+        base = os.path.join(self.proc_root, str(pid))
+        try:
+            io_bytes = 0
+            with open(os.path.join(base, 'io'), 'rb') as f:
+                for line in f:
+                    if line.startswith((b'rchar:', b'wchar:')):
+                        io_bytes += int(line.split()[1])
+            with open(os.path.join(base, 'stat'), 'rb') as f:
+                # Fields after the parenthesized command name, from state
+                fields = f.read().rsplit(b')', 1)[1].split()
+            cpu = (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+        except (EnvironmentError, IndexError, ValueError):
+            return None
+        return io_bytes, cpu
+
+    def reset(self):
+        '''
+        Start over, e.g. after the apps were resumed
+        '''
+        # {pid: (sampled_at, io_bytes, cpu_seconds)}
+        self.previous = {}
+        self.busy_at = self.clock()
+        self.busy = True
+        self.quiescent = False
+        self.interval = MIN_SAMPLE_INTERVAL
+        self.rates = {}
+
+    def sample(self, app_pids, reported_busy=()):
+        '''
+        Sample the processes of {app_name: [pid, ...]}. The apps in
+        reported_busy have told us they are still syncing, and count as busy
+        whatever their rates. Returns {'quiescent', 'quiet_for', 'rates':
+        {app_name: (bytes/s, cpu fraction)}, 'interval'}, or None where /proc
+        is not available.
+        '''
+        if not self.supported:
+            return None
+        now = self.clock()
+        self.samples += 1
+
+        current = {}
+        rates = {}
+        busy = False
+        for name, pids in app_pids.items():
+            io_rate = cpu_rate = 0.0
+            for pid in pids:
+                counters = self.counters(pid)
+                if counters is None:
+                    continue
+                current[pid] = (now,) + counters
+                prev = self.previous.get(pid)
+                if prev is None or now <= prev[0]:
+                    # First sight of this process, its rate is not known yet
+                    continue
+                elapsed = now - prev[0]
+                io_rate += max(0, counters[0] - prev[1]) / elapsed
+                cpu_rate += max(0, counters[1] - prev[2]) / elapsed
+            rates[name] = (io_rate, cpu_rate)
+            if (io_rate >= self.quiet_rate or cpu_rate >= self.quiet_cpu or
+                    name in reported_busy):
+                busy = True
+        # A process seen for the first time may be busy
+        new_processes = any(pid not in self.previous for pid in current)
+        busy = busy or new_processes
+        self.previous = current
+        self.rates = rates
+
+        was_quiescent = self.quiescent
+        if busy:
+            self.busy_at = now
+        quiet_for = now - self.busy_at
+        self.quiescent = quiet_for >= self.quiet_window
+
+        if busy != self.busy:
+            # Something changed, look again soon
+            self.interval = MIN_SAMPLE_INTERVAL
+        else:
+            self.interval = min(self.interval * 2, MAX_SAMPLE_INTERVAL)
+        self.busy = busy
+        if not self.quiescent:
+            # Sample again as the quiet window would end
+            self.interval = max(MIN_SAMPLE_INTERVAL,
+                                min(self.interval, self.quiet_window - quiet_for))
+        if self.quiescent != was_quiescent:
+            self._log("sync apps {0} after {1} samples: {2}",
+                      "quiescent" if self.quiescent else "busy", self.samples, rates)
+
+        return {'quiescent': self.quiescent, 'quiet_for': quiet_for,
+                'rates': rates, 'interval': self.interval}
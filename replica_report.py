@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2014, Greg Riker <griker@hotmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import os, threading, time
+
+from calibre.gui2.ui import get_gui
+
+from calibre_plugins.syncman.common_utils import Logger, load_form
+from calibre_plugins.syncman.manifest import ChecksumManifest
+from calibre_plugins.syncman.prefs import prefs
+
+from PyQt4.Qt import (QDialog, QDialogButtonBox, QFileDialog, QHeaderView,
+                      QTableWidgetItem, pyqtSignal)
+
+# Import Ui_Dialog from replica_report.ui. This module is only imported by
+# ConfigWidget.show_replica_report(), so the form is compiled on first use
+Ui_Dialog = load_form('replica_report')
+
+# Table text of each problem ChecksumManifest.compare() reports
+PROBLEMS = {
+    'missing': "Missing",
+    'extra': "Not in library",
+    'size': "Size differs",
+    'checksum': "Contents differ",
+    'unreadable': "Unreadable",
+    }
+
+
+class ReplicaReport(QDialog, Ui_Dialog, Logger):
+    '''
+    Compare a replica of the current library, such as the copy a sync app
+    keeps on another machine, with the library's checksum manifest. The
+    manifest is updated and the replica hashed on a worker thread. The last
+    replica chosen is remembered in prefs['replica_folder'] and verified
+    when the dialog opens.
+    '''
+    # Delivers verify results from the worker thread
+    verify_complete = pyqtSignal(object)
+
+    def __init__(self, parent, library_path):
+        self._log_location(library_path)
+        self.gui = get_gui()
+        QDialog.__init__(self, parent)
+        self.setupUi(self)
+
+        self.manifest = ChecksumManifest(library_path)
+        self.replica_path = prefs.get('replica_folder', '')
+        self.verifying = False
+        self.verify_complete.connect(self.show_problems)
+
+        self.choose_button = self.bb.addButton("Choose replica...", QDialogButtonBox.ActionRole)
+        self.choose_button.clicked.connect(self.choose_replica)
+        self.verify_button = self.bb.addButton("Verify", QDialogButtonBox.ActionRole)
+        self.verify_button.clicked.connect(self.verify)
+        self.bb.rejected.connect(self.reject)
+
+        self.problems_tw.horizontalHeader().setResizeMode(1, QHeaderView.Stretch)
+        if os.path.isdir(self.replica_path):
+            self.verify()
+        else:
+            self.verify_button.setEnabled(False)
+
+    def choose_replica(self):
+        '''
+        Browse for the replica folder, and verify it
+        '''
+        folder = unicode(QFileDialog.getExistingDirectory(
+            self, "Select replica folder", self.replica_path or os.path.expanduser("~")))
+        if not folder:
+            return
+        if os.path.abspath(folder) == os.path.abspath(self.manifest.library_path):
+            self.summary_label.setText("Choose a copy of the library, not the library itself")
+            return
+        self.replica_path = folder
+        prefs.set_now('replica_folder', folder)
+        self.verify()
+
+    def show_problems(self, result):
+        '''
+        Fill the table with the comparison results
+        '''
+        stats, elapsed = result
+        self.verifying = False
+        self.choose_button.setEnabled(True)
+        self.verify_button.setEnabled(True)
+        if stats is None:
+            self.summary_label.setText("Unable to verify {0}".format(self.replica_path))
+            return
+        update, compare = stats
+
+        problems = compare['problems']
+        self.summary_label.setText(
+            "{0}: {1} problems. {2} library files, {3} hashed since the last check; "
+            "{4} replica files hashed ({5:.1f} MB). Verified in {6:.2f} s".format(
+                self.replica_path, len(problems), update['files'], update['hashed'],
+                compare['checked'], compare['bytes'] / (1024 * 1024), elapsed))
+
+        self.problems_tw.setSortingEnabled(False)
+        self.problems_tw.setRowCount(len(problems))
+        for row, (path, problem, detail) in enumerate(problems):
+            self.problems_tw.setItem(row, 0, QTableWidgetItem(PROBLEMS.get(problem, problem)))
+            self.problems_tw.setItem(row, 1, QTableWidgetItem(path))
+            self.problems_tw.setItem(row, 2, QTableWidgetItem(detail))
+        self.problems_tw.resizeColumnsToContents()
+        self.problems_tw.horizontalHeader().setResizeMode(1, QHeaderView.Stretch)
+        self.problems_tw.setSortingEnabled(True)
+
+    def verify(self):
+        '''
+        Update the manifest and compare the replica on a worker thread
+        '''
+        if self.verifying or not self.replica_path:
+            return
+        self.verifying = True
+        self.choose_button.setEnabled(False)
+        self.verify_button.setEnabled(False)
+        self.summary_label.setText("Verifying {0}...".format(self.replica_path))
+        replica_path = self.replica_path
+
+        def verify():
+            started = time.time()
+            try:
+                stats = (self.manifest.update(), self.manifest.compare(replica_path))
+            except Exception as e:
+                self._log("replica verify failed: {0}", e)
+                stats = None
+            try:
+                self.verify_complete.emit((stats, time.time() - started))
+            except RuntimeError:
+                # The dialog was closed while verifying
+                pass
+
+        thread = threading.Thread(target=verify, name='SyncMan replica verify')
+        thread.daemon = True
+        thread.start()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2014, Greg Riker <griker@hotmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import os, shutil, time
+
+from calibre.utils.filenames import atomic_rename
+
+from calibre_plugins.syncman.common_utils import Logger
+from calibre_plugins.syncman.tracing import tracer
+
+try:
+    import apsw
+except ImportError:
+    apsw = None
+
+# Default minimum interval in seconds between published snapshots
+DEFAULT_SNAPSHOT_INTERVAL = 900
+
+SNAPSHOT_NAME = 'metadata.db'
+
+
+def backup_database(src_path, dest_path):
+    '''
+    Copy the SQLite database at src_path to dest_path with the online backup
+    API, which yields a consistent copy even while calibre holds the database
+    open. calibre ships apsw; the sqlite3 module only has a backup API from
+    Python 3.7. Without either the file is copied, which is consistent as
+    snapshots are taken after the library has been quiet for a while, unless
+    a journal shows calibre is still in a transaction.
+    '''
+    if apsw is not None:
+        src = apsw.Connection(src_path, flags=apsw.SQLITE_OPEN_READONLY)
+        dest = apsw.Connection(dest_path)
+        try:
+            with dest.backup('main', src, 'main') as backup:
+                while not backup.done:
+                    backup.step(-1)
+        finally:
+            dest.close()
+            src.close()
+        return
+
+    import sqlite3
+    if not hasattr(sqlite3.Connection, 'backup'):
+        for journal in (src_path + '-journal', src_path + '-wal'):
+            if os.path.exists(journal) and os.path.getsize(journal):
+                raise EnvironmentError("{0} has uncommitted changes in {1}".format(
+                    src_path, journal))
+        shutil.copyfile(src_path, dest_path)
+        return
+
+    src = sqlite3.connect(src_path)
+    dest = sqlite3.connect(dest_path)
+    try:
+        src.backup(dest)
+    finally:
+        dest.close()
+        src.close()
+
+
+class SnapshotPublisher(Logger):
+    '''
+    Publish a consistent copy of the library's metadata.db into a synced
+    folder, so the live database can be kept out of the synced set.
+    publish() is called at the end of a pause window, while the sync apps are
+    still suspended, and does nothing unless snapshot_interval seconds have
+    passed since the last snapshot. The copy is written beside its
+    destination and renamed into place, so the sync app never sees a partial
+    file.
+    '''
+    def __init__(self, prefs, clock=time.time):
+        self.prefs = prefs
+        self.clock = clock
+        self.last_published = 0
+        self.published = 0
+
+    @property
+    def enabled(self):
+        return bool(self.prefs.get('snapshot_mode', False) and
+                    self.prefs.get('snapshot_folder', ''))
+
+    def due(self):
+        interval = self.prefs.get('snapshot_interval', DEFAULT_SNAPSHOT_INTERVAL)
+        return self.clock() - self.last_published >= interval
+
+    def publish(self, library_path, force=False):
+        '''
+        Publish library_path/metadata.db if enabled and due.
+        Returns the path of the published snapshot, or None.
+        '''
+        if not self.enabled or not (force or self.due()):
+            return None
+
+        src_path = os.path.join(library_path, 'metadata.db')
+        folder = self.prefs.get('snapshot_folder')
+        if not os.path.exists(src_path) or not os.path.isdir(folder):
+            self._log("unable to publish {0} to {1}", src_path, folder)
+            return None
+        if os.path.realpath(folder) == os.path.realpath(library_path):
+            self._log_location("snapshot folder is the library folder")
+            return None
+
+        dest_path = os.path.join(folder, SNAPSHOT_NAME)
+        temp_path = os.path.join(folder, '.' + SNAPSHOT_NAME + '.syncman')
+        with tracer.span('publish_snapshot'):
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            try:
+                backup_database(src_path, temp_path)
+            except Exception as e:
+                self._log("snapshot of {0} failed: {1}", src_path, e)
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                return None
+            atomic_rename(temp_path, dest_path)
+
+        self.last_published = self.clock()
+        self.published += 1
+        self._log_location(dest_path)
+        return dest_path
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2014, Greg Riker <griker@hotmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import os, shutil, threading
+
+from calibre.utils.filenames import atomic_rename
+
+from calibre_plugins.syncman.common_utils import Logger
+from calibre_plugins.syncman.snapshot import SNAPSHOT_NAME, backup_database
+from calibre_plugins.syncman.tracing import tracer
+
+# Suffix of copies in progress in the staging folder
+PART_SUFFIX = '.part'
+
+# Library paths removed since the last commit, one per line, in the staging
+# folder. Renamed to TOMBSTONES + PART_SUFFIX while a commit applies them.
+TOMBSTONES = '.syncman_removed'
+
+# Files SQLite creates beside metadata.db while it is open
+SQLITE_TRANSIENTS = ('-journal', '-wal', '-shm')
+
+
+def is_mirrored(path):
+    '''
+    Select the library files copied to the mirror
+    '''
+    return not (path.startswith(SNAPSHOT_NAME) and
+                path[len(SNAPSHOT_NAME):] in SQLITE_TRANSIENTS)
+
+
+class StagingArea(Logger):
+    '''
+    Mirror the library into a synced folder, so the sync app only ever sees
+    complete files. The live library is kept out of the synced folder.
+    stage() copies changed library files into a staging folder which is not
+    synced, but is on the same filesystem as the mirror. commit() renames the
+    staged files into the mirror and removes deleted ones, and is called
+    while the sync apps are suspended, so each file is uploaded once, whole.
+    metadata.db is staged with the SQLite backup API.
+
+    Staged files survive a restart: copies are written as name.part and only
+    renamed to name when complete, so anything else in the staging folder is
+    ready to commit. Removals are appended to TOMBSTONES, so they survive too.
+    '''
+    def __init__(self, prefs):
+        self.prefs = prefs
+        self.lock = threading.Lock()
+        # {relative path: True to copy in, False to remove from the mirror}
+        self.batch = None
+        self.committed = 0
+
+    @property
+    def enabled(self):
+        return bool(self.prefs.get('staging_mode', False) and
+                    self.mirror_folder and self.staging_folder)
+
+    @property
+    def mirror_folder(self):
+        return self.prefs.get('mirror_folder', '')
+
+    @property
+    def pending(self):
+        with self.lock:
+            if self.batch is None:
+                self.batch = self.recover()
+            return len(self.batch)
+
+    @property
+    def staging_folder(self):
+        return self.prefs.get('staging_folder', '')
+
+    def check(self, library_path):
+        '''
+        Return why the folders cannot be used for library_path, or None
+        '''
+        mirror, staging = self.mirror_folder, self.staging_folder
+        for folder in (mirror, staging):
+            if not os.path.isdir(folder):
+                return "{0} is not a folder".format(folder)
+        real = [os.path.realpath(p) + os.sep for p in (library_path, mirror, staging)]
+        for i, a in enumerate(real):
+            for b in real[i + 1:]:
+                if a.startswith(b) or b.startswith(a):
+                    return "the library, mirror and staging folders must not overlap"
+        if self.prefs.get('mirror_library') != library_path:
+            return "the mirror folder belongs to another library"
+        if os.stat(mirror).st_dev != os.stat(staging).st_dev:
+            return "the staging folder must be on the same drive as the mirror folder"
+        return None
+
+    def commit(self):
+        '''
+        Move the staged files into the mirror. The sync apps must be
+        suspended. Returns the number of files committed.
+        '''
+        tombstones = os.path.join(self.staging_folder, TOMBSTONES)
+        with self.lock:
+            batch = self.recover() if self.batch is None else self.batch
+            self.batch = {}
+            if os.path.exists(tombstones):
+                # Removals staged from now on go to a new file
+                atomic_rename(tombstones, tombstones + PART_SUFFIX)
+        if not batch:
+            return 0
+
+        mirror, staging = self.mirror_folder, self.staging_folder
+        with tracer.span('staging.commit'):
+            for path in sorted(batch):
+                dest = os.path.join(mirror, *path.split('/'))
+                try:
+                    if batch[path]:
+                        parent = os.path.dirname(dest)
+                        if not os.path.isdir(parent):
+                            os.makedirs(parent)
+                        src = os.path.join(staging, *path.split('/'))
+                        atomic_rename(src, dest)
+                        self.remove_empty_dirs(os.path.dirname(src), staging)
+                    elif os.path.exists(dest):
+                        os.remove(dest)
+                        self.remove_empty_dirs(os.path.dirname(dest), mirror)
+                except EnvironmentError as e:
+                    self._log("unable to commit {0}: {1}", path, e)
+            if os.path.exists(tombstones + PART_SUFFIX):
+                os.remove(tombstones + PART_SUFFIX)
+
+        self.committed += len(batch)
+        self._log_location("{0} files".format(len(batch)))
+        return len(batch)
+
+    def needs_full_copy(self):
+        '''
+        True if nothing has been mirrored or staged yet
+        '''
+        return not self.pending and not os.listdir(self.mirror_folder)
+
+    def recover(self):
+        '''
+        Return the batch of complete files and removals left in the staging
+        folder by a previous session, discarding partial copies
+        '''
+        batch = {}
+        staging = self.staging_folder
+        tombstones = os.path.join(staging, TOMBSTONES)
+        # The removals of an interrupted commit first, then the newer ones
+        for fs in (tombstones + PART_SUFFIX, tombstones):
+            if os.path.exists(fs):
+                with open(fs, 'rb') as f:
+                    for path in f.read().decode('utf-8').splitlines():
+                        if path:
+                            batch[path] = False
+        for root, dirs, files in os.walk(staging):
+            for name in files:
+                fs = os.path.join(root, name)
+                if fs.startswith(tombstones):
+                    continue
+                if name.endswith(PART_SUFFIX):
+                    os.remove(fs)
+                else:
+                    batch[os.path.relpath(fs, staging).replace(os.sep, '/')] = True
+        return batch
+
+    def remove_empty_dirs(self, path, stop):
+        '''
+        Remove path and its parents below stop while they are empty
+        '''
+        stop = os.path.realpath(stop)
+        while os.path.realpath(path) != stop and not os.listdir(path):
+            os.rmdir(path)
+            path = os.path.dirname(path)
+
+    def stage(self, library_path, changed, removed):
+        '''
+        Copy the changed library files into the staging folder, and note the
+        removed ones. Returns the paths that changed again while being copied,
+        which the caller should rescan. Safe to call from a worker thread.
+        '''
+        staging = self.staging_folder
+        unstable = []
+        staged = {}
+        with self.lock:
+            if self.batch is None:
+                self.batch = self.recover()
+        with tracer.span('staging.stage'):
+            for path in changed:
+                if not is_mirrored(path):
+                    continue
+                src = os.path.join(library_path, *path.split('/'))
+                dest = os.path.join(staging, *path.split('/'))
+                temp_path = dest + PART_SUFFIX
+                try:
+                    parent = os.path.dirname(dest)
+                    if not os.path.isdir(parent):
+                        os.makedirs(parent)
+                    if path == SNAPSHOT_NAME:
+                        backup_database(src, temp_path)
+                    else:
+                        before = os.stat(src)
+                        shutil.copy2(src, temp_path)
+                        after = os.stat(src)
+                        if (before.st_size, before.st_mtime) != (after.st_size, after.st_mtime):
+                            os.remove(temp_path)
+                            unstable.append(path)
+                            continue
+                    atomic_rename(temp_path, dest)
+                    staged[path] = True
+                except Exception as e:
+                    # Deleted since the scan, or being written by calibre
+                    self._log("unable to stage {0}: {1}", path, e)
+                    if os.path.exists(temp_path):
+                        os.remove(temp_path)
+                    unstable.append(path)
+            for path in removed:
+                if is_mirrored(path):
+                    staged[path] = False
+                    fs = os.path.join(staging, *path.split('/'))
+                    if os.path.exists(fs):
+                        os.remove(fs)
+
+        with self.lock:
+            self.batch.update(staged)
+            removals = [path for path, copy in staged.items() if not copy]
+            if removals:
+                with open(os.path.join(staging, TOMBSTONES), 'ab') as f:
+                    f.write(''.join(path + '\n' for path in removals).encode('utf-8'))
+        return unstable
@@ -8,34 +8,41 @@ __license__ = 'GPL v3'
 __copyright__ = '2014, Gregory Riker <griker@hotmail.com>'
 __docformat__ = 'restructuredtext en'
 
-import os, sys
+import os, threading
 
+from calibre.constants import isosx, iswindows
 from calibre.gui2.ui import get_gui
 
-from calibre_plugins.syncman.action import plugin_resources_path
-from calibre_plugins.syncman.common_utils import Logger
+from calibre_plugins.syncman.common_utils import Logger, load_form
+from calibre_plugins.syncman.prefs import prefs
 
-from PyQt4.Qt import (QDialog, QDialogButtonBox, QFileDialog, QIcon, QPixmap,
-                      QSize)
+from PyQt4.Qt import (QCompleter, QDialog, QDialogButtonBox, QFileDialog, QIcon,
+                      QPixmap, QSize, QTimer, pyqtSignal)
 
-# Import Ui_Form from form generated dynamically during initialization
-if True:
-    sys.path.insert(0, plugin_resources_path)
-    from sync_app_wizard_ui import Ui_Dialog
-    sys.path.remove(plugin_resources_path)
+# Import Ui_Dialog from sync_app_wizard.ui. This module is only imported by
+# ConfigWidget.add_service(), so the form is compiled on first use
+Ui_Dialog = load_form('sync_app_wizard')
+
+
+# Milliseconds after the last keystroke before the path is validated
+VALIDATE_DELAY = 300
 
 
 class SyncAppWizard(QDialog, Ui_Dialog, Logger):
 
     YELLOW_BG = '<font style="background:#FDFF99">{0}</font>'
 
-    def __init__(self, parent, verbose=True):
+    # Delivers (path, exists) from the thread checking a typed path
+    path_checked = pyqtSignal(object, bool)
+
+    def __init__(self, parent, verbose=True, discovery=None):
         self._log_location()
         self.gui = get_gui()
         QDialog.__init__(self, self.gui)
 
         self.setupUi(self)
         self.verbose = verbose
+        self.discovery = discovery
 
         """
         # Populate the icon
@@ -61,14 +68,21 @@ class SyncAppWizard(QDialog, Ui_Dialog, Logger):
         self.browser_tb.setIcon(QIcon(I('document_open.png')))
         self.browser_tb.clicked.connect(self.get_sync_app_fs)
 
-        # Hook the sync_app edit controls
-        self.sync_app_path_le.textChanged.connect(self.validate_sync_app)
-        self.app_name_le.textChanged.connect(self.validate_sync_app)
+        # Offer the sync apps found by discovery, without touching the disk
+        self.prefill()
+
+        # Hook the sync_app edit controls, validating once typing pauses
+        self.validate_timer = QTimer(self)
+        self.validate_timer.setSingleShot(True)
+        self.validate_timer.setInterval(VALIDATE_DELAY)
+        self.validate_timer.timeout.connect(self.validate_sync_app)
+        self.sync_app_path_le.textChanged.connect(self.schedule_validation)
+        self.app_name_le.textChanged.connect(self.schedule_validation)
+        self.path_checked.connect(self.sync_app_checked)
 
         # Disable OK button until we have a valid app path and name
         self.validate_sync_app()
 
-
     def accept(self):
         self._log_location()
         super(SyncAppWizard, self).accept()
@@ -97,11 +111,17 @@ class SyncAppWizard(QDialog, Ui_Dialog, Logger):
         Get path to selected sync_app
         '''
         self._log_location()
+        if isosx:
+            app_filter = "*.app"
+        elif iswindows:
+            app_filter = "Programs (*.exe)"
+        else:
+            app_filter = ""
         sync_app = unicode(QFileDialog.getOpenFileName(
             self.gui,
             "Select sync app",
             os.path.expanduser("~"),
-            "*.app").toUtf8())
+            app_filter))
         if sync_app:
             # Populate the filespec edit control
             self._log(sync_app)
@@ -120,11 +140,64 @@ class SyncAppWizard(QDialog, Ui_Dialog, Logger):
             #self.step_1.setText(self.YELLOW_BG.format(self.STEP_ONE.format(self.column_type)))
             self.step_1.setText(self.STEP_ONE.format(self.column_type))
 
+    def prefill(self):
+        '''
+        Fill in the first discovered sync app not configured yet, and offer
+        all discovered apps as completions
+        '''
+        if self.discovery is None:
+            return
+        found = self.discovery.found()
+        self.sync_app_path_le.setCompleter(
+            QCompleter([path for name, path in found], self))
+        configured = set(prefs.get('sync_apps', {}).values())
+        for name, path in found:
+            if path not in configured:
+                self.sync_app_path_le.setText(path)
+                self.app_name_le.setText(name)
+                break
+
+    def schedule_validation(self, *args):
+        '''
+        Restart the validation delay on each keystroke
+        '''
+        self.validate_timer.start()
+
+    def sync_app_checked(self, path, exists):
+        '''
+        A path check finished, applied if the path has not been edited since
+        '''
+        if path == unicode(self.sync_app_path_le.text()):
+            self.accept_button.setEnabled(exists and bool(self.app_name_le.text()))
+
     def validate_sync_app(self, *args):
         '''
-        Confirm length of sync_app name > 0 and app is a valid file
+        Confirm length of sync_app name > 0 and app is a valid file.
+        Paths not in the discovery cache are checked on a worker thread.
         '''
-        app_exists = os.path.exists(str(self.sync_app_path_le.text()))
+        path = unicode(self.sync_app_path_le.text())
         app_name = self.app_name_le.text()
-        enabled = app_exists and len(app_name)
-        self.accept_button.setEnabled(enabled)
+        if not path or not app_name:
+            self.accept_button.setEnabled(False)
+            return
+
+        exists = self.discovery.is_cached(path) if self.discovery is not None else None
+        if exists is not None:
+            self.accept_button.setEnabled(exists)
+            return
+
+        self.accept_button.setEnabled(False)
+        check = self.discovery.check if self.discovery is not None else os.path.exists
+
+        def check_path():
+            exists = check(path)
+            try:
+                self.path_checked.emit(path, exists)
+            except RuntimeError:
+                # The wizard was closed during the check
+                pass
+
+        thread = threading.Thread(target=check_path, name='SyncMan path check')
+        thread.daemon = True
+        thread.start()
+
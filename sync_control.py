@@ -0,0 +1,414 @@
+#!/usr/bin/env python
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2014, Greg Riker <griker@hotmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import signal, threading, time
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+
+from calibre_plugins.syncman.common_utils import Logger
+from calibre_plugins.syncman.drivers import driver_for, driver_provider
+from calibre_plugins.syncman.process_index import ProcessIndex
+from calibre_plugins.syncman.tracing import tracer
+
+# Default quiet period in seconds after the last library write before the
+# sync app is resumed
+DEFAULT_RESUME_DELAY = 10
+
+# Default hard limit in seconds on a single pause window, so cloud copies are
+# never more than this stale
+DEFAULT_MAX_PAUSE = 300
+
+# Default time in seconds after a window closes during which library changes
+# do not open a new window, giving the sync app a chance to catch up
+DEFAULT_PAUSE_COOLDOWN = 30
+
+# Default upload rate in bytes per second assumed for the sync app. The
+# cooldown is extended by the time needed to upload what a window wrote.
+DEFAULT_UPLOAD_RATE = 1024 * 1024
+
+# Upper bound on the threads suspending and resuming sync apps
+MAX_WORKERS = 8
+
+
+def active_sync_apps(prefs, library_path=None):
+    '''
+    Return {app_name: app_path} of the sync apps checked in the dialog, for
+    library_path if it has a profile of its own
+    '''
+    sync_apps = prefs.get('sync_apps', {})
+    profile = library_profile(prefs, library_path)
+    if profile is not None:
+        names = profile.get('active_sync_apps', [])
+    else:
+        names = prefs.get('active_sync_apps', None)
+    if names is None:
+        # Prefs saved before several apps could be active
+        sync_app = prefs.get('sync_app', '')
+        names = [sync_app] if sync_app else []
+    return dict((name, sync_apps[name]) for name in names if name in sync_apps)
+
+
+def library_profile(prefs, library_path):
+    '''
+    Return the settings of library_path from prefs['library_profiles'], or
+    None if it uses the global settings. A profile with no active sync
+    apps marks a local-only library.
+    '''
+    if library_path is None:
+        return None
+    return prefs.get('library_profiles', {}).get(library_path)
+
+
+class SuspensionEngine(Logger):
+    '''
+    Stop the processes of the active sync apps while calibre rewrites the
+    library, continue them afterwards. Each app is controlled by its
+    driver. Apps are suspended and resumed in parallel on a thread pool, so
+    the latency of an operation is that of the slowest app. This module is
+    kept free of GUI imports.
+    command_line, if given, is cli.CommandLineControl: the processes held by
+    a command line pause are neither stopped nor continued here, so calibre
+    never ends a nightly job's pause early.
+    '''
+    def __init__(self, prefs, process_index=None, report=None, command_line=None):
+        self.prefs = prefs
+        self.process_index = process_index or ProcessIndex()
+        # Called with (operation, {app_name: result}) after each operation
+        self.report = report
+        self.command_line = command_line
+        self.pool = None
+        # {app_name: [pid, ...]} of the processes we have stopped, and the
+        # drivers that stopped them
+        self.suspended = {}
+        self.suspended_drivers = {}
+        # Set as calibre exits, no process is stopped after that
+        self.closed = False
+        # Library whose profile selects the apps, and the resolved
+        # (library_path, profile, {app_name: app_path}, {app_name: driver}),
+        # replaced whole so other threads never see it half updated. The GUI,
+        # controller and scanning threads all resolve, the lock lets only one
+        # of them rebuild the drivers.
+        self.library_path = None
+        self.resolved = None
+        self.drivers_kept = {}
+        self.resolve_lock = threading.Lock()
+
+    @property
+    def is_suspended(self):
+        return bool(self.suspended)
+
+    @property
+    def local_only(self):
+        '''
+        True if the current library's profile has no sync apps
+        '''
+        library_path, profile, apps, drivers = self.resolve()
+        return profile is not None and not apps
+
+    def active_apps(self):
+        '''
+        Return {app_name: app_path} of the sync apps to manage
+        '''
+        return dict(self.resolve()[2])
+
+    def close(self):
+        '''
+        Release the worker pool, refusing further suspend()s
+        '''
+        self.closed = True
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+        with self.resolve_lock:
+            for driver in self.drivers_kept.values():
+                driver.close()
+
+    def drivers(self):
+        '''
+        Return {app_name: driver} of the sync apps to manage
+        '''
+        return dict(self.resolve()[3])
+
+    def find_pids(self, app_path):
+        '''
+        Return the pids of processes whose executable is app_path or lives
+        inside it, e.g. an OS X application bundle or ~/.dropbox-dist
+        '''
+        return self.process_index.pids(app_path)
+
+    def resolve(self):
+        '''
+        Return (library_path, profile, {app_name: app_path}, {app_name:
+        driver}) of the current library, resolved from prefs once per
+        set_library(). Drivers still suited to an app are kept, with any
+        connection they hold.
+        '''
+        resolved = self.resolved
+        if resolved is not None and resolved[0] == self.library_path:
+            return resolved
+        with self.resolve_lock:
+            # Another thread may have rebuilt while we waited
+            resolved = self.resolved
+            if resolved is not None and resolved[0] == self.library_path:
+                return resolved
+            library_path = self.library_path
+            apps = active_sync_apps(self.prefs, library_path)
+            old = self.drivers_kept
+            drivers = {}
+            for name, path in apps.items():
+                driver = old.get(name)
+                if (driver is None or driver.app_path != path or
+                        driver.provider != driver_provider(name, path, self.prefs)):
+                    driver = driver_for(name, path, self.process_index, self.prefs)
+                drivers[name] = driver
+            for name, driver in old.items():
+                if drivers.get(name) is not driver:
+                    driver.close()
+            self.drivers_kept = drivers
+            resolved = self.resolved = (
+                library_path, library_profile(self.prefs, library_path), apps, drivers)
+        return resolved
+
+    def resume(self):
+        '''
+        Continue every process stopped by suspend().
+        Returns {app_name: result}, see SyncDriver.pause().
+        '''
+        jobs = [(name, self.suspended_drivers[name], pids, 'resume')
+                for name, pids in self.suspended.items()]
+        self.suspended = {}
+        self.suspended_drivers = {}
+        with self._command_line_held() as held, tracer.span('resume'):
+            results = self._run([(name, driver, [pid for pid in pids if pid not in held], op)
+                                 for name, driver, pids, op in jobs])
+        if results:
+            self._log_location(results)
+        if self.report is not None:
+            self.report('resume', results)
+        return results
+
+    def set_library(self, library_path=None):
+        '''
+        Manage the sync apps of library_path's profile. Also called with
+        the current library after prefs change.
+        '''
+        # Waits for a rebuild in progress, which may have read the old prefs
+        with self.resolve_lock:
+            self.library_path = library_path
+            self.resolved = None
+
+    def suspend(self):
+        '''
+        Stop the processes of every active sync app.
+        Returns {app_name: result}, see SyncDriver.pause().
+        '''
+        if self.suspended or self.closed:
+            return {}
+
+        apps = self.active_apps()
+        if not apps:
+            return {}
+        drivers = self.drivers()
+
+        if not hasattr(signal, 'SIGSTOP'):
+            self._log_location("suspending processes is not supported on this platform")
+            return {}
+
+        # Resolve pids here: all apps are matched in a single index scan
+        self.process_index.register(apps.values())
+        with self._command_line_held() as held, tracer.span('suspend'):
+            jobs = [(name, drivers[name], [pid for pid in drivers[name].pids() if pid not in held],
+                     'pause') for name in apps]
+            results = self._run(jobs)
+        for name, result in results.items():
+            if result['pids']:
+                self.suspended_drivers[name] = drivers[name]
+                self.suspended[name] = result['pids']
+        if self.closed:
+            # close() was called while we were stopping processes
+            self.resume()
+        self._log_location(results)
+        if self.report is not None:
+            self.report('suspend', results)
+        return results
+
+    # Helpers
+    @contextmanager
+    def _command_line_held(self):
+        '''
+        Yield the pids held by command line pauses, with the command line
+        state locked so none is taken or released meanwhile
+        '''
+        if self.command_line is None:
+            yield set()
+            return
+        # A control of its own, as suspend() and resume() may run on
+        # different threads
+        command_line = self.command_line(self.prefs, engine=self)
+        command_line.lock()
+        try:
+            yield command_line.held()
+        finally:
+            command_line.unlock()
+
+    def _run(self, jobs):
+        if not jobs:
+            return {}
+        if len(jobs) == 1:
+            results = [self._control_app(jobs[0])]
+        else:
+            if self.pool is None:
+                self.pool = ThreadPool(MAX_WORKERS)
+            results = self.pool.map(self._control_app, jobs)
+        return dict(results)
+
+    def _control_app(self, job):
+        '''
+        Pause or resume the pids of one app. Returns (app_name, result).
+        '''
+        name, driver, pids, operation = job
+        if operation == 'pause':
+            return name, driver.pause(pids, cancelled=lambda: self.closed)
+        return name, driver.resume(pids)
+
+
+class PauseScheduler(object):
+    '''
+    Merge bursts of library change events into pause windows.
+    A window opens on the first event and closes once no event has arrived for
+    quiet_period seconds, or max_pause seconds after it opened, whichever comes
+    first. After a window closes, events arriving within cooldown seconds do
+    not reopen it; report_backlog() extends the cooldown while the sync app
+    uploads what the window wrote, up to max_pause. The caller arms a timer
+    for next_deadline() and calls tick() when it fires. before_resume, if
+    given, is called as a window closes while the sync apps are still
+    suspended.
+    '''
+    def __init__(self, engine, quiet_period=DEFAULT_RESUME_DELAY,
+                 max_pause=DEFAULT_MAX_PAUSE, cooldown=DEFAULT_PAUSE_COOLDOWN,
+                 upload_rate=DEFAULT_UPLOAD_RATE, clock=time.time,
+                 before_resume=None):
+        self.engine = engine
+        self.before_resume = before_resume
+        self.quiet_period = quiet_period
+        self.max_pause = max_pause
+        self.cooldown = cooldown
+        self.upload_rate = upload_rate
+        self.clock = clock
+
+        self.window_start = None
+        self.window_events = 0
+        self.last_event = None
+        self.last_close = None
+        # (start, duration, events, closed_at) of the last window closed
+        self.last_window = None
+        self.cooldown_until = 0
+        self.pending_bytes = 0
+
+        # Counters
+        self.windows = 0
+        self.events = 0
+        self.merged_events = 0
+        self.cooldown_events = 0
+        self.paused_time = 0.0
+
+    @property
+    def paused(self):
+        return self.window_start is not None
+
+    def configure(self, quiet_period, max_pause, cooldown,
+                  upload_rate=DEFAULT_UPLOAD_RATE):
+        self.quiet_period = quiet_period
+        self.max_pause = max_pause
+        self.cooldown = cooldown
+        self.upload_rate = upload_rate
+
+    def event(self):
+        '''
+        A library change was reported. Returns True if a window is open.
+        '''
+        now = self.clock()
+        self.events += 1
+        if self.window_start is None:
+            if now < self.cooldown_until:
+                self.cooldown_events += 1
+                return False
+            self.window_start = now
+            self.window_events = 0
+            self.windows += 1
+            self.engine.suspend()
+        else:
+            self.merged_events += 1
+        self.window_events += 1
+        self.last_event = now
+        return True
+
+    def next_deadline(self):
+        '''
+        Seconds until the open window is due to close, or None
+        '''
+        if self.window_start is None:
+            return None
+        deadline = min(self.last_event + self.quiet_period,
+                       self.window_start + self.max_pause)
+        return max(0, deadline - self.clock())
+
+    def tick(self):
+        '''
+        Close the open window if it is due. Returns True if it was closed.
+        '''
+        remaining = self.next_deadline()
+        if remaining is None or remaining > 0:
+            return False
+        self.close()
+        return True
+
+    def close(self):
+        '''
+        Close the open window now, resuming the sync app
+        '''
+        if self.window_start is None:
+            return
+        now = self.clock()
+        self.paused_time += now - self.window_start
+        self.last_window = (self.window_start, now - self.window_start,
+                            self.window_events, now)
+        self.window_start = self.last_event = None
+        self.last_close = now
+        self.cooldown_until = now + self.cooldown
+        try:
+            if self.before_resume is not None:
+                self.before_resume()
+        finally:
+            # Whatever went wrong, never leave the sync apps stopped
+            self.engine.resume()
+
+    def report_backlog(self, pending_bytes):
+        '''
+        The sync app has pending_bytes to upload since the last window closed.
+        Hold off the next window until it is likely to have caught up.
+        '''
+        self.pending_bytes = pending_bytes
+        if self.window_start is not None or self.upload_rate <= 0:
+            return
+        start = self.last_close if self.last_close is not None else self.clock()
+        upload_time = min(pending_bytes / self.upload_rate, self.max_pause)
+        self.cooldown_until = max(self.cooldown_until, start + upload_time)
+
+    def counters(self):
+        paused_time = self.paused_time
+        if self.window_start is not None:
+            paused_time += self.clock() - self.window_start
+        return {
+            'windows': self.windows,
+            'events': self.events,
+            'merged_events': self.merged_events,
+            'cooldown_events': self.cooldown_events,
+            'paused_time': paused_time,
+            'pending_bytes': self.pending_bytes,
+            }
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2014, Greg Riker <griker@hotmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import json, os, threading, time
+from collections import deque
+
+from calibre.constants import DEBUG
+from calibre.devices.usbms.driver import debug_print
+from calibre.utils.config import config_dir
+
+# Number of records kept in memory
+DEFAULT_CAPACITY = 4096
+
+# Number of runs kept in the timing history, and samples kept per phase per run
+DEFAULT_MAX_RUNS = 20
+MAX_SAMPLES = 50
+
+TRACE_LOG = os.path.join(config_dir, 'plugins', 'SyncMan_resources', 'trace.log')
+TIMINGS_FILE = os.path.join(config_dir, 'plugins', 'SyncMan_resources', 'timings.json')
+
+
+class Tracer(object):
+    '''
+    Bounded in-memory trace of plugin events and timed spans.
+    Records hold a format string and its arguments, which are only formatted
+    when the trace is flushed to TRACE_LOG, or echoed when calibre is running
+    in debug mode. Callers test tracer.enabled before recording, so disabled
+    tracing costs one attribute check per call.
+    '''
+    def __init__(self, enabled=False, capacity=DEFAULT_CAPACITY, echo=DEBUG):
+        self.enabled = enabled
+        self.echo = echo
+        self.records = deque(maxlen=capacity)
+
+    def event(self, fmt, *args):
+        '''
+        Record fmt.format(*args), formatted lazily
+        '''
+        record = (time.time(), threading.current_thread().name, fmt, args)
+        self.records.append(record)
+        if self.echo:
+            debug_print(self.format_record(record, stamp=False))
+
+    def flush(self, path=TRACE_LOG):
+        '''
+        Write the records to path, replacing the previous trace
+        '''
+        if not self.records:
+            return
+        lines = [self.format_record(record) for record in list(self.records)]
+        with open(path, 'wb') as f:
+            f.write('\n'.join(lines).encode('utf-8') + b'\n')
+
+    def format_record(self, record, stamp=True):
+        timestamp, thread, fmt, args = record
+        try:
+            msg = fmt.format(*args)
+        except Exception as e:
+            msg = "{0!r} {1!r} ({2})".format(fmt, args, e)
+        if not stamp:
+            return msg
+        return "{0}.{1:03d} [{2}] {3}".format(
+            time.strftime('%H:%M:%S', time.localtime(timestamp)),
+            int(timestamp * 1000) % 1000, thread, msg)
+
+    def span(self, name):
+        '''
+        Context manager recording the duration of the enclosed block in
+        timings, and in the trace if enabled
+        '''
+        return Span(self, name)
+
+
+class PhaseTimings(object):
+    '''
+    Durations of named phases in this run and in the previous max_runs runs.
+    The history is read when first needed and written by save() at shutdown,
+    so recording costs nothing on disk during startup.
+    '''
+    def __init__(self, path=TIMINGS_FILE, max_runs=DEFAULT_MAX_RUNS):
+        self.path = path
+        self.max_runs = max_runs
+        # {phase: [seconds, ...]} for this run
+        self.current = {}
+        self.history = None
+
+    def load(self):
+        '''
+        Return the saved runs, oldest first, as a list of {phase: [seconds]}
+        '''
+        if self.history is None:
+            self.history = []
+            if os.path.exists(self.path):
+                try:
+                    with open(self.path, 'rb') as f:
+                        self.history = json.loads(f.read())
+                except:
+                    self.history = []
+        return self.history
+
+    def record(self, phase, seconds):
+        samples = self.current.setdefault(phase, [])
+        if len(samples) < MAX_SAMPLES:
+            samples.append(seconds)
+
+    def save(self):
+        '''
+        Append this run to the history
+        '''
+        if not self.current:
+            return
+        history = self.load() + [self.current]
+        self.history = history[-self.max_runs:]
+        self.current = {}
+        with open(self.path, 'wb') as f:
+            f.write(json.dumps(self.history, separators=(',', ':')).encode('utf-8'))
+
+    def stats(self):
+        '''
+        Return {phase: (samples, min, median, max)} in seconds over the saved
+        runs and this run
+        '''
+        merged = {}
+        for run in self.load() + [self.current]:
+            for phase, samples in run.items():
+                merged.setdefault(phase, []).extend(samples)
+
+        stats = {}
+        for phase, samples in merged.items():
+            samples = sorted(samples)
+            n = len(samples)
+            if n % 2:
+                median = samples[n // 2]
+            else:
+                median = (samples[n // 2 - 1] + samples[n // 2]) / 2
+            stats[phase] = (n, samples[0], median, samples[-1])
+        return stats
+
+
+class Span(object):
+    def __init__(self, tracer, name):
+        self.tracer = tracer
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, *args):
+        elapsed = time.time() - self.started
+        timings.record(self.name, elapsed)
+        if self.tracer.enabled:
+            self.tracer.event("span {0}: {1:.3f} ms", self.name, elapsed * 1000)
+
+
+# Shared by every module of the plugin. prefs.py enables the tracer from
+# 'Enable debug logging'; timings are always recorded.
+tracer = Tracer()
+timings = PhaseTimings()